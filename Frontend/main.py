@@ -5,49 +5,29 @@ from dash import html
 from dash import dash_table
 from dash.dependencies import Input, Output
 import pandas as pd
-import plotly.express as px
 import numpy as np
 import dash_bootstrap_components as dbc
-import plotly.graph_objects as go
-
-
-# Sample GeoJSON data for Bremen (replace this with actual GeoJSON data)
-bremen_geojson = {
-  "type": "FeatureCollection",
-  "features": [
-    {
-      "type": "Feature",
-      "properties": {"name": "Bremen City Center"},
-      "geometry": {
-        "type": "Point",
-        "coordinates": [8.80776, 53.07516]
-      }
-    },
-    {
-      "type": "Feature",
-      "properties": {"name": "University of Bremen"},
-      "geometry": {
-        "type": "Point",
-        "coordinates": [8.84858, 53.10645]
-      }
-    },
-    {
-      "type": "Feature",
-      "properties": {"name": "Bremen Airport"},
-      "geometry": {
-        "type": "Point",
-        "coordinates": [8.78667, 53.0475]
-      }
-    }
-  ]
-}
-
-
-# Updated Air quality data for the map
-air_quality_data = pd.DataFrame({
-    'id': ["Bremen City Center", "University of Bremen", "Bremen Airport"],
-    'air_quality': [50, 75, 100]  # Example air quality values for each location
-})
+import math
+import os
+import psycopg2
+# Heatmap cells from common/cells.py; run with PYTHONPATH=common
+from cells import POLLUTANTS, heatmap_cells
+
+
+# PostgreSQL database credentials
+db_name = os.getenv('DB_NAME', 'default_db_name')
+db_user = os.getenv('DB_USER', 'default_user')
+db_password = os.getenv('DB_PASSWORD', 'default_password')
+db_host = os.getenv('DB_HOST', 'localhost')
+db_port = os.getenv('DB_PORT', '5432')
+
+# Initial map view and the size used to estimate its extent
+MAP_CENTER = {"lat": 53.0793, "lon": 8.8017}
+MAP_ZOOM = 12
+MAP_HEIGHT = 600
+MAP_WIDTH_ESTIMATE = 1200  # pixels, until the map reports its real bounds
+
+POLLUTANT_LABELS = {'co': 'CO', 'pm25': 'PM2.5', 'no2': 'NO2', 'nh3': 'NH3'}
 
 
 # Sample DataFrame for air quality data visualization
@@ -81,6 +61,12 @@ app.layout = html.Div([
 # Layout for Map page
 map_layout = html.Div([
     html.H1("Bremen Air Quality Map"),
+    dcc.Dropdown(
+        id='heatmap-pollutant',
+        options=[{'label': POLLUTANT_LABELS[p], 'value': p} for p in POLLUTANTS],
+        value='pm25',
+        clearable=False
+    ),
     dcc.Graph(id='bremen-map', figure={})
 ])
 
@@ -113,84 +99,91 @@ def display_page(pathname):
     else:
         return "404 Page Not Found"
 
-bicycle_icon_url = "https://upload.wikimedia.org/wikipedia/commons/3/34/Map_icons_by_Scott_de_Jonge_-_bicycle-store.svg"
+def connect_to_database():
+    return psycopg2.connect(
+        dbname=db_name,
+        user=db_user,
+        password=db_password,
+        host=db_host,
+        port=db_port
+    )
+
 
-# Callback for updating the map
-# Callback for updating the map to display points with air quality data
-# Callback for updating the map to display points with air quality data
+def map_view(relayout_data):
+    # Center, zoom and (west, south, east, north) of what the map shows
+    relayout_data = relayout_data or {}
+    center = relayout_data.get('mapbox.center', MAP_CENTER)
+    zoom = relayout_data.get('mapbox.zoom', MAP_ZOOM)
+    corners = relayout_data.get('mapbox._derived', {}).get('coordinates')
+    if corners:
+        lons = [lon for lon, _ in corners]
+        lats = [lat for _, lat in corners]
+        return center, zoom, (min(lons), min(lats), max(lons), max(lats))
+    # 256 pixel tiles: degrees of longitude per pixel at this zoom
+    degrees = 360 / (256 * 2 ** zoom)
+    half_width = MAP_WIDTH_ESTIMATE / 2 * degrees
+    half_height = MAP_HEIGHT / 2 * degrees * math.cos(math.radians(center['lat']))
+    return center, zoom, (center['lon'] - half_width, center['lat'] - half_height,
+                          center['lon'] + half_width, center['lat'] + half_height)
+
+
+# plotly.express and plotly.graph_objects load slowly, so the callbacks
+# that draw figures import them
+
+# Callback for updating the map with the heatmap cells in view
 @app.callback(
     Output('bremen-map', 'figure'),
-    [Input('bremen-map', 'value')]
+    [Input('bremen-map', 'relayoutData'),
+     Input('heatmap-pollutant', 'value')]
 )
-def update_map(selected_value):
-    # Extract latitude, longitude, and names from GeoJSON
-    latitudes = [feature['geometry']['coordinates'][1] for feature in bremen_geojson['features']]
-    longitudes = [feature['geometry']['coordinates'][0] for feature in bremen_geojson['features']]
-    names = [feature['properties']['name'] for feature in bremen_geojson['features']]
-    
-    # Create a DataFrame for the map with air quality data
-    map_data = pd.DataFrame({
-        'lat': latitudes,
-        'lon': longitudes,
-        'name': names,
-        'air_quality': air_quality_data['air_quality']
-    })
-
-    # Generate random locations for bicycles around Bremen
-    np.random.seed(42)  # Seed for reproducibility
-    bicycle_lats = np.random.uniform(53.045, 53.095, 20)  # Random latitudes
-    bicycle_lons = np.random.uniform(8.775, 8.845, 20)  # Random longitudes
-
-    # Initialize a figure with Mapbox
-    fig = go.Figure()
-
-    # Add air quality data to the map
-    air_quality_trace = go.Scattermapbox(
-        lat=map_data['lat'],
-        lon=map_data['lon'],
-        mode='markers',
-        marker=go.scattermapbox.Marker(
-            size=map_data['air_quality'],
-            sizeref=2.*max(map_data['air_quality'])/(40.**2),
-            sizemode='area',
-            color=map_data['air_quality'],
-            colorscale='thermal',
-            showscale=True,
-            opacity=0.6
-        ),
-        text=map_data['name']
-    )
-    fig.add_trace(air_quality_trace)
-
-    # Add bicycles to the map with custom symbols
-    bicycle_trace = go.Scattermapbox(
-        lat=bicycle_lats,
-        lon=bicycle_lons,
-        mode='markers',
-        marker=go.scattermapbox.Marker(
-            size=100,  # Size of the bicycle markers
-            color='rgb(235, 0, 100)',  # Color of the bicycle markers
-            symbol=bicycle_icon_url # Mapbox symbol for bicycle
-        ),
-        name="bicycle"
-    )
-    fig.add_trace(bicycle_trace)
-
-    # Set the layout for the map
+def update_map(relayout_data, pollutant):
+    import plotly.graph_objects as go
+    center, zoom, bbox = map_view(relayout_data)
+    conn = connect_to_database()
+    try:
+        cells = heatmap_cells(conn, bbox, zoom)
+    finally:
+        conn.close()
+
+    # One square polygon per cell, coloured by the mean of the pollutant
+    features = []
+    for cell in cells:
+        west, south, east, north = cell['bounds']
+        features.append({
+            "type": "Feature",
+            "id": f"{cell['x']}/{cell['y']}",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]]
+            }
+        })
+
+    fig = go.Figure(go.Choroplethmapbox(
+        geojson={"type": "FeatureCollection", "features": features},
+        locations=[feature["id"] for feature in features],
+        z=[cell[f'{pollutant}_mean'] for cell in cells],
+        customdata=[[cell['readings'], cell[f'{pollutant}_max']] for cell in cells],
+        hovertemplate=(f"{POLLUTANT_LABELS[pollutant]} mean %{{z:.1f}}, max %{{customdata[1]:.1f}}"
+                       "<br>%{customdata[0]} readings<extra></extra>"),
+        colorscale='thermal',
+        marker_opacity=0.6,
+        marker_line_width=0,
+        colorbar_title=POLLUTANT_LABELS[pollutant]
+    ))
+
+    # Set the layout for the map; uirevision keeps the user's pan and zoom
     fig.update_layout(
         mapbox=dict(
             style="open-street-map",
-            zoom=12,
-            center={"lat": 53.0793, "lon": 8.8017}
+            zoom=zoom,
+            center=center
         ),
-        height=600,
+        uirevision='heatmap',
+        height=MAP_HEIGHT,
         margin={"r":0,"t":0,"l":0,"b":0}
     )
-    
-    return fig
-
-
 
+    return fig
 
 
 # Callback for updating the data visualization graph
@@ -199,6 +192,7 @@ def update_map(selected_value):
     [Input('location-dropdown', 'value')]
 )
 def update_graph(selected_location):
+    import plotly.express as px
     filtered_df = df[df.Location == selected_location]
     fig = px.line(
         filtered_df,
@@ -210,5 +204,9 @@ def update_graph(selected_location):
 
 
 # Run the app
-if __name__ == '__main__':
+def main():
     app.run_server(debug=True)
+
+
+if __name__ == '__main__':
+    main()
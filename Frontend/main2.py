@@ -38,7 +38,7 @@ app.layout = html.Div([
                     L.tileLayer('https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
                         maxZoom: 20
                     }}).addTo(map);
-                    var wmsLayer = L.tileLayer.wms("{geoserver_wms_url}/wms", {{
+                    var wmsLayer = L.tileLayer.wms("{geoserver_wms_url}/gwc/service/wms", {{
                         layers: '{wms_layer_name}',
                         format: 'image/png',
                         transparent: true,
@@ -55,5 +55,9 @@ app.layout = html.Div([
 ])
 
 # Run the app
-if __name__ == '__main__':
+def main():
     app.run_server(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,18 @@
 import psycopg2
 import networkx as nx
-from shapely.geometry import Point, MultiPoint, LineString
+import numpy as np
+import shapely
+from shapely.geometry import Point, MultiPoint
 from shapely.ops import nearest_points
-import geopandas as gpd
-from shapely.geometry import MultiLineString
-from shapely.ops import linemerge
-import folium
+from topology import node_lines
 
 
-# Function to fetch road data from the database
-def fetch_roads_data():
+ROAD_CHUNK_SIZE = 5000  # segments per fetch from the server-side cursor
+
+
+# Function to fetch road data from the database in chunks of
+# (air quality levels, geometries)
+def fetch_roads_data(chunk_size=ROAD_CHUNK_SIZE):
     conn = psycopg2.connect(
         dbname="bremengeo",
         user="postgres",
@@ -17,31 +20,51 @@ def fetch_roads_data():
         host="localhost",
         port="5433"
     )
-    sql = 'SELECT * FROM "highway-bremen";'
-    return gpd.read_postgis(sql, conn, geom_col='geom')
-
-
-# Function to create a graph from road data
+    try:
+        with conn.cursor(name='highway_bremen_stream') as cur:
+            cur.itersize = chunk_size
+            cur.execute('SELECT air_quality_level, ST_AsBinary(geom) FROM "highway-bremen";')
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                wkb = np.array([None if row[1] is None else bytes(row[1]) for row in rows], dtype=object)
+                yield [row[0] for row in rows], shapely.from_wkb(wkb)
+    finally:
+        conn.close()
+
+
+# Function to create a graph from road data. The roads are noded with
+# common/topology.py like the road graph of Graphql_handler/algorithm.py, so
+# both join roads at the same crossings and line ends.
 def create_graph_from_roads(roads_data):
+    all_lines, all_levels = [], []
+    for levels, geoms in roads_data:
+        # Every line of a MultiLineString, also where they cannot be merged
+        # into one
+        lines, line_rows = shapely.get_parts(geoms, return_index=True)
+        all_lines.append(lines)
+        all_levels.extend(levels[i] for i in line_rows)
+    lines = np.concatenate(all_lines) if all_lines else np.empty(0, dtype=object)
+
+    # Consecutive vertices of the same noded line, plus the connectors of
+    # line ends snapped onto another road
+    coords, vertex_lines, (connector_lines, connector_starts, connector_ends) = node_lines(lines)
+    same_line = vertex_lines[1:] == vertex_lines[:-1]
+    starts = np.concatenate((coords[:-1][same_line], connector_starts))
+    ends = np.concatenate((coords[1:][same_line], connector_ends))
+    edge_lines = np.concatenate((vertex_lines[:-1][same_line], connector_lines))
+
     G = nx.Graph()
-    for index, road in roads_data.iterrows():
-        geom = road['geom']
-        if isinstance(geom, MultiLineString):
-            geom = linemerge(geom)
-        if isinstance(geom, LineString):
-            coords = list(geom.coords)
-            for i in range(len(coords)-1):
-                G.add_edge(
-                    coords[i], coords[i+1], weight=calculate_weight(road))
-        else:
-            print(f"Skipping invalid geometry at index {index}")
+    for start, end, line in zip(starts.tolist(), ends.tolist(), edge_lines.tolist()):
+        if start != end:
+            G.add_edge(tuple(start), tuple(end), weight=calculate_weight(all_levels[line]))
     return G
 
 
 # Function to calculate weight based on air quality level
-def calculate_weight(road_segment):
-    return 1 / max(
-        road_segment['air_quality_level'], 1)  # Avoid division by zero
+def calculate_weight(air_quality_level):
+    return 1 / max(air_quality_level or 1, 1)  # Avoid division by zero
 
 
 # Function to find the closest graph node to a given coordinate
@@ -95,6 +118,7 @@ def visualize_route(route):
     if not route:
         print("No route to visualize.")
         return
+    import folium
 
     # Create a map centered at the start of the route
     route_map = folium.Map(location=[route[0][1], route[0][0]], zoom_start=14)
@@ -112,19 +136,29 @@ def visualize_route(route):
     print("Route map saved to 'route_map.html'. Open this file in a web browser to view the map.")
 
 
-# Fetch road data and create a graph
-roads_data = fetch_roads_data()
-G = create_graph_from_roads(roads_data)
+def main():
+    # Fetch road data and create a graph
+    roads_data = fetch_roads_data()
+    G = create_graph_from_roads(roads_data)
+
+    print(G)
+    # Keep only the largest connected component, so that the start and end snap
+    # to nodes with a path between them
+    components = sorted(nx.connected_components(G), key=len, reverse=True)
+    print(f"{len(components)} components, the largest has {len(components[0])} of {G.number_of_nodes()} nodes")
+    G = G.subgraph(components[0]).copy()
+    # Add coordinates as node attributes for all nodes in the graph
+    for node in G.nodes:
+        G.nodes[node]['coord'] = node
+
+    # Define start and end coordinates for the route calculation
+    start = (8.808072, 53.094698)  # Replace with actual start coordinates
+    end = (8.814953, 53.093698)       # Replace with actual end coordinates
 
-print(G)
-# Add coordinates as node attributes for all nodes in the graph
-for node in G.nodes:
-    G.nodes[node]['coord'] = node
+    # Calculate the route
+    route = find_route(start, end, G)
+    visualize_route(route)
 
-# Define start and end coordinates for the route calculation
-start = (8.808072, 53.094698)  # Replace with actual start coordinates
-end = (8.814953, 53.093698)       # Replace with actual end coordinates
 
-# Calculate the route
-route = find_route(start, end, G)
-visualize_route(route)
+if __name__ == '__main__':
+    main()
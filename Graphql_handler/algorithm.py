@@ -1,14 +1,13 @@
 import psycopg2
 import logging
 import time
-import networkx as nx
-import geopy.distance
-import geopandas as gpd
 import pickle
-from shapely.geometry import MultiLineString
-from neo4j import GraphDatabase
 import os
 
+# networkx, shapely, geopy, neo4j and the road layer modules are imported
+# by the functions that use them, so that the services and tools that only
+# need connect_to_database or level_factor from here start quickly
+
 # Database initialization
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -24,6 +23,23 @@ neo4j_uri = os.getenv('NEO4J_URI', 'neo4j://localhost:7687')
 neo4j_user = os.getenv('NEO4J_USER', 'neo4j')
 neo4j_password = os.getenv('NEO4J_PASSWORD', 'default_password')
 
+EXPORT_BATCH_SIZE = 5000  # nodes or relationships per UNWIND transaction
+# Optional "xmin,ymin,xmax,ymax" extent to build the graph for
+road_bbox = tuple(map(float, os.getenv('ROAD_BBOX').split(','))) if os.getenv('ROAD_BBOX') else None
+# The road lines are noded in tiles of this size, so only one tile of
+# geometry is in memory at a time
+graph_tile_degrees = float(os.getenv('GRAPH_TILE_DEGREES', '0.05'))  # about 5 km
+
+# Levels 1-5 come from handler.determine_air_quality_level; anything else
+# (NULL or the 150 placeholder) is treated as this factor
+unknown_level = float(os.getenv('UNKNOWN_AIR_QUALITY_LEVEL', '2'))
+KNOWN_LEVELS = {1, 2, 3, 4, 5}
+MIN_LEVEL = 1
+
+# Connected components with fewer nodes are dropped from the graph; the
+# largest one (component 0) is the routable core that endpoints snap to
+min_component_nodes = int(os.getenv('MIN_COMPONENT_NODES', '20'))
+
 
 def connect_to_database(attempts=5, delay=5):
     while attempts > 0:
@@ -43,25 +59,175 @@ def connect_to_database(attempts=5, delay=5):
     raise Exception("Unable to connect to the database")
 
 def build_network(conn):
+    from road_layer import layer_extent, stream_road_segments
+    return build_network_tiled(
+        lambda bbox=None: stream_road_segments(conn, bbox=bbox), layer_extent(conn), road_bbox)
+
+def line_keys(rows, line_rows):
+    # (gid, part) of every line that get_parts returned for a chunk
+    import numpy as np
+    parts = np.arange(len(line_rows)) - np.searchsorted(line_rows, line_rows)
+    return [(rows[row][0], part) for row, part in zip(line_rows.tolist(), parts.tolist())]
+
+def tile_windows(extent, size):
+    # Windows are half-open, so the last row and column reach past the extent
+    west, south, east, north = extent
+    i = 0
+    while west + i * size <= east:
+        j = 0
+        while south + j * size <= north:
+            yield (west + i * size, south + j * size, west + (i + 1) * size, south + (j + 1) * size)
+            j += 1
+        i += 1
+
+def collect_splits(read, extent):
+    # Split points per (gid, part) and connectors as (row, start, end), from
+    # one tile of lines at a time
+    import numpy as np
+    import shapely
+    from topology import snap_degrees, split_points
+    splits, connectors = {}, []
+    margin = 2 * snap_degrees
+    for window in tile_windows(extent, graph_tile_degrees):
+        lines, rows, keys = [], [], []
+        for chunk_rows, geoms in read((window[0] - margin, window[1] - margin,
+                                       window[2] + margin, window[3] + margin)):
+            chunk_lines, line_rows = shapely.get_parts(geoms, return_index=True)
+            lines.append(chunk_lines)
+            rows.extend(chunk_rows[i] for i in line_rows)
+            keys.extend(line_keys(chunk_rows, line_rows))
+        if not lines:
+            continue
+        split_lines, points, (owners, starts, ends) = split_points(np.concatenate(lines), window)
+        for i, point in zip(split_lines.tolist(), points.tolist()):
+            splits.setdefault(keys[i], []).append(point)
+        connectors.extend(zip((rows[i] for i in owners.tolist()), starts.tolist(), ends.tolist()))
+    return splits, connectors
+
+def build_network_tiled(read, extent, bbox=None):
+    # read(bbox) yields the (rows, geometries) chunks of the segments whose
+    # bbox intersects bbox. The split points are found tile by tile first,
+    # then the layer is read once more and every line is noded on its own.
+    # With a bbox, roads are only noded inside it.
+    import networkx as nx
+    import numpy as np
+    import shapely
+    from topology import coord_decimals, insert_splits
+    G = nx.Graph()
+    if bbox is not None:
+        extent = bbox
+    if extent is None:
+        return finish_network(G, 0, 0)
+    splits, connectors = collect_splits(read, extent)
+
+    line_count = 0
+    for rows, geoms in read(bbox):
+        lines, line_rows = shapely.get_parts(geoms, return_index=True)
+        line_count += len(lines)
+        split_lines, points = [], []
+        for i, key in enumerate(line_keys(rows, line_rows)):
+            for point in splits.get(key, ()):
+                split_lines.append(i)
+                points.append(point)
+        coords, vertex_lines = insert_splits(
+            lines, np.array(split_lines, dtype=np.int64), np.array(points, dtype=float).reshape(-1, 2))
+        same_line = vertex_lines[1:] == vertex_lines[:-1]
+        starts, ends = coords[:-1][same_line], coords[1:][same_line]
+        distinct = (starts != ends).any(axis=1)
+        add_edges_from_coordinates(
+            G, starts[distinct].tolist(), ends[distinct].tolist(),
+            [rows[line_rows[i]] for i in vertex_lines[:-1][same_line][distinct]])
+
+    if connectors:
+        connector_rows, starts, ends = zip(*connectors)
+        starts = np.round(np.array(starts), coord_decimals)
+        ends = np.round(np.array(ends), coord_decimals)
+        distinct = (starts != ends).any(axis=1)
+        add_edges_from_coordinates(
+            G, starts[distinct].tolist(), ends[distinct].tolist(),
+            [row for row, keep in zip(connector_rows, distinct) if keep])
+    return finish_network(G, line_count, len(connectors))
+
+def build_network_from_segments(segments):
+    # segments: (gid, air_quality_level) rows and geometries per chunk. The
+    # lines of all chunks are noded together, since a crossing can join
+    # segments of different chunks.
+    import networkx as nx
+    import numpy as np
+    import shapely
+    from topology import coord_decimals, node_lines
+    all_lines, all_rows = [], []
+    for rows, geoms in segments:
+        # Split MultiLineStrings into their lines
+        lines, line_rows = shapely.get_parts(geoms, return_index=True)
+        all_lines.append(lines)
+        all_rows.extend(rows[i] for i in line_rows)
+    lines = np.concatenate(all_lines) if all_lines else np.empty(0, dtype=object)
+
+    # Pair up consecutive vertices of the same noded line; every edge keeps
+    # the gid of the segment it belongs to
+    coords, vertex_lines, (connector_lines, connector_starts, connector_ends) = node_lines(lines)
+    same_line = vertex_lines[1:] == vertex_lines[:-1]
+    starts = np.concatenate((coords[:-1][same_line], connector_starts))
+    ends = np.concatenate((coords[1:][same_line], connector_ends))
+    edge_lines = np.concatenate((vertex_lines[:-1][same_line], connector_lines))
+    distinct = (starts != ends).any(axis=1)
     G = nx.Graph()
-    sql = 'SELECT gid, geom FROM "highway-bremen";'
-    df = gpd.read_postgis(sql, conn, geom_col='geom')
-    for index, row in df.iterrows():
-        geom = row.geom
-        if isinstance(geom, MultiLineString):
-            for line in geom.geoms:
-                add_edges_from_line(G, line)
-        else:
-            add_edges_from_line(G, geom)
+    add_edges_from_coordinates(
+        G, starts[distinct].tolist(), ends[distinct].tolist(),
+        [all_rows[i] for i in edge_lines[distinct]])
+    return finish_network(G, len(lines), len(connector_lines))
+
+def finish_network(G, line_count, connector_count):
+    from topology import coord_decimals
+    logging.info(f"Noded {line_count} road lines, {connector_count} line ends snapped")
+    label_components(G)
+    G.graph['coord_decimals'] = coord_decimals
+    G.graph['fingerprint'] = graph_fingerprint(G)
     return G
 
-def add_edges_from_line(G, line):
-    coords = list(line.coords)
-    for i in range(len(coords) - 1):
-        point1 = coords[i]
-        point2 = coords[i + 1]
+def graph_fingerprint(G):
+    # Short hash of the edges and their gids, so that a rebuilt graph can be
+    # told apart from the one a cached route was computed on
+    import hashlib
+    import numpy as np
+    edges = np.array([(*u, *v, -1 if data.get('gid') is None else data['gid'])
+                      for u, v, data in G.edges(data=True)], dtype=float)
+    return hashlib.blake2b(edges.tobytes(), digest_size=8).hexdigest()
+
+def label_components(G):
+    # Drops the fragments below min_component_nodes and numbers the rest by
+    # size into the `component` node attribute, so that two nodes are
+    # connected exactly when their components are equal
+    import networkx as nx
+    components = sorted(nx.connected_components(G), key=len, reverse=True)
+    pruned = [c for c in components[1:] if len(c) < min_component_nodes]
+    for component in pruned:
+        G.remove_nodes_from(component)
+    components = components[:len(components) - len(pruned)]
+    for i, component in enumerate(components):
+        for node in component:
+            G.nodes[node]['component'] = i
+    G.graph['component_sizes'] = [len(c) for c in components]
+
+    core = len(components[0]) if components else 0
+    logging.info(
+        f"Road graph: {G.number_of_nodes()} nodes, {G.number_of_edges()} edges, "
+        f"{len(components)} components, core {core} nodes "
+        f"({100 * core / max(G.number_of_nodes(), 1):.1f}%); "
+        f"pruned {len(pruned)} fragments with {sum(len(c) for c in pruned)} nodes")
+
+def add_edges_from_coordinates(G, starts, ends, rows):
+    import geopy.distance
+    for point1, point2, (gid, air_quality_level) in zip(starts, ends, rows):
+        point1 = tuple(point1)
+        point2 = tuple(point2)
         distance = geopy.distance.distance(point1, point2).km
-        G.add_edge(point1, point2, weight=distance)
+        G.add_edge(point1, point2, weight=distance, gid=gid,
+                   air_quality_level=air_quality_level)
+
+def level_factor(level):
+    return float(level) if level in KNOWN_LEVELS else unknown_level
 
 def save_graph(graph, filename='network_graph.pkl'):
     with open(filename, 'wb') as f:
@@ -71,45 +237,100 @@ def load_graph(filename='network_graph.pkl'):
     with open(filename, 'rb') as f:
         return pickle.load(f)
 
+def load_or_build_network(filename='network_graph.pkl'):
+    from road_layer import road_source
+    from topology import coord_decimals
+    try:
+        G = load_graph(filename)  # Load the graph from a file
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        G = None
+    if G is not None and G.graph.get('coord_decimals') == coord_decimals:
+        return G
+    if G is not None:
+        logging.info(f"{filename} was built without the current noding, rebuilding it")
+    try:
+        conn = connect_to_database()
+    except Exception as e:
+        logging.error(e)
+        conn = None  # The road snapshot can still be used
+    try:
+        # Build the graph from the road snapshot, or PostGIS if it is stale
+        read, extent = road_source(conn)
+        G = build_network_tiled(read, extent, road_bbox)
+        save_graph(G, filename)  # Save the graph to a file
+    finally:
+        if conn is not None:
+            conn.close()
+    return G
+
 def connect_to_neo4j(uri, user, password):
+    from neo4j import GraphDatabase
     return GraphDatabase.driver(uri, auth=(user, password))
 
-def create_node(tx, node_id, latitude, longitude):
+def create_nodes(tx, nodes):
     query = (
-        "MERGE (n:Node {id: $node_id}) "
-        "ON CREATE SET n.latitude = $latitude, n.longitude = $longitude"
+        "UNWIND $nodes AS node "
+        "MERGE (n:Node {id: node.id}) "
+        "SET n.latitude = node.latitude, n.longitude = node.longitude, "
+        "n.location = point({latitude: node.latitude, longitude: node.longitude}), "
+        "n.component = node.component"
     )
-    tx.run(query, node_id=node_id, latitude=latitude, longitude=longitude)
+    tx.run(query, nodes=nodes)
 
-def create_relationship(tx, node_id_1, node_id_2, distance):
+def create_relationships(tx, relationships):
     query = (
-        "MATCH (n1:Node {id: $node_id_1}), (n2:Node {id: $node_id_2}) "
-        "MERGE (n1)-[:CONNECTS {distance: $distance}]->(n2)"
+        "UNWIND $relationships AS rel "
+        "MATCH (n1:Node {id: rel.source}), (n2:Node {id: rel.target}) "
+        "MERGE (n1)-[r:CONNECTS]->(n2) "
+        "SET r.distance = rel.distance, r.exposure = rel.exposure, r.gid = rel.gid"
     )
-    tx.run(query, node_id_1=node_id_1, node_id_2=node_id_2, distance=distance)
+    tx.run(query, relationships=relationships)
+
+def relationship_record(node_ids, start_node, end_node, data):
+    gid = data.get('gid')
+    return {
+        'source': node_ids[start_node],
+        'target': node_ids[end_node],
+        'distance': data['weight'],
+        'exposure': data['weight'] * level_factor(data.get('air_quality_level')),
+        'gid': None if gid is None else int(gid)
+    }
 
 def transfer_graph_to_neo4j(graph, neo4j_driver):
+    from neo4j_backend import drop_projection, ensure_schema
+    ensure_schema(neo4j_driver)  # The id constraint keeps the MERGEs from scanning
+
+    # Compact integer ids instead of coordinate tuples
+    node_ids = {node: i for i, node in enumerate(graph.nodes)}
+    nodes = [{'id': i, 'latitude': node[0], 'longitude': node[1],
+              'component': graph.nodes[node].get('component', 0)}
+             for node, i in node_ids.items()]
+    relationships = [
+        relationship_record(node_ids, start_node, end_node, data)
+        for start_node, end_node, data in graph.edges(data=True)]
+
     with neo4j_driver.session() as session:
-        for node in graph.nodes:
-            session.write_transaction(create_node, node, node[0], node[1])
-        for start_node, end_node, data in graph.edges(data=True):
-            session.write_transaction(create_relationship, start_node, end_node, data['weight'])
+        for i in range(0, len(nodes), EXPORT_BATCH_SIZE):
+            session.write_transaction(create_nodes, nodes[i:i + EXPORT_BATCH_SIZE])
+        for i in range(0, len(relationships), EXPORT_BATCH_SIZE):
+            session.write_transaction(
+                create_relationships, relationships[i:i + EXPORT_BATCH_SIZE])
 
-# Main Execution
-if __name__ == "__main__":
+    # The in-memory GDS projection no longer matches the stored graph
+    drop_projection(neo4j_driver)
+
+def main():
+    from neo4j_backend import clear_graph
     neo4j_driver = connect_to_neo4j(neo4j_uri, neo4j_user, neo4j_password)
 
-    try:
-        G = load_graph()  # Load the graph from a file
-    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
-        conn = connect_to_database()
-        try:
-            G = build_network(conn)  # Build the graph
-            save_graph(G)  # Save the graph to a file
-        finally:
-            conn.close()
+    G = load_or_build_network()
 
-    # Transfer the graph to Neo4j
+    # Replace the stored graph with a fresh export
+    clear_graph(neo4j_driver)
     transfer_graph_to_neo4j(G, neo4j_driver)
 
     neo4j_driver.close()
+
+# Main Execution
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+import heapq
+import logging
+import os
+import time
+
+import numpy as np
+
+from algorithm import graph_fingerprint, load_or_build_network
+
+hierarchy_file = os.getenv('CH_FILE', 'contraction_hierarchy.npz')
+graph_file = os.getenv('GRAPH_FILE', 'network_graph.pkl')
+
+# Customizable contraction hierarchy (CCH):
+#  * preprocessing orders the nodes and adds every shortcut of the elimination
+#    game; it only depends on the topology of the road graph
+#  * customization computes shortcut weights for one metric (distance,
+#    exposure, ...) with a vectorized pass over the lower triangles
+#  * queries walk the elimination tree upwards, no priority queue is needed
+
+
+def minimum_degree_order(adjacency):
+    # Greedy minimum degree elimination; returns the elimination rank of every
+    # node and its upward neighbours in the resulting chordal supergraph
+    adjacency = [set(neighbours) for neighbours in adjacency]
+    heap = [(len(neighbours), v) for v, neighbours in enumerate(adjacency)]
+    heapq.heapify(heap)
+
+    rank = np.full(len(adjacency), -1, dtype=np.int64)
+    upward = [None] * len(adjacency)
+    next_rank = 0
+    while heap:
+        degree, v = heapq.heappop(heap)
+        if rank[v] >= 0 or degree != len(adjacency[v]):
+            continue
+        rank[v] = next_rank
+        next_rank += 1
+        neighbours = adjacency[v]
+        upward[v] = neighbours
+        for u in neighbours:
+            adjacency[u].discard(v)
+            adjacency[u].update(w for w in neighbours if w != u)
+            heapq.heappush(heap, (len(adjacency[u]), u))
+        adjacency[v] = set()
+    return rank, upward
+
+
+class ContractionHierarchy:
+    ARRAYS = ('node_coords', 'rank', 'parent', 'up_start', 'arc_tail',
+              'arc_head', 'input_u', 'input_v', 'input_arc', 'tri_vu',
+              'tri_vw', 'tri_uw', 'batch_bounds')
+
+    def __init__(self, fingerprint=None, **arrays):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.node_count = len(self.node_coords)
+        # graph_fingerprint of the road graph it was built for
+        self.fingerprint = fingerprint
+
+        # Plain Python views for the query loop, where NumPy scalar
+        # indexing would dominate the running time
+        self.parent_list = self.parent.tolist()
+        self.head_views = [
+            self.arc_head[lo:hi] for lo, hi in zip(
+                self.up_start[:-1].tolist(), self.up_start[1:].tolist())]
+
+        # Incoming upward arcs per node, used to recover search predecessors
+        self.down_arcs = np.argsort(self.arc_head, kind='stable')
+        self.down_start = np.searchsorted(
+            self.arc_head[self.down_arcs], np.arange(self.node_count + 1))
+
+    @classmethod
+    def build(cls, graph):
+        nodes = list(graph.nodes)
+        index = {node: i for i, node in enumerate(nodes)}
+        n = len(nodes)
+
+        input_u, input_v = [], []
+        adjacency = [[] for _ in range(n)]
+        for a, b in graph.edges():
+            u, v = index[a], index[b]
+            if u == v:
+                continue
+            input_u.append(u)
+            input_v.append(v)
+            adjacency[u].append(v)
+            adjacency[v].append(u)
+
+        rank, upward = minimum_degree_order(adjacency)
+
+        # Upward arcs in CSR layout, sorted by the rank of their head
+        up_start = np.zeros(n + 1, dtype=np.int64)
+        heads = []
+        for v in range(n):
+            ups = sorted(upward[v], key=rank.__getitem__)
+            heads.append(ups)
+            up_start[v + 1] = up_start[v] + len(ups)
+        arc_head = np.fromiter(
+            (u for ups in heads for u in ups), dtype=np.int64,
+            count=up_start[-1])
+        arc_tail = np.repeat(np.arange(n), np.diff(up_start))
+        arc_id = {(t, h): a for a, (t, h) in enumerate(zip(
+            arc_tail.tolist(), arc_head.tolist()))}
+
+        # The parent in the elimination tree is the lowest upward neighbour
+        parent = np.full(n, -1, dtype=np.int64)
+        has_up = np.diff(up_start) > 0
+        parent[has_up] = arc_head[up_start[:-1][has_up]]
+
+        input_arc = np.array([
+            arc_id[(u, v)] if rank[u] < rank[v] else arc_id[(v, u)]
+            for u, v in zip(input_u, input_v)], dtype=np.int64)
+
+        # Lower triangles (v, u, w) with v below u below w; grouped by the
+        # height of v in the elimination tree so that each group only reads
+        # arcs that earlier groups have finalised
+        height = np.zeros(n, dtype=np.int64)
+        for v in np.argsort(rank):
+            if parent[v] >= 0:
+                height[parent[v]] = max(height[parent[v]], height[v] + 1)
+
+        tri_vu, tri_vw, tri_uw, tri_height = [], [], [], []
+        for v in range(n):
+            ups = heads[v]
+            base = up_start[v]
+            for i in range(len(ups)):
+                for j in range(i + 1, len(ups)):
+                    tri_vu.append(base + i)
+                    tri_vw.append(base + j)
+                    tri_uw.append(arc_id[(ups[i], ups[j])])
+                    tri_height.append(height[v])
+
+        order = np.argsort(np.array(tri_height, dtype=np.int64), kind='stable')
+        tri_height = np.array(tri_height, dtype=np.int64)[order]
+        batch_bounds = np.flatnonzero(np.diff(tri_height)) + 1
+        batch_bounds = np.concatenate(([0], batch_bounds, [len(order)]))
+
+        return cls(
+            fingerprint=graph.graph.get('fingerprint') or graph_fingerprint(graph),
+            node_coords=np.array(nodes, dtype=float),
+            rank=rank,
+            parent=parent,
+            up_start=up_start,
+            arc_tail=arc_tail,
+            arc_head=arc_head,
+            input_u=np.array(input_u, dtype=np.int64),
+            input_v=np.array(input_v, dtype=np.int64),
+            input_arc=input_arc,
+            tri_vu=np.array(tri_vu, dtype=np.int64)[order],
+            tri_vw=np.array(tri_vw, dtype=np.int64)[order],
+            tri_uw=np.array(tri_uw, dtype=np.int64)[order],
+            batch_bounds=batch_bounds)
+
+    def save(self, filename=hierarchy_file):
+        np.savez_compressed(
+            filename, fingerprint=np.array(self.fingerprint or ''),
+            **{name: getattr(self, name) for name in self.ARRAYS})
+
+    @classmethod
+    def load(cls, filename=hierarchy_file):
+        with np.load(filename) as data:
+            # Files saved before the fingerprint was added have none
+            fingerprint = str(data['fingerprint']) if 'fingerprint' in data.files else None
+            return cls(fingerprint=fingerprint or None, **{name: data[name] for name in cls.ARRAYS})
+
+    def nodes(self):
+        return [tuple(coords) for coords in self.node_coords.tolist()]
+
+    def edge_weights(self, graph, attribute):
+        nodes = self.nodes()
+        return np.array([
+            graph[nodes[u]][nodes[v]][attribute]
+            for u, v in zip(self.input_u.tolist(), self.input_v.tolist())])
+
+    def customize(self, weights):
+        W = np.full(len(self.arc_head), np.inf)
+        np.minimum.at(W, self.input_arc, np.asarray(weights, dtype=float))
+        via = np.full(len(self.arc_head), -1, dtype=np.int64)
+
+        bounds = self.batch_bounds
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            uw = self.tri_uw[lo:hi]
+            candidate = W[self.tri_vu[lo:hi]] + W[self.tri_vw[lo:hi]]
+            previous = W[uw]
+            np.minimum.at(W, uw, candidate)
+            improved = (candidate < previous) & (candidate == W[uw])
+            via[uw[improved]] = np.arange(lo, hi)[improved]
+        return CustomizedMetric(self, W, via)
+
+
+class CustomizedMetric:
+    def __init__(self, hierarchy, weights, via):
+        self.ch = hierarchy
+        self.weights = weights
+        self.via = via
+        self.weight_views = [
+            weights[lo:hi] for lo, hi in zip(
+                hierarchy.up_start[:-1].tolist(),
+                hierarchy.up_start[1:].tolist())]
+
+    def upward_search(self, source):
+        # Every upward neighbour is an ancestor in the elimination tree, so
+        # dist[v] is final by the time the walk reaches v
+        parent = self.ch.parent_list
+        head_views = self.ch.head_views
+        weight_views = self.weight_views
+        dist = np.full(self.ch.node_count, np.inf)
+        dist[source] = 0.0
+        path = []
+        v = source
+        while v >= 0:
+            path.append(v)
+            heads = head_views[v]
+            if len(heads):
+                dist[heads] = np.minimum(dist[heads], dist[v] + weight_views[v])
+            v = parent[v]
+        return np.array(path, dtype=np.int64), dist
+
+    def predecessor_arc(self, node, dist):
+        # Upward arc through which the search reached node
+        ch = self.ch
+        arcs = ch.down_arcs[ch.down_start[node]:ch.down_start[node + 1]]
+        matches = arcs[dist[ch.arc_tail[arcs]] + self.weights[arcs] == dist[node]]
+        if not len(matches):
+            raise ValueError(f"No predecessor for node {node}")
+        return matches[0]
+
+    def distance(self, source, target):
+        path, forward = self.upward_search(source)
+        _, backward = self.upward_search(target)
+        return float((forward[path] + backward[path]).min())
+
+    def route(self, source, target):
+        # Returns (node indices, cost); an empty list if unreachable
+        path, forward = self.upward_search(source)
+        _, backward = self.upward_search(target)
+        total = forward[path] + backward[path]
+        best = int(np.argmin(total))
+        if not np.isfinite(total[best]):
+            return [], None
+        meeting = path[best]
+
+        up_arcs = []
+        v = meeting
+        while v != source:
+            arc = self.predecessor_arc(v, forward)
+            up_arcs.append(arc)
+            v = self.ch.arc_tail[arc]
+        nodes = [source]
+        for arc in reversed(up_arcs):
+            nodes.extend(self.unpack(arc, reverse=False))
+
+        v = meeting
+        while v != target:
+            arc = self.predecessor_arc(v, backward)
+            nodes.extend(self.unpack(arc, reverse=True))
+            v = self.ch.arc_tail[arc]
+        return nodes, float(total[best])
+
+    def unpack(self, arc, reverse):
+        # Original nodes visited after leaving the start of the arc
+        ch = self.ch
+        nodes = []
+        stack = [(arc, reverse)]
+        while stack:
+            a, backwards = stack.pop()
+            k = self.via[a]
+            if k < 0:
+                nodes.append(int(ch.arc_tail[a] if backwards else ch.arc_head[a]))
+            elif backwards:
+                stack.append((ch.tri_vu[k], False))
+                stack.append((ch.tri_vw[k], True))
+            else:
+                stack.append((ch.tri_vw[k], False))
+                stack.append((ch.tri_vu[k], True))
+        return nodes
+
+    def matrix(self, sources, targets):
+        # Many-to-many distances with target buckets on the upward paths
+        bucket_nodes, bucket_dist, bucket_target = [], [], []
+        for j, target in enumerate(targets):
+            path, dist = self.upward_search(target)
+            bucket_nodes.append(path)
+            bucket_dist.append(dist[path])
+            bucket_target.append(np.full(len(path), j, dtype=np.int64))
+        bucket_nodes = np.concatenate(bucket_nodes)
+        order = np.argsort(bucket_nodes, kind='stable')
+        bucket_nodes = bucket_nodes[order]
+        bucket_dist = np.concatenate(bucket_dist)[order]
+        bucket_target = np.concatenate(bucket_target)[order]
+
+        result = np.full((len(sources), len(targets)), np.inf)
+        for i, source in enumerate(sources):
+            path, dist = self.upward_search(source)
+            lo = np.searchsorted(bucket_nodes, path, side='left')
+            counts = np.searchsorted(bucket_nodes, path, side='right') - lo
+            total = counts.sum()
+            if not total:
+                continue
+            offsets = np.repeat(np.cumsum(counts) - counts, counts)
+            entries = np.arange(total) - offsets + np.repeat(lo, counts)
+            values = np.repeat(dist[path], counts) + bucket_dist[entries]
+            np.minimum.at(result[i], bucket_target[entries], values)
+        return result
+
+
+def main():
+    G = load_or_build_network(graph_file)
+    logging.info(f"Road graph loaded: {G}")
+
+    started = time.perf_counter()
+    hierarchy = ContractionHierarchy.build(G)
+    logging.info(
+        f"Preprocessing took {time.perf_counter() - started:.1f}s: "
+        f"{len(hierarchy.arc_head)} arcs, {len(hierarchy.tri_uw)} triangles")
+
+    started = time.perf_counter()
+    metric = hierarchy.customize(hierarchy.edge_weights(G, 'weight'))
+    logging.info(f"Customization took {time.perf_counter() - started:.2f}s")
+
+    rng = np.random.default_rng(0)
+    pairs = rng.integers(0, hierarchy.node_count, size=(100, 2))
+    started = time.perf_counter()
+    for source, target in pairs:
+        metric.distance(source, target)
+    logging.info(
+        f"Mean one-to-one query: "
+        f"{(time.perf_counter() - started) * 10:.3f}ms")
+
+    hierarchy.save(hierarchy_file)
+    logging.info(f"Contraction hierarchy saved to {hierarchy_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 from neo4j import GraphDatabase
+from neo4j_backend import find_nearest_node, find_shortest_path
+from route_geometry import reduce_to
 import os
 
 # Load environment variables
@@ -6,36 +8,26 @@ uri = os.getenv('NEO4J_URI', 'neo4j://localhost:7687')
 neo4j_user = os.getenv('NEO4J_USER', 'neo4j')
 neo4j_password = os.getenv('NEO4J_PASSWORD', '12Wuw4Bbi8')
 
-# Neo4j connection settings
-driver = GraphDatabase.driver(uri, auth=(neo4j_user, neo4j_password))
+# Neo4j connection, opened on first use
+driver = None
 
+# Google Maps URLs accept at most 9 intermediate waypoints
+MAX_WAYPOINTS = 9
 
-def find_nearest_node(driver, latitude, longitude):
-    with driver.session() as session:
-        result = session.run(
-            "WITH point({latitude: $latitude, longitude: $longitude}) AS inputPoint "
-            "MATCH (n:Node) "
-            "RETURN n.id AS nodeId, point.distance(point({latitude: n.latitude, longitude: n.longitude}), inputPoint) AS dist "
-            "ORDER BY dist "
-            "LIMIT 1",
-            latitude=latitude, longitude=longitude)
-        return result.single()[0]
 
-
-def find_shortest_path(driver, start_id, end_id):
-    with driver.session() as session:
-        result = session.run(
-            "MATCH (start:Node {id: $start_id}), (end:Node {id: $end_id}) "
-            "MATCH path = shortestPath((start)-[:CONNECTS*]-(end)) "
-            "RETURN [node in nodes(path) | node.id] AS nodeIds",
-            start_id=start_id, end_id=end_id)
-        return result.single()[0]
+def get_driver():
+    global driver
+    if driver is None:
+        driver = GraphDatabase.driver(uri, auth=(neo4j_user, neo4j_password))
+    return driver
 
 
 def generate_google_maps_navigation_link(path):
     if not path or len(path) < 2:
         return None
 
+    # Keep the waypoints that best preserve the shape of the route
+    path = reduce_to(path, MAX_WAYPOINTS + 2)
     start_point = path[0]
     end_point = path[-1]
     waypoints = path[1:-1]
@@ -43,13 +35,14 @@ def generate_google_maps_navigation_link(path):
     base_url = "https://www.google.com/maps/dir/?api=1"
     origin_param = f"origin={start_point[1]},{start_point[0]}"
     destination_param = f"destination={end_point[1]},{end_point[0]}"
-    waypoints_param = "&waypoints=" + '|'.join([f"{lat},{lng}" for lng, lat in waypoints])
+    waypoints_param = "waypoints=" + '|'.join([f"{lat},{lng}" for lng, lat in waypoints])
 
     url = f"{base_url}&{origin_param}&{destination_param}&{waypoints_param}&travelmode=driving"
     return url
 
 
-if __name__ == "__main__":
+def main():
+    driver = get_driver()
     start_latitude = 8.776387
     start_longitude = 53.098774
     end_latitude = 8.782535
@@ -67,3 +60,7 @@ if __name__ == "__main__":
             print("Google Maps Navigation Link:", google_maps_link)
         else:
             print("Error: Unable to generate Google Maps link.")
+
+
+if __name__ == "__main__":
+    main()
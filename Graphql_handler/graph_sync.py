@@ -0,0 +1,142 @@
+import logging
+import select
+import time
+import os
+from neo4j import GraphDatabase
+from algorithm import connect_to_database, level_factor
+from neo4j_backend import drop_projection, ensure_schema
+from metrics import GRAPH_SYNC_LAG_SECONDS, QUERY_SECONDS, start_metrics_server
+
+# Keeps the CONNECTS relationships in Neo4j in step with "highway-bremen".
+#
+# handler.py stamps every air_quality_level change with a new levels_version.
+# This process reads the rows above the last synced version, rewrites the
+# exposure of their relationships (matched through the r.gid index) in
+# batches and stores the new version in a SyncState node in the same
+# transaction. It wakes up on the levels channel and polls as a fallback.
+
+logging.basicConfig(
+    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+neo4j_uri = os.getenv('NEO4J_URI', 'neo4j://localhost:7687')
+neo4j_user = os.getenv('NEO4J_USER', 'neo4j')
+neo4j_password = os.getenv('NEO4J_PASSWORD', 'default_password')
+
+levels_channel = os.getenv('LEVELS_CHANNEL', 'highway_bremen_levels')
+sync_interval = float(os.getenv('GRAPH_SYNC_INTERVAL', '30'))  # seconds between polls
+SYNC_BATCH_SIZE = 2000  # segments per Neo4j transaction
+
+SYNCED_VERSION_QUERY = (
+    "MATCH (s:SyncState {name: 'levels'}) RETURN s.version AS version"
+)
+
+# handler.py is the only writer of levels_version and runs one transaction
+# at a time, so versions become visible in order and nothing below the
+# checkpoint can appear later
+CHANGED_ROWS_QUERY = """
+    SELECT gid, air_quality_level, levels_version
+    FROM "highway-bremen"
+    WHERE levels_version > %s
+    ORDER BY levels_version
+    LIMIT %s;
+"""
+
+SYNC_LAG_QUERY = """
+    SELECT count(*), extract(epoch FROM now() - min(levels_updated_at))
+    FROM "highway-bremen"
+    WHERE levels_version > %s;
+"""
+
+
+def update_relationships(tx, rows, version):
+    tx.run(
+        "UNWIND $rows AS row "
+        "MATCH ()-[r:CONNECTS {gid: row.gid}]->() "
+        "SET r.exposure = r.distance * row.factor, r.levels_version = row.version",
+        rows=rows)
+    tx.run(
+        "MERGE (s:SyncState {name: 'levels'}) SET s.version = $version, s.synced_at = datetime()",
+        version=version)
+
+
+def get_synced_version(driver):
+    with driver.session() as session:
+        record = session.run(SYNCED_VERSION_QUERY).single()
+    return record[0] if record is not None else 0
+
+
+def sync_lag(conn, version):
+    # Rows still to be synced and the age of the oldest of them in seconds
+    with conn.cursor() as cur:
+        cur.execute(SYNC_LAG_QUERY, (version,))
+        pending, lag = cur.fetchone()
+    conn.commit()
+    return pending, float(lag or 0)
+
+
+def sync_changes(conn, driver, version):
+    # Pushes every change above `version`; returns the new checkpoint
+    synced = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(CHANGED_ROWS_QUERY, (version, SYNC_BATCH_SIZE))
+            rows = cur.fetchall()
+        conn.commit()
+        if not rows:
+            break
+
+        version = rows[-1][2]
+        batch = [{'gid': gid, 'factor': level_factor(level), 'version': row_version}
+                 for gid, level, row_version in rows]
+        with driver.session() as session, \
+                QUERY_SECONDS.labels('neo4j', 'update_relationships').time():
+            session.write_transaction(update_relationships, batch, version)
+        synced += len(rows)
+
+    if synced:
+        # Weighted paths must not be answered from the old projection
+        drop_projection(driver)
+    return version, synced
+
+
+def wait_for_changes(listen_conn, timeout):
+    # Returns early when handler.py announces changed levels
+    if select.select([listen_conn], [], [], timeout)[0]:
+        listen_conn.poll()
+        del listen_conn.notifies[:]
+
+
+def main():
+    start_metrics_server(9104)
+    neo4j_driver = GraphDatabase.driver(neo4j_uri, auth=(neo4j_user, neo4j_password))
+    ensure_schema(neo4j_driver)
+    conn = connect_to_database()
+
+    listen_conn = connect_to_database()
+    listen_conn.set_session(autocommit=True)
+    with listen_conn.cursor() as cur:
+        cur.execute(f"LISTEN {levels_channel};")
+
+    while True:
+        try:
+            version = get_synced_version(neo4j_driver)
+            pending, lag = sync_lag(conn, version)
+            GRAPH_SYNC_LAG_SECONDS.set(lag)
+            if pending:
+                started = time.monotonic()
+                version, synced = sync_changes(conn, neo4j_driver, version)
+                logging.info(
+                    f"Synced {synced} segments up to version {version} in "
+                    f"{time.monotonic() - started:.2f}s, sync lag was {lag:.1f}s")
+                GRAPH_SYNC_LAG_SECONDS.set(0)
+            else:
+                logging.debug(f"Graph in sync at version {version}")
+        except Exception as e:
+            logging.error(f"An error occurred during graph sync: {e}")
+            conn.close()
+            conn = connect_to_database()
+        wait_for_changes(listen_conn, sync_interval)
+
+
+if __name__ == "__main__":
+    main()
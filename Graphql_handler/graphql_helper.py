@@ -1,10 +1,14 @@
+import argparse
 import logging
 import time
 import psycopg2
 import psycopg2.extras
 from neo4j import GraphDatabase
-import folium
 import os
+from neo4j_backend import ensure_projection, ensure_schema, match_pairs
+from metrics import PROCESS_SEGMENT_SECONDS, QUERY_SECONDS, SEGMENTS_PROCESSED, start_metrics_server
+from profiling import add_profile_arguments, loop_profiler
+from trajectory import filter_trajectories
 
 # Database initialization for PostgreSQL
 logging.basicConfig(
@@ -35,57 +39,62 @@ def connect_to_database(attempts=5, delay=5):
     raise Exception("Unable to connect to the database")
 
 
-pg_conn = connect_to_database()
-
-
 # Load environment variables
 uri = os.getenv('NEO4J_URI', 'neo4j://neo4j:7687')
 neo4j_user = os.getenv('NEO4J_USER', 'neo4j')
 neo4j_password = os.getenv('NEO4J_PASSWORD', 'default_password')
 
-# Neo4j connection settings
-neo4j_driver = GraphDatabase.driver(uri, auth=(neo4j_user, neo4j_password))
+# Both connections are opened on first use, not at import
+pg_conn = None
+neo4j_driver = None
+
+
+def get_pg_conn():
+    global pg_conn
+    if pg_conn is None or pg_conn.closed:
+        pg_conn = connect_to_database()
+    return pg_conn
+
 
+def get_neo4j_driver():
+    global neo4j_driver
+    if neo4j_driver is None:
+        neo4j_driver = GraphDatabase.driver(uri, auth=(neo4j_user, neo4j_password))
+    return neo4j_driver
 
-def find_nearest_node(driver, latitude, longitude):
-    with driver.session() as session:
-        result = session.run(
-            "WITH point({latitude: $latitude,longitude: $longitude}) AS inputPoint "
-            "MATCH (n:Node) "
-            "RETURN n.id AS nodeId, point.distance(point({latitude: n.latitude, longitude: n.longitude}), inputPoint) AS dist "
-            "ORDER BY dist "
-            "LIMIT 1",
-            latitude=latitude, longitude=longitude)
-        return result.single()[0]
+# Relationship weight for map matching through the GDS projection
+# ('distance' or 'exposure'); unweighted shortestPath is used without GDS
+path_weight = os.getenv('PATH_WEIGHT', 'distance')
 
 
-def find_shortest_path(driver, start_id, end_id):
-    with driver.session() as session:
-        result = session.run(
-            "MATCH (start:Node {id: $start_id}), (end:Node {id: $end_id}) "
-            "MATCH path = shortestPath((start)-[:CONNECTS*]-(end)) "
-            "RETURN [node in nodes(path) | node.id] AS nodeIds",
-            start_id=start_id, end_id=end_id)
-        return result.single()[0]
+def ensure_air_quality_columns():
+    # time_received lets handler.py measure end-to-end freshness
+    conn = get_pg_conn()
+    with conn.cursor() as cur:
+        cur.execute("ALTER TABLE air_quality ADD COLUMN IF NOT EXISTS time_received TIMESTAMPTZ;")
+    conn.commit()
 
 
+@QUERY_SECONDS.labels('postgis', 'get_data_from_postgres').time()
 def get_data_from_postgres():
-    with pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        cur.execute("SELECT * FROM raw_data_2 ORDER BY time_received;")
+    with get_pg_conn().cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute("SELECT * FROM raw_data_2 ORDER BY time_received, id;")
         return cur.fetchall()
 
 
+@QUERY_SECONDS.labels('postgis', 'update_air_quality_table').time()
 def update_air_quality_table(data):
-    with pg_conn.cursor() as cur:
+    conn = get_pg_conn()
+    with conn.cursor() as cur:
         psycopg2.extras.execute_batch(cur, """
             INSERT INTO air_quality (co_level,
                                       pm25_level,
                                       no2_level,
                                       nh3_level,
                                       longitude,
-                                      latitude, geom)
+                                      latitude, geom, time_received)
             VALUES (%s, %s, %s, %s, %s, %s,
-            ST_SetSRID(ST_Point(%s, %s), 4326));
+            ST_SetSRID(ST_Point(%s, %s), 4326), %s);
             """, [(
                 row[2],
                 row[3],
@@ -94,33 +103,40 @@ def update_air_quality_table(data):
                 row[0],
                 row[1],
                 row[0],
-                row[1]) for row in data])
-    pg_conn.commit()
+                row[1],
+                row[6]) for row in data])
+    conn.commit()
 
 
-def process_data(raw_data):
+def process_data(raw_data, weight=None):
+    started = time.perf_counter()
     processed_data = []
     number_of_rows_to_leave = len(raw_data) % 6  # Calculate how many rows to leave unprocessed
     rows_to_process = len(raw_data) - number_of_rows_to_leave
 
+    segments = []
+    pairs = []
     for i in range(0, rows_to_process, 6):
         segment = raw_data[i:i + 6]
         if len(segment) < 6 or i + 6 >= len(raw_data):
             break
 
         next_point = raw_data[i + 6]
+        if next_point['device_id'] != segment[0]['device_id']:
+            continue  # the track of another bike
 
         # Get interpolated points
         start_point = (segment[0]['longitude'], segment[0]['latitude'])
         end_point = (next_point['longitude'], next_point['latitude'])
 
-        start_node_id = find_nearest_node(
-            neo4j_driver, start_point[1], start_point[0])
-        end_node_id = find_nearest_node(
-            neo4j_driver, end_point[1], end_point[0])
+        segments.append(segment)
+        pairs.append(((start_point[1], start_point[0]), (end_point[1], end_point[0])))
+
+    # Snap and match every segment in a single round trip
+    paths = match_pairs(get_neo4j_driver(), pairs, weight)
 
-        interpolated_points = find_shortest_path(
-            neo4j_driver, start_node_id, end_node_id)
+    for index, segment in enumerate(segments):
+        interpolated_points = paths.get(index)
         if not interpolated_points:
             continue
 
@@ -142,6 +158,9 @@ def process_data(raw_data):
                 row['time_received']
             ))
 
+    if segments:
+        PROCESS_SEGMENT_SECONDS.observe((time.perf_counter() - started) / len(segments))
+        SEGMENTS_PROCESSED.inc(len(segments))
     return processed_data
 
 
@@ -149,6 +168,7 @@ def visualize_path(data, filename='path_map.html'):
     if not data:
         print("No data to visualize.")
         return
+    import folium
 
     # Create a map centered on the first point
     folium_map = folium.Map(location=[data[0][1], data[0][0]], zoom_start=14)
@@ -165,38 +185,67 @@ def visualize_path(data, filename='path_map.html'):
     print(f"Map saved as {filename}")
 
 
+@QUERY_SECONDS.labels('postgis', 'remove_processed_data').time()
 def remove_processed_data(ids):
-    with pg_conn.cursor() as cur:
+    conn = get_pg_conn()
+    with conn.cursor() as cur:
         cur.execute("DELETE FROM raw_data_2 WHERE id = ANY(%s);", (ids,))
-    pg_conn.commit()
+    conn.commit()
+
+
+def newest_fixes(rows):
+    # device_id -> time_received of its newest fix
+    newest = {}
+    for row in rows:
+        if row['time_received'] is not None:
+            newest[row['device_id']] = max(newest.get(row['device_id'], row['time_received']), row['time_received'])
+    return newest
+
+
+def run_cycle():
+    raw_data = get_data_from_postgres()
+    total_rows = len(raw_data)
+    if total_rows >= 7:  # Check for at least 7 rows
+        # Calculate the number of complete sets
+        number_of_complete_sets = (total_rows - 1) // 6
+
+        # Process and delete only complete sets, leaving the last set
+        rows_to_process = number_of_complete_sets * 6
+        weight = path_weight if ensure_projection(get_neo4j_driver()) else None
+        # Rows of outlying fixes are dropped and the rest smoothed, per device
+        filtered_data = filter_trajectories(raw_data[:rows_to_process])
+        processed_data = process_data(filtered_data, weight)
+        visualize_path(processed_data)
+        update_air_quality_table(processed_data)
+
+        # Collect IDs of processed rows. The newest fix of every device has
+        # not been paired yet, so it stays for the next cycle to pair with
+        # the device's following uplink.
+        newest = newest_fixes(raw_data[:rows_to_process])
+        processed_ids = [
+            row['id'] for row in raw_data[:rows_to_process]
+            if row['time_received'] is None or row['time_received'] != newest[row['device_id']]]
+        remove_processed_data(processed_ids)
+    else:
+        logging.info("Not enough data to process.")
 
 
 def main():
-    while True:
+    parser = argparse.ArgumentParser(description="Match raw readings onto the road graph")
+    add_profile_arguments(parser)
+    profiler = loop_profiler('graphql_helper', parser.parse_args())
+
+    start_metrics_server(9102)
+    ensure_schema(get_neo4j_driver())
+    ensure_air_quality_columns()
+    while not profiler.done:
         try:
-            raw_data = get_data_from_postgres()
-            total_rows = len(raw_data)
-            if total_rows >= 7:  # Check for at least 7 rows
-                # Calculate the number of complete sets
-                number_of_complete_sets = (total_rows - 1) // 6
-
-                # Process and delete only complete sets, leaving the last set
-                rows_to_process = number_of_complete_sets * 6
-                processed_data = process_data(raw_data[:rows_to_process])
-                visualize_path(processed_data)
-                update_air_quality_table(processed_data)
-
-                # Collect IDs of processed rows
-                processed_ids = [
-                    row['id'] for row in raw_data[:rows_to_process]]
-                remove_processed_data(processed_ids)
-            else:
-                logging.info("Not enough data to process.")
-
-            time.sleep(60)  # Wait for 1 minute
+            with profiler.cycle():
+                run_cycle()
         except Exception as e:
             logging.error(f"An error occurred: {e}")
-            time.sleep(60)  # Wait before retrying
+        if not profiler.done:
+            time.sleep(60)  # Wait for 1 minute
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+import heapq
+import math
+import os
+
+import numpy as np
+
+from algorithm import MIN_LEVEL, level_factor, unknown_level
+
+# Time-dependent clean-air routing.
+#
+# handler.py keeps, in highway_bremen_hourly_levels, the level of every
+# segment for each UTC hour of the day, from the readings of the last few
+# weeks. HourlyLevels stores them as a (edges, 24) uint8 array in the edge
+# order of the road graph, with 0 where a segment had no readings in that
+# hour. Those hours fall back to the segment's current level. For the
+# search, identical rows are shared: each edge points to one distinct
+# 24-hour row of level factors.
+#
+# route() is an A* search on exposure. An edge costs its length times the
+# level factor of the hour in which the rider reaches it, riding at
+# ride_speed_kmh from the departure time. The time at an edge is that of the
+# best path found to its start. Hours are long compared to a ride across
+# town, so this only differs from an exact time-dependent search on paths
+# within minutes of an hour boundary.
+
+ride_speed_kmh = float(os.getenv('RIDE_SPEED_KMH', '15'))
+HOURS = 24
+
+
+class HourlyLevels:
+    def __init__(self, graph, nodes, node_index, rows):
+        # rows: (gid, hour, air_quality_level) from highway_bremen_hourly_levels
+        edges = list(graph.edges(data=True))
+        edge_ids_by_gid = {}
+        for i, (_, _, data) in enumerate(edges):
+            edge_ids_by_gid.setdefault(data.get('gid'), []).append(i)
+        self.levels = np.zeros((len(edges), HOURS), dtype=np.uint8)
+        for gid, hour, level in rows:
+            for i in edge_ids_by_gid.get(gid, ()):
+                self.levels[i, hour] = level
+        self.segments = sum(1 for gid in {row[0] for row in rows} if gid in edge_ids_by_gid)
+
+        # Distinct rows as tuples of factors, None for hours without data
+        distinct, row_of_edge = np.unique(self.levels, axis=0, return_inverse=True)
+        self.factor_rows = [tuple(level_factor(int(level)) if level else None for level in row)
+                            for row in distinct]
+        row_of_edge = row_of_edge.reshape(-1).tolist()
+
+        # Adjacency lists of (neighbour index, factor row, edge data); the
+        # data dicts are shared with the graph, so level updates apply here
+        self.nodes = nodes
+        self.node_index = node_index
+        self.node_coords = np.array(nodes, dtype=float)
+        self.adjacency = [[] for _ in nodes]
+        for i, (u, v, data) in enumerate(edges):
+            row = self.factor_rows[row_of_edge[i]]
+            a, b = node_index[u], node_index[v]
+            self.adjacency[a].append((b, row, data))
+            self.adjacency[b].append((a, row, data))
+        # No edge costs less than its length times this
+        self.min_factor = min(MIN_LEVEL, unknown_level)
+
+    def route(self, start_node, end_node, departure, lower_bound_km):
+        # departure: seconds since midnight UTC. Returns (route, exposure, gids).
+        source = self.node_index[start_node]
+        target = self.node_index[end_node]
+        estimate = (self.min_factor * lower_bound_km(
+            self.node_coords, self.node_coords[target])).tolist()
+        seconds_per_km = 3600 / ride_speed_kmh
+
+        best = {source: 0.0}
+        ridden = {source: 0.0}
+        previous = {}
+        heap = [(estimate[source], 0.0, source)]
+        while heap:
+            _, cost, u = heapq.heappop(heap)
+            if u == target:
+                break
+            if cost > best[u]:
+                continue
+            km = ridden[u]
+            hour = int((departure + km * seconds_per_km) // 3600) % HOURS
+            for v, row, data in self.adjacency[u]:
+                factor = row[hour]
+                new_cost = cost + (data['exposure'] if factor is None else data['weight'] * factor)
+                if new_cost < best.get(v, math.inf):
+                    best[v] = new_cost
+                    ridden[v] = km + data['weight']
+                    previous[v] = (u, data)
+                    heapq.heappush(heap, (new_cost + estimate[v], new_cost, v))
+        if target not in best:
+            return [], None, []
+
+        indices, gids = [target], []
+        while indices[-1] != source:
+            u, data = previous[indices[-1]]
+            indices.append(u)
+            gids.append(data.get('gid'))
+        return [self.nodes[i] for i in reversed(indices)], best[target], gids[::-1]
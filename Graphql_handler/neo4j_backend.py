@@ -0,0 +1,248 @@
+import logging
+import os
+
+from neo4j.exceptions import ClientError
+from metrics import QUERY_SECONDS
+
+# Cypher queries shared by the Neo4j based services and scripts.
+#
+# Nodes have a compact integer `id` (assigned by algorithm.py on export) and a
+# native `location` point with a point index, so nearest-node lookups only
+# scan the nodes inside a small bounding box around the input coordinate.
+# Paths are returned as [latitude, longitude] property pairs, i.e. the
+# coordinate tuples the road graph is built from. Nodes also carry the
+# `component` algorithm.py labelled them with: endpoints are only snapped
+# to nodes of one component, so a path search never fails after scanning
+# everything reachable from the start.
+
+# Half-size of the search box in degrees, and how often it may be widened
+nearest_node_radius = float(os.getenv('NEAREST_NODE_RADIUS', '0.005'))
+NEAREST_NODE_ATTEMPTS = 3
+NEAREST_NODE_GROWTH = 4
+
+# Named GDS projection with distance and exposure relationship weights
+projection_name = os.getenv('GDS_GRAPH_NAME', 'roads')
+
+SCHEMA_QUERIES = [
+    "CREATE CONSTRAINT node_id IF NOT EXISTS FOR (n:Node) REQUIRE n.id IS UNIQUE",
+    "CREATE POINT INDEX node_location IF NOT EXISTS FOR (n:Node) ON (n.location)",
+    "CREATE INDEX connects_gid IF NOT EXISTS FOR ()-[r:CONNECTS]-() ON (r.gid)",
+]
+
+# Backfills nodes written before the location property existed
+LOCATION_BACKFILL_QUERY = (
+    "MATCH (n:Node) WHERE n.location IS NULL "
+    "SET n.location = point({latitude: n.latitude, longitude: n.longitude})"
+)
+
+CLEAR_GRAPH_QUERY = (
+    "MATCH (n:Node) "
+    "CALL { WITH n DETACH DELETE n } IN TRANSACTIONS OF 10000 ROWS"
+)
+
+NEAREST_NODE_QUERY = (
+    "WITH point({latitude: $latitude, longitude: $longitude}) AS inputPoint "
+    "MATCH (n:Node) "
+    "WHERE point.withinBBox(n.location, "
+    "  point({latitude: $latitude - $radius, longitude: $longitude - $radius}), "
+    "  point({latitude: $latitude + $radius, longitude: $longitude + $radius})) "
+    "  AND coalesce(n.component, 0) = $component "
+    "RETURN n.id AS nodeId, point.distance(n.location, inputPoint) AS dist "
+    "ORDER BY dist "
+    "LIMIT 1"
+)
+
+SHORTEST_PATH_QUERY = (
+    "MATCH (start:Node {id: $start_id}), (end:Node {id: $end_id}) "
+    "MATCH path = shortestPath((start)-[:CONNECTS*0..]-(end)) "
+    "RETURN [node in nodes(path) | [node.latitude, node.longitude]] AS path"
+)
+
+PROJECTION_EXISTS_QUERY = "CALL gds.graph.exists($name) YIELD exists RETURN exists"
+
+PROJECT_QUERY = (
+    "CALL gds.graph.project($name, "
+    "  {Node: {properties: ['latitude', 'longitude']}}, "
+    "  {CONNECTS: {orientation: 'UNDIRECTED', properties: ['distance', 'exposure']}}) "
+    "YIELD nodeCount, relationshipCount "
+    "RETURN nodeCount, relationshipCount"
+)
+
+DROP_PROJECTION_QUERY = (
+    "CALL gds.graph.drop($name, false) YIELD graphName RETURN graphName"
+)
+
+# GDS stream procedures against the cached projection. A* estimates the
+# remaining cost as the haversine distance in nautical miles between the
+# latitude/longitude node properties, which stays below both the km
+# `distance` and the (level-scaled) `exposure` weights.
+PATH_PROCEDURES = {
+    'dijkstra': (
+        "gds.shortestPath.dijkstra.stream($graph, {"
+        "sourceNode: start, targetNode: end, relationshipWeightProperty: $weight})"),
+    'astar': (
+        "gds.shortestPath.astar.stream($graph, {"
+        "sourceNode: start, targetNode: end, relationshipWeightProperty: $weight, "
+        "latitudeProperty: 'latitude', longitudeProperty: 'longitude'})"),
+}
+
+WEIGHTED_PATH_QUERY = (
+    "MATCH (start:Node {{id: $start_id}}), (end:Node {{id: $end_id}}) "
+    "CALL {procedure} "
+    "YIELD totalCost, nodeIds "
+    "RETURN [nodeId IN nodeIds | [gds.util.asNode(nodeId).latitude, "
+    "gds.util.asNode(nodeId).longitude]] AS path, totalCost"
+)
+
+# Snaps both endpoints of every pair, the end to the component of the start;
+# followed by one of the path tails below. Pairs with an endpoint outside
+# the search box are missing from the result.
+SNAP_PAIRS_QUERY = (
+    "UNWIND $pairs AS pair "
+    "CALL { "
+    "  WITH pair "
+    "  MATCH (n:Node) "
+    "  WHERE point.withinBBox(n.location, "
+    "    point({latitude: pair.start_lat - $radius, longitude: pair.start_lon - $radius}), "
+    "    point({latitude: pair.start_lat + $radius, longitude: pair.start_lon + $radius})) "
+    "  RETURN n AS start "
+    "  ORDER BY point.distance(n.location, point({latitude: pair.start_lat, longitude: pair.start_lon})) "
+    "  LIMIT 1 "
+    "} "
+    "CALL { "
+    "  WITH pair, start "
+    "  MATCH (n:Node) "
+    "  WHERE point.withinBBox(n.location, "
+    "    point({latitude: pair.end_lat - $radius, longitude: pair.end_lon - $radius}), "
+    "    point({latitude: pair.end_lat + $radius, longitude: pair.end_lon + $radius})) "
+    "    AND coalesce(n.component, 0) = coalesce(start.component, 0) "
+    "  RETURN n AS end "
+    "  ORDER BY point.distance(n.location, point({latitude: pair.end_lat, longitude: pair.end_lon})) "
+    "  LIMIT 1 "
+    "} "
+)
+
+MATCH_PAIRS_QUERY = SNAP_PAIRS_QUERY + (
+    "OPTIONAL MATCH path = shortestPath((start)-[:CONNECTS*0..]-(end)) "
+    "RETURN pair.i AS i, [node in nodes(path) | [node.latitude, node.longitude]] AS path"
+)
+
+MATCH_PAIRS_WEIGHTED_QUERY = SNAP_PAIRS_QUERY + (
+    "CALL " + PATH_PROCEDURES['dijkstra'] + " "
+    "YIELD nodeIds "
+    "RETURN pair.i AS i, [nodeId IN nodeIds | [gds.util.asNode(nodeId).latitude, "
+    "gds.util.asNode(nodeId).longitude]] AS path"
+)
+
+
+def ensure_schema(driver):
+    with driver.session() as session:
+        for query in SCHEMA_QUERIES:
+            session.run(query)
+        session.run(LOCATION_BACKFILL_QUERY)
+
+
+def clear_graph(driver):
+    with driver.session() as session:
+        session.run(CLEAR_GRAPH_QUERY)
+        # A fresh export has to be brought up to date by graph_sync.py again
+        session.run("MATCH (s:SyncState) DELETE s")
+
+
+@QUERY_SECONDS.labels('neo4j', 'ensure_projection').time()
+def ensure_projection(driver):
+    # Projects the road graph once; later queries reuse it until it is dropped.
+    # Returns False if the GDS plugin is not available.
+    try:
+        with driver.session() as session:
+            if not session.run(PROJECTION_EXISTS_QUERY, name=projection_name).single()[0]:
+                counts = session.run(PROJECT_QUERY, name=projection_name).single()
+                logging.info(
+                    f"Projected GDS graph '{projection_name}': "
+                    f"{counts[0]} nodes, {counts[1]} relationships")
+        return True
+    except ClientError as e:
+        logging.warning(f"GDS projection unavailable: {e}")
+        return False
+
+
+def drop_projection(driver):
+    try:
+        with driver.session() as session:
+            session.run(DROP_PROJECTION_QUERY, name=projection_name)
+    except ClientError as e:
+        logging.warning(f"Could not drop GDS projection: {e}")
+
+
+@QUERY_SECONDS.labels('neo4j', 'find_nearest_node').time()
+def find_nearest_node(driver, latitude, longitude, component=0):
+    # Widen the search box until it contains a node of the component
+    # (0 is the routable core)
+    radius = nearest_node_radius
+    with driver.session() as session:
+        for _ in range(NEAREST_NODE_ATTEMPTS):
+            record = session.run(
+                NEAREST_NODE_QUERY, latitude=latitude, longitude=longitude,
+                radius=radius, component=component).single()
+            if record is not None:
+                return record[0]
+            radius *= NEAREST_NODE_GROWTH
+    return None
+
+
+@QUERY_SECONDS.labels('neo4j', 'find_shortest_path').time()
+def find_shortest_path(driver, start_id, end_id):
+    # Fewest hops, without weights
+    with driver.session() as session:
+        record = session.run(
+            SHORTEST_PATH_QUERY, start_id=start_id, end_id=end_id).single()
+        return record[0] if record is not None else None
+
+
+@QUERY_SECONDS.labels('neo4j', 'find_weighted_path').time()
+def find_weighted_path(driver, start_id, end_id, weight='distance', algorithm='dijkstra'):
+    # Returns (path, total cost) through the GDS projection
+    query = WEIGHTED_PATH_QUERY.format(procedure=PATH_PROCEDURES[algorithm])
+    with driver.session() as session:
+        record = session.run(
+            query, graph=projection_name, start_id=start_id, end_id=end_id,
+            weight=weight).single()
+    if record is None:
+        return None, None
+    return record[0], record[1]
+
+
+@QUERY_SECONDS.labels('neo4j', 'match_pairs').time()
+def match_pairs(driver, pairs, weight=None):
+    # pairs: list of ((start_lat, start_lon), (end_lat, end_lon));
+    # returns {index: path} for every pair that could be matched. With a
+    # weight the paths come from GDS Dijkstra, otherwise from shortestPath.
+    params = [{
+        'i': i,
+        'start_lat': start[0], 'start_lon': start[1],
+        'end_lat': end[0], 'end_lon': end[1]
+    } for i, (start, end) in enumerate(pairs)]
+    with driver.session() as session:
+        if weight is None:
+            result = session.run(
+                MATCH_PAIRS_QUERY, pairs=params, radius=nearest_node_radius)
+        else:
+            result = session.run(
+                MATCH_PAIRS_WEIGHTED_QUERY, pairs=params,
+                radius=nearest_node_radius, graph=projection_name, weight=weight)
+        paths = {record['i']: record['path'] for record in result}
+
+    # Endpoints without a node nearby fall back to the widening lookup,
+    # which snaps both to the routable core
+    for i, (start, end) in enumerate(pairs):
+        if i in paths:
+            continue
+        start_id = find_nearest_node(driver, *start)
+        end_id = find_nearest_node(driver, *end)
+        if start_id is None or end_id is None:
+            continue
+        if weight is None:
+            paths[i] = find_shortest_path(driver, start_id, end_id)
+        else:
+            paths[i] = find_weighted_path(driver, start_id, end_id, weight)[0]
+    return paths
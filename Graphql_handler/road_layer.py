@@ -0,0 +1,355 @@
+import glob
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+import numpy as np
+import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shapely
+
+# Reading the "highway-bremen" road layer, either straight from PostGIS or
+# from a versioned GeoParquet snapshot of it.
+#
+# Both sources yield (attribute rows, geometries) chunks, so a graph build
+# holds one chunk at a time whatever it reads from. A snapshot is tagged
+# with the row count, max gid and geometry version of the table (its
+# geometry fingerprint) and the levels_version it was taken at. If the
+# geometry still matches, only the air_quality_level of rows changed since
+# then is read from PostGIS; otherwise the whole layer is streamed from
+# PostGIS again. The geometry version is a sequence that a trigger bumps on
+# every insert, delete or truncate and every update of gid or geom, so
+# geometry edited in place is caught without reading the table.
+
+logging.basicConfig(
+    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+db_name = os.getenv('DB_NAME', 'default_db_name')
+db_user = os.getenv('DB_USER', 'default_user')
+db_password = os.getenv('DB_PASSWORD', 'default_password')
+db_host = os.getenv('DB_HOST', 'localhost')
+db_port = os.getenv('DB_PORT', '5432')
+
+road_chunk_size = int(os.getenv('ROAD_CHUNK_SIZE', '5000'))  # segments per chunk
+snapshot_dir = os.getenv('ROAD_SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_PREFIX = 'highway-bremen-v'
+SNAPSHOTS_KEPT = 2
+SNAPSHOT_ROW_GROUP_SIZE = 4096  # bbox filters skip whole row groups
+SNAPSHOT_COLUMNS = ('gid', 'air_quality_level', 'levels_version')
+
+SNAPSHOT_SCHEMA = pa.schema([
+    ('gid', pa.int64()),
+    ('air_quality_level', pa.int32()),
+    ('levels_version', pa.int64()),
+    ('bbox', pa.struct([('xmin', pa.float64()), ('ymin', pa.float64()),
+                        ('xmax', pa.float64()), ('ymax', pa.float64())])),
+    ('geom', pa.binary()),
+])
+
+LAYER_EXTENT_QUERY = """
+    SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+    FROM (SELECT ST_Extent(geom) AS extent FROM "highway-bremen") AS layer;
+"""
+
+LAYER_VERSION_QUERY = """
+    SELECT count(*), coalesce(max(gid), 0), coalesce(max(levels_version), 0),
+           (SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM highway_bremen_geometry_version)
+    FROM "highway-bremen";
+"""
+
+# Idempotent, so that this service also works on a database that
+# Postgis_handler/handler.py has not set up yet
+LAYER_VERSIONS_SETUP = """
+    CREATE SEQUENCE IF NOT EXISTS highway_bremen_levels_version;
+    ALTER TABLE "highway-bremen"
+        ADD COLUMN IF NOT EXISTS levels_version BIGINT NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS levels_updated_at TIMESTAMPTZ;
+    CREATE INDEX IF NOT EXISTS highway_bremen_levels_version_idx
+        ON "highway-bremen" (levels_version);
+    CREATE SEQUENCE IF NOT EXISTS highway_bremen_geometry_version;
+    CREATE OR REPLACE FUNCTION highway_bremen_geometry_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM nextval('highway_bremen_geometry_version');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    DROP TRIGGER IF EXISTS highway_bremen_geometry_changed ON "highway-bremen";
+    CREATE TRIGGER highway_bremen_geometry_changed
+        AFTER INSERT OR DELETE OR UPDATE OF gid, geom OR TRUNCATE ON "highway-bremen"
+        FOR EACH STATEMENT EXECUTE PROCEDURE highway_bremen_geometry_changed();
+"""
+layer_versions_ready = False
+
+
+def connect_to_database(attempts=5, delay=5):
+    while attempts > 0:
+        try:
+            conn = psycopg2.connect(
+                dbname=db_name,
+                user=db_user,
+                password=db_password,
+                host=db_host,
+                port=db_port
+            )
+            return conn
+        except psycopg2.OperationalError as e:
+            logging.error(f"Failed to connect to the database: {e}")
+            time.sleep(delay)
+            attempts -= 1
+    raise Exception("Unable to connect to the database")
+
+
+def bbox_clause(bbox):
+    if bbox is None:
+        return '', ()
+    return ' WHERE geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)', tuple(bbox)
+
+
+def stream_road_segments(conn, columns=('gid', 'air_quality_level'), chunk_size=None, bbox=None):
+    # Reads "highway-bremen" through a server-side cursor, so only one chunk
+    # of WKB and decoded geometries is held at a time
+    chunk_size = chunk_size or road_chunk_size
+    where, params = bbox_clause(bbox)
+    with conn.cursor(name='highway_bremen_stream') as cur:
+        cur.itersize = chunk_size
+        cur.execute(
+            f'SELECT {", ".join(columns)}, ST_AsBinary(geom) FROM "highway-bremen"{where};',
+            params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            wkb = np.array([None if row[-1] is None else bytes(row[-1]) for row in rows], dtype=object)
+            yield [row[:-1] for row in rows], shapely.from_wkb(wkb)
+
+
+def ensure_layer_versions(conn):
+    # Once per process; the columns, sequences and trigger are then in place
+    global layer_versions_ready
+    if layer_versions_ready:
+        return
+    with conn.cursor() as cur:
+        cur.execute(LAYER_VERSIONS_SETUP)
+    conn.commit()
+    layer_versions_ready = True
+
+
+def layer_version(conn):
+    ensure_layer_versions(conn)
+    with conn.cursor() as cur:
+        cur.execute(LAYER_VERSION_QUERY)
+        row_count, max_gid, levels_version, geometry_version = cur.fetchone()
+    conn.commit()
+    return {'row_count': row_count, 'max_gid': max_gid, 'levels_version': levels_version,
+            'geometry_version': geometry_version}
+
+
+def layer_extent(conn):
+    # (xmin, ymin, xmax, ymax) of the table, None if it is empty
+    with conn.cursor() as cur:
+        cur.execute(LAYER_EXTENT_QUERY)
+        extent = cur.fetchone()
+    conn.commit()
+    return None if extent[0] is None else tuple(extent)
+
+
+def snapshot_extent(path):
+    bbox = json.loads(pq.read_schema(path).metadata[b'geo'])['columns']['geom']['bbox']
+    return tuple(bbox) if bbox else None
+
+
+def spatial_order(bounds):
+    # Z-order of the bbox centres, so nearby segments share row groups
+    centres = (bounds[:, :2] + bounds[:, 2:]) / 2
+    low = centres.min(axis=0)
+    span = np.maximum(centres.max(axis=0) - low, 1e-12)
+    cells = ((centres - low) / span * 0xFFFF).astype(np.uint64)
+    key = np.zeros(len(cells), dtype=np.uint64)
+    for bit in range(16):
+        key |= ((cells[:, 0] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+        key |= ((cells[:, 1] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + 1)
+    return np.argsort(key, kind='stable')
+
+
+def geo_metadata(bounds, geometry_types, version):
+    return {
+        b'geo': json.dumps({
+            'version': '1.1.0',
+            'primary_column': 'geom',
+            'columns': {'geom': {
+                'encoding': 'WKB',
+                'geometry_types': geometry_types,
+                'bbox': bounds,
+                'covering': {'bbox': {
+                    'xmin': ['bbox', 'xmin'], 'ymin': ['bbox', 'ymin'],
+                    'xmax': ['bbox', 'xmax'], 'ymax': ['bbox', 'ymax']}}
+            }}
+        }).encode(),
+        b'atmos': json.dumps(version).encode()
+    }
+
+
+def write_snapshot(conn, directory=None):
+    directory = directory or snapshot_dir
+    os.makedirs(directory, exist_ok=True)
+    version = layer_version(conn)
+
+    # The table is read in chunks but sorted as a whole: the snapshot holds
+    # the WKB, which is far smaller than the decoded geometries
+    columns = {name: [] for name in SNAPSHOT_COLUMNS}
+    wkb = []
+    bounds = []
+    for rows, geoms in stream_road_segments(conn, SNAPSHOT_COLUMNS):
+        present = ~shapely.is_missing(geoms)
+        rows = [row for row, keep in zip(rows, present) if keep]
+        for name, values in zip(SNAPSHOT_COLUMNS, zip(*rows)):
+            columns[name].extend(values)
+        wkb.extend(shapely.to_wkb(geoms[present]))
+        bounds.append(shapely.bounds(geoms[present]))
+    bounds = np.concatenate(bounds) if bounds else np.empty((0, 4))
+    order = spatial_order(bounds) if len(bounds) else np.arange(0)
+
+    table = pa.Table.from_arrays([
+        pa.array(columns['gid'], pa.int64()).take(order),
+        pa.array(columns['air_quality_level'], pa.int32()).take(order),
+        pa.array(columns['levels_version'], pa.int64()).take(order),
+        pa.StructArray.from_arrays(
+            [pa.array(bounds[order, i]) for i in range(4)],
+            names=['xmin', 'ymin', 'xmax', 'ymax']),
+        pa.array(wkb, pa.binary()).take(order),
+    ], schema=SNAPSHOT_SCHEMA)
+    version['created_at'] = datetime.now(timezone.utc).isoformat()
+    table = table.replace_schema_metadata(geo_metadata(
+        np.nanmin(bounds[:, :2], axis=0).tolist() + np.nanmax(bounds[:, 2:], axis=0).tolist()
+        if len(bounds) else [], ['MultiLineString', 'LineString'], version))
+
+    path = os.path.join(directory, f"{SNAPSHOT_PREFIX}{version['levels_version']}.parquet")
+    pq.write_table(table, path + '.tmp', row_group_size=SNAPSHOT_ROW_GROUP_SIZE,
+                   compression='zstd')
+    os.replace(path + '.tmp', path)  # readers never see a partial file
+    prune_snapshots(directory)
+    logging.info(f"Wrote road snapshot {path} ({table.num_rows} segments)")
+    return path
+
+
+def list_snapshots(directory=None):
+    # Newest first
+    paths = glob.glob(os.path.join(directory or snapshot_dir, f"{SNAPSHOT_PREFIX}*.parquet"))
+    return sorted(paths, key=lambda path: int(
+        os.path.basename(path)[len(SNAPSHOT_PREFIX):-len('.parquet')]), reverse=True)
+
+
+def prune_snapshots(directory=None):
+    for path in list_snapshots(directory)[SNAPSHOTS_KEPT:]:
+        os.remove(path)
+
+
+def snapshot_version(path):
+    return json.loads(pq.read_schema(path).metadata[b'atmos'])
+
+
+def same_geometry(snapshot, current):
+    # Snapshots written before the geometry version was added count as stale
+    return ((snapshot['row_count'], snapshot['max_gid'], snapshot.get('geometry_version'))
+            == (current['row_count'], current['max_gid'], current['geometry_version']))
+
+
+def read_snapshot(path, columns=('gid', 'air_quality_level'), bbox=None, chunk_size=None, levels=None):
+    # Yields the same chunks as stream_road_segments, reading only the
+    # requested columns and the row groups that can intersect bbox. levels
+    # overrides air_quality_level for the gids it contains.
+    dataset = ds.dataset(path, format='parquet')
+    expression = None
+    if bbox is not None:
+        xmin, ymin, xmax, ymax = bbox
+        expression = ((pc.field('bbox', 'xmax') >= xmin) & (pc.field('bbox', 'xmin') <= xmax)
+                      & (pc.field('bbox', 'ymax') >= ymin) & (pc.field('bbox', 'ymin') <= ymax))
+    read_columns = list(dict.fromkeys(list(columns) + (['gid'] if levels else []) + ['geom']))
+    for batch in dataset.to_batches(columns=read_columns, filter=expression,
+                                    batch_size=chunk_size or road_chunk_size):
+        if batch.num_rows == 0:
+            continue
+        values = {name: batch.column(name).to_pylist() for name in read_columns[:-1]}
+        if levels and 'air_quality_level' in values:
+            values['air_quality_level'] = [
+                levels.get(gid, level)
+                for gid, level in zip(values['gid'], values['air_quality_level'])]
+        geoms = shapely.from_wkb(batch.column('geom').to_numpy(zero_copy_only=False))
+        yield list(zip(*(values[name] for name in columns))), geoms
+
+
+def changed_levels(conn, since):
+    with conn.cursor() as cur:
+        cur.execute(
+            'SELECT gid, air_quality_level FROM "highway-bremen" WHERE levels_version > %s;',
+            (since,))
+        levels = dict(cur.fetchall())
+    conn.commit()
+    return levels
+
+
+def road_source(conn, columns=('gid', 'air_quality_level'), directory=None):
+    # (read, extent) of the snapshot if its geometry is current, of PostGIS
+    # otherwise; read(bbox) yields the chunks of the segments whose bbox
+    # intersects bbox (all of them for None), and can be called repeatedly.
+    # conn may be None when the database is unreachable; the newest
+    # snapshot is then used as it is.
+    def from_postgis():
+        return (lambda bbox=None: stream_road_segments(conn, columns, bbox=bbox)), layer_extent(conn)
+
+    def from_snapshot(path, levels=None):
+        return (lambda bbox=None: read_snapshot(path, columns, bbox, levels=levels)), snapshot_extent(path)
+
+    snapshots = list_snapshots(directory)
+    if not snapshots:
+        logging.info("No road snapshot found, reading from PostGIS")
+        return from_postgis()
+
+    path = snapshots[0]
+    snapshot = snapshot_version(path)
+    if conn is None:
+        logging.warning(f"Database unavailable, using road snapshot {path} without level updates")
+        return from_snapshot(path)
+
+    current = layer_version(conn)
+    if not same_geometry(snapshot, current):
+        logging.info(f"Road snapshot {path} is stale, reading from PostGIS")
+        return from_postgis()
+
+    levels = None
+    if current['levels_version'] > snapshot['levels_version']:
+        levels = changed_levels(conn, snapshot['levels_version'])
+    logging.info(f"Using road snapshot {path} with {len(levels or ())} updated levels")
+    return from_snapshot(path, levels)
+
+
+def road_segments(conn, columns=('gid', 'air_quality_level'), bbox=None, directory=None):
+    read, _ = road_source(conn, columns, directory)
+    return read(bbox)
+
+
+def main():
+    # Writes a new snapshot unless the newest one is current
+    conn = connect_to_database()
+    try:
+        snapshots = list_snapshots()
+        if snapshots:
+            snapshot = snapshot_version(snapshots[0])
+            current = layer_version(conn)
+        if (snapshots and same_geometry(snapshot, current)
+                and snapshot['levels_version'] == current['levels_version']):
+            logging.info(f"Road snapshot {snapshots[0]} is current")
+            return
+        started = time.monotonic()
+        write_snapshot(conn)
+        logging.info(f"Snapshot export took {time.monotonic() - started:.1f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
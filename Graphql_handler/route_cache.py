@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict, namedtuple
+from metrics import (ROUTE_CACHE_ENTRIES, ROUTE_CACHE_EVICTIONS, ROUTE_CACHE_INVALIDATIONS,
+                     ROUTE_CACHE_LOOKUPS)
+
+CachedRoute = namedtuple('CachedRoute', ['route', 'cost', 'gids'])
+
+
+class RouteCache:
+    # LRU cache of computed routes, keyed by
+    # (start node, end node, cost profile, graph fingerprint), followed by
+    # the departure slot for time-dependent routes. The counts are also
+    # exported as atmos_route_cache_* metrics.
+    # Entries are indexed by the segment gids they traverse so that a level
+    # change only drops the routes it can actually affect.
+
+    def __init__(self, max_entries=10000, max_nodes=2000000):
+        self.max_entries = max_entries
+        self.max_nodes = max_nodes
+        self.entries = OrderedDict()
+        self.keys_by_gid = {}
+        self.node_count = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                ROUTE_CACHE_LOOKUPS.labels('miss').inc()
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            ROUTE_CACHE_LOOKUPS.labels('hit').inc()
+            return entry
+
+    def put(self, key, route, cost, gids, generation):
+        with self.lock:
+            # Results computed while an invalidation ran may be stale
+            if generation != self.generation or len(route) > self.max_nodes:
+                return False
+            if key in self.entries:
+                self._remove(key)
+
+            gids = frozenset(gid for gid in gids if gid is not None)
+            self.entries[key] = CachedRoute(route, cost, gids)
+            self.node_count += len(route)
+            for gid in gids:
+                self.keys_by_gid.setdefault(gid, set()).add(key)
+
+            while (len(self.entries) > self.max_entries
+                   or self.node_count > self.max_nodes):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+                ROUTE_CACHE_EVICTIONS.inc()
+            ROUTE_CACHE_ENTRIES.set(len(self.entries))
+            return True
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.node_count -= len(entry.route)
+        for gid in entry.gids:
+            keys = self.keys_by_gid.get(gid)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_gid[gid]
+
+    def invalidate(self, gids, profiles):
+        # Drop entries of the given profiles that traverse any of the gids
+        with self.lock:
+            self.generation += 1
+            keys = set()
+            for gid in gids:
+                keys.update(self.keys_by_gid.get(gid, ()))
+            keys = [key for key in keys if key[2] in profiles]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            ROUTE_CACHE_INVALIDATIONS.inc(len(keys))
+            ROUTE_CACHE_ENTRIES.set(len(self.entries))
+            return len(keys)
+
+    def invalidate_where(self, predicate, profiles):
+        # Drop entries of the given profiles for which predicate(key, entry) holds
+        with self.lock:
+            self.generation += 1
+            keys = [key for key, entry in self.entries.items()
+                    if key[2] in profiles and predicate(key, entry)]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            ROUTE_CACHE_INVALIDATIONS.inc(len(keys))
+            ROUTE_CACHE_ENTRIES.set(len(self.entries))
+            return len(keys)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'nodes': self.node_count,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
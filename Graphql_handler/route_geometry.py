@@ -0,0 +1,118 @@
+import heapq
+import os
+import numpy as np
+
+# Output stage for route geometries: Douglas-Peucker simplification in
+# metres, a point-budget variant for navigation waypoints, and Google's
+# encoded polyline format for compact API responses.
+#
+# Coordinates are (longitude, latitude) pairs like the graph nodes.
+
+simplify_tolerance = float(os.getenv('ROUTE_SIMPLIFY_METERS', '5'))
+POLYLINE_PRECISION = 5
+METERS_PER_DEGREE = 111320.0
+
+
+def to_meters(coords):
+    # Local equirectangular projection, accurate to well under a metre over
+    # the extent of a city route
+    coords = np.asarray(coords, dtype=float)
+    scale = np.cos(np.radians(coords[:, 1].mean()))
+    return np.column_stack((coords[:, 0] * scale, coords[:, 1])) * METERS_PER_DEGREE
+
+
+def max_deviation(points, start, end):
+    # Index and distance of the point between start and end that lies
+    # furthest from the chord start-end
+    inner = points[start + 1:end]
+    chord = points[end] - points[start]
+    offset = inner - points[start]
+    length = np.hypot(chord[0], chord[1])
+    if length == 0:
+        distances = np.hypot(offset[:, 0], offset[:, 1])
+    else:
+        distances = np.abs(chord[0] * offset[:, 1] - chord[1] * offset[:, 0]) / length
+    i = int(np.argmax(distances))
+    return start + 1 + i, distances[i]
+
+
+def simplify_indices(coords, tolerance=None):
+    # Douglas-Peucker; returns the sorted indices of the vertices to keep
+    tolerance = simplify_tolerance if tolerance is None else tolerance
+    n = len(coords)
+    if n < 3 or tolerance <= 0:
+        return np.arange(n)
+    points = to_meters(coords)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        index, distance = max_deviation(points, start, end)
+        if distance > tolerance:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return np.flatnonzero(keep)
+
+
+def simplify(coords, tolerance=None):
+    return [coords[i] for i in simplify_indices(coords, tolerance)]
+
+
+def reduce_to(coords, count):
+    # Douglas-Peucker with a point budget: always splits the span with the
+    # largest deviation next, so the `count` kept vertices are the ones
+    # that matter most for the shape of the route
+    n = len(coords)
+    if n <= count:
+        return list(coords)
+    points = to_meters(coords)
+    kept = [0, n - 1]
+    heap = []
+
+    def push(start, end):
+        if end - start >= 2:
+            index, distance = max_deviation(points, start, end)
+            heapq.heappush(heap, (-distance, start, end, index))
+
+    push(0, n - 1)
+    while heap and len(kept) < count:
+        _, start, end, index = heapq.heappop(heap)
+        kept.append(index)
+        push(start, index)
+        push(index, end)
+    return [coords[i] for i in sorted(kept)]
+
+
+def encode_polyline(coords, precision=POLYLINE_PRECISION):
+    # Google encoded polyline of (lon, lat) pairs; the format stores lat first
+    if len(coords) == 0:
+        return ''
+    values = np.round(np.asarray(coords, dtype=float)[:, ::-1] * 10 ** precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=[[0, 0]]).ravel()
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    chars = []
+    for value in zigzag.tolist():
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return ''.join(chars)
+
+
+def decode_polyline(encoded, precision=POLYLINE_PRECISION):
+    # Inverse of encode_polyline; returns (lon, lat) pairs
+    values = []
+    value = shift = 0
+    for char in encoded:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    latlng = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** precision
+    return [(lng, lat) for lat, lng in latlng.tolist()]
@@ -0,0 +1,134 @@
+import multiprocessing
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+matrix_workers = int(os.getenv('MATRIX_WORKERS', str(os.cpu_count() or 1)))
+MATRIX_CHUNK_SIZE = 64  # sources per Dijkstra task, bounds the (k, n) buffer
+ATTACHED_GRAPHS = 4  # shared graphs a worker keeps mapped, one per profile in use
+
+# The cost graphs are copied into shared memory once and the Dijkstra tasks
+# only carry its name and their sources. The workers are started by a
+# forkserver, since forking the threaded route service could copy a lock
+# that another thread holds.
+_pool = None
+_shared = {}  # id(csgraph) -> spec of its shared copy, while csgraph is alive
+_attached = {}  # in a worker: name -> (shared memory, csgraph), oldest first
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        _pool = ProcessPoolExecutor(max_workers=matrix_workers, mp_context=context)
+    return _pool
+
+
+def release_shared(key, shm):
+    _shared.pop(key, None)
+    shm.close()
+    shm.unlink()
+
+
+def share_csgraph(csgraph):
+    # (name, shape, layout) of a shared copy of csgraph's CSR arrays; the
+    # copy is removed once csgraph is garbage collected
+    spec = _shared.get(id(csgraph))
+    if spec is None:
+        arrays = (csgraph.data, csgraph.indices, csgraph.indptr)
+        shm = shared_memory.SharedMemory(create=True, size=max(sum(a.nbytes for a in arrays), 1))
+        layout, offset = [], 0
+        for array in arrays:
+            np.ndarray(array.shape, array.dtype, buffer=shm.buf, offset=offset)[:] = array
+            layout.append((array.dtype.str, len(array), offset))
+            offset += array.nbytes
+        spec = (shm.name, csgraph.shape, tuple(layout))
+        _shared[id(csgraph)] = spec
+        weakref.finalize(csgraph, release_shared, id(csgraph), shm)
+    return spec
+
+
+def attached_csgraph(spec):
+    # Runs in a worker process; maps a shared graph on its first task
+    name, shape, layout = spec
+    entry = _attached.pop(name, None)
+    if entry is None:
+        shm = shared_memory.SharedMemory(name=name)
+        data, indices, indptr = (np.ndarray((length,), dtype, buffer=shm.buf, offset=offset)
+                                 for dtype, length, offset in layout)
+        entry = (shm, csr_matrix((data, indices, indptr), shape=shape, copy=False))
+    _attached[name] = entry
+    while len(_attached) > ATTACHED_GRAPHS:
+        shm = _attached.pop(next(iter(_attached)))[0]
+        try:
+            shm.close()
+        except BufferError:
+            pass  # still referenced, unmapped when the worker exits
+    return entry[1]
+
+
+def build_csgraph(engine, attribute):
+    # Sparse adjacency in the node order of engine.nodes
+    index = engine.node_index
+    rows, cols, weights = [], [], []
+    for u, v, data in engine.graph.edges(data=True):
+        rows.append(index[u])
+        cols.append(index[v])
+        weights.append(data[attribute])
+    n = len(engine.nodes)
+    return csr_matrix((weights, (rows, cols)), shape=(n, n))
+
+
+def dijkstra_rows(csgraph, sources, targets, limit):
+    dist = dijkstra(csgraph, directed=False, indices=sources,
+                    limit=np.inf if limit is None else limit)
+    return dist[:, targets]
+
+
+def shared_dijkstra_rows(spec, sources, targets, limit):
+    # Runs in a worker process; only the target columns are sent back
+    return dijkstra_rows(attached_csgraph(spec), sources, targets, limit)
+
+
+def route_matrix(engine, origins, destinations, profile='distance', limit=None):
+    # origins and destinations are (N, 2) / (M, 2) arrays of lon/lat
+    sources = engine.snap_many(origins)
+    targets = engine.snap_many(destinations)
+    unique_sources, source_rows = np.unique(sources, return_inverse=True)
+    unique_targets, target_cols = np.unique(targets, return_inverse=True)
+
+    metric = engine.metrics.get(profile)
+    if metric is not None and limit is None:
+        ch_index = engine.ch_index
+        result = metric.matrix(
+            [ch_index[engine.nodes[i]] for i in unique_sources],
+            [ch_index[engine.nodes[i]] for i in unique_targets])
+    else:
+        csgraph = engine.csgraph(profile)
+        chunks = [unique_sources[i:i + MATRIX_CHUNK_SIZE]
+                  for i in range(0, len(unique_sources), MATRIX_CHUNK_SIZE)]
+        if len(chunks) == 1:
+            parts = [dijkstra_rows(csgraph, chunks[0], unique_targets, limit)]
+        else:
+            spec = share_csgraph(csgraph)
+            parts = list(get_pool().map(
+                shared_dijkstra_rows, [spec] * len(chunks), chunks,
+                [unique_targets] * len(chunks), [limit] * len(chunks)))
+        result = np.vstack(parts)
+
+    return result[np.ix_(source_rows, target_cols)]
+
+
+def isochrone(engine, longitude, latitude, limit, profile='distance'):
+    # Nodes reachable within limit, as (K, 2) lon/lat coordinates and costs
+    source = engine.snap_many(np.array([[longitude, latitude]]))[0]
+    dist = dijkstra(engine.csgraph(profile), directed=False,
+                    indices=source, limit=limit)
+    reachable = np.flatnonzero(np.isfinite(dist))
+    return engine.node_coords[reachable], dist[reachable]
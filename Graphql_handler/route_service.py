@@ -0,0 +1,559 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import networkx as nx
+import numpy as np
+from aiohttp import web
+from scipy.spatial import cKDTree
+
+from algorithm import (MIN_LEVEL, connect_to_database, graph_fingerprint, level_factor,
+                       load_or_build_network, unknown_level)
+from contraction import ContractionHierarchy
+from hourly_levels import HourlyLevels
+from metrics import ROUTE_SECONDS, render_metrics
+from profiling import LoopProfiler, profile_seconds
+from route_cache import RouteCache
+from route_geometry import encode_polyline, simplify
+import route_matrix
+
+# Routing service settings
+service_host = os.getenv('ROUTE_SERVICE_HOST', '0.0.0.0')
+service_port = int(os.getenv('ROUTE_SERVICE_PORT', '8090'))
+route_workers = int(os.getenv('ROUTE_WORKERS', '4'))
+graph_file = os.getenv('GRAPH_FILE', 'network_graph.pkl')
+hierarchy_file = os.getenv('CH_FILE', 'contraction_hierarchy.npz')
+admin_token = os.getenv('ROUTE_ADMIN_TOKEN')  # required by /admin/* when set
+route_cache_size = int(os.getenv('ROUTE_CACHE_SIZE', '10000'))
+route_cache_max_nodes = int(os.getenv('ROUTE_CACHE_MAX_NODES', '2000000'))
+levels_channel = os.getenv('LEVELS_CHANNEL', 'highway_bremen_levels')
+hourly_levels_channel = os.getenv('HOURLY_LEVELS_CHANNEL', 'highway_bremen_hourly_levels')
+DEPARTURE_SLOT_SECONDS = 900  # departures are rounded down to this, so routes can be cached
+
+# Edge attribute minimised by each cost profile
+COST_PROFILES = {'distance': 'weight', 'clean': 'exposure'}
+# Profiles whose cost depends on air_quality_level
+LEVEL_PROFILES = {'clean'}
+
+
+def lower_bound_km(points_a, points_b):
+    # Great-circle distance with the same coordinate ordering that
+    # algorithm.add_edges_from_coordinates passes to geopy, so that it never
+    # exceeds an edge-weight path between the two points
+    a = np.radians(points_a)
+    b = np.radians(points_b)
+    h = (np.sin((b[..., 0] - a[..., 0]) / 2) ** 2
+         + np.cos(a[..., 0]) * np.cos(b[..., 0])
+         * np.sin((b[..., 1] - a[..., 1]) / 2) ** 2)
+    # 1% slack covers the sphere/ellipsoid difference
+    return 0.99 * 2 * 6371.0 * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+class RouteEngine:
+    def __init__(self, graph, version=None, hierarchy=None):
+        self.graph = graph
+        # Part of every cache key; graphs pickled before the fingerprint
+        # was stored get it computed here
+        self.version = version or graph.graph.get('fingerprint') or graph_fingerprint(graph)
+        self.nodes = list(graph.nodes)
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        self.node_coords = np.array(self.nodes, dtype=float)
+        # Component of every node (see algorithm.label_components); two
+        # nodes are connected exactly when these are equal
+        self.components = np.array(
+            [graph.nodes[node].get('component', 0) for node in self.nodes], dtype=np.int64)
+
+        # Endpoints snap to the routable core only. Longitudes are scaled so
+        # that the KD-tree distance is roughly isotropic.
+        self.lon_scale = math.cos(math.radians(self.node_coords[:, 1].mean()))
+        self.core = np.flatnonzero(self.components == 0)
+        self.tree = cKDTree(self.node_coords[self.core] * (self.lon_scale, 1.0))
+
+        # Sparse adjacency matrices per profile, built on demand
+        self.csgraphs = {}
+
+        self.edges_by_gid = {}
+        for u, v, data in graph.edges(data=True):
+            data['exposure'] = data['weight'] * level_factor(
+                data.get('air_quality_level'))
+            self.edges_by_gid.setdefault(data.get('gid'), []).append((u, v))
+
+        # Hourly levels for routes with a departure time, once loaded
+        self.hourly = None
+
+        # With a contraction hierarchy every profile gets its own metric
+        self.hierarchy = hierarchy
+        self.metrics = {}
+        if hierarchy is not None:
+            self.ch_nodes = hierarchy.nodes()
+            self.ch_index = {node: i for i, node in enumerate(self.ch_nodes)}
+            for profile in COST_PROFILES:
+                self.customize(profile)
+
+    def customize(self, profile):
+        weights = self.hierarchy.edge_weights(
+            self.graph, COST_PROFILES[profile])
+        self.metrics[profile] = self.hierarchy.customize(weights)
+
+    def snap(self, longitude, latitude):
+        _, index = self.tree.query((longitude * self.lon_scale, latitude))
+        return self.nodes[self.core[index]]
+
+    def snap_many(self, coords):
+        # Indices into self.nodes for an (N, 2) array of lon/lat
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        _, indices = self.tree.query(coords * (self.lon_scale, 1.0))
+        return self.core[indices]
+
+    def connected(self, start_node, end_node):
+        return self.components[self.node_index[start_node]] == self.components[self.node_index[end_node]]
+
+    def csgraph(self, profile):
+        csgraph = self.csgraphs.get(profile)
+        if csgraph is None:
+            csgraph = route_matrix.build_csgraph(self, COST_PROFILES[profile])
+            self.csgraphs[profile] = csgraph
+        return csgraph
+
+    def load_hourly_levels(self, rows):
+        self.hourly = HourlyLevels(self.graph, self.nodes, self.node_index, rows)
+
+    def route(self, start_node, end_node, profile='distance', departure=None):
+        # departure (seconds since midnight UTC) makes level profiles time-dependent
+        weight = COST_PROFILES[profile]
+        if not self.connected(start_node, end_node):
+            return [], None, []  # no search would find a path
+        if departure is not None and profile in LEVEL_PROFILES and self.hourly is not None:
+            return self.hourly.route(start_node, end_node, departure, lower_bound_km)
+        if profile in self.metrics:
+            indices, cost = self.metrics[profile].route(
+                self.ch_index[start_node], self.ch_index[end_node])
+            route = [self.ch_nodes[i] for i in indices]
+        else:
+            try:
+                route = nx.shortest_path(
+                    self.graph, start_node, end_node, weight=weight)
+            except nx.NetworkXNoPath:
+                route = []
+        if not route:
+            return [], None, []
+        edges = [self.graph[u][v] for u, v in zip(route, route[1:])]
+        cost = sum(data[weight] for data in edges)
+        return route, cost, [data.get('gid') for data in edges]
+
+    def route_length(self, route):
+        return sum(
+            self.graph[u][v]['weight'] for u, v in zip(route, route[1:]))
+
+    def apply_levels(self, levels):
+        # Update exposure weights and return (raised, lowered) edge lists
+        raised, lowered = [], []
+        for gid, level in levels.items():
+            for u, v in self.edges_by_gid.get(gid, ()):
+                data = self.graph[u][v]
+                old_exposure = data['exposure']
+                data['air_quality_level'] = level
+                data['exposure'] = data['weight'] * level_factor(level)
+                if data['exposure'] > old_exposure:
+                    raised.append((gid, u, v))
+                elif data['exposure'] < old_exposure:
+                    lowered.append((gid, u, v, data['exposure']))
+
+        # Only the weights change, so the hierarchy is just recustomized
+        if raised or lowered:
+            for profile in LEVEL_PROFILES:
+                self.csgraphs.pop(profile, None)
+                if self.hierarchy is not None:
+                    self.customize(profile)
+        return raised, lowered
+
+    def invalidate(self, cache, raised, lowered):
+        changed = {edge[0] for edge in raised} | {edge[0] for edge in lowered}
+        dropped = cache.invalidate(changed, LEVEL_PROFILES)
+        if not lowered:
+            return dropped
+
+        # A cheaper edge elsewhere can only beat a cached route if the
+        # lower bound of a path through it is below the cached cost
+        starts = np.array([edge[1] for edge in lowered], dtype=float)
+        ends = np.array([edge[2] for edge in lowered], dtype=float)
+        costs = np.array([edge[3] for edge in lowered])
+
+        factor = min(MIN_LEVEL, unknown_level)
+
+        def could_improve(key, entry):
+            s = np.array(key[0], dtype=float)
+            t = np.array(key[1], dtype=float)
+            via_forward = factor * (
+                lower_bound_km(s, starts) + lower_bound_km(ends, t))
+            via_backward = factor * (
+                lower_bound_km(s, ends) + lower_bound_km(starts, t))
+            best = np.minimum(via_forward, via_backward) + costs
+            return bool((best < entry.cost).any())
+
+        return dropped + cache.invalidate_where(could_improve, LEVEL_PROFILES)
+
+
+def load_hierarchy(graph):
+    # The hierarchy is produced offline by contraction.py
+    try:
+        hierarchy = ContractionHierarchy.load(hierarchy_file)
+    except FileNotFoundError:
+        logging.info("No contraction hierarchy found, using Dijkstra")
+        return None
+    # The fingerprint covers the edges too, so a hierarchy of a graph with
+    # the same nodes but other edges is not used either
+    if hierarchy.fingerprint != (graph.graph.get('fingerprint') or graph_fingerprint(graph)):
+        logging.warning(f"{hierarchy_file} does not match the road graph, rebuilding it")
+        started = time.perf_counter()
+        hierarchy = ContractionHierarchy.build(graph)
+        hierarchy.save(hierarchy_file)
+        logging.info(f"Contraction hierarchy rebuilt in {time.perf_counter() - started:.1f}s")
+    return hierarchy
+
+
+def route_to_geojson(engine, route, cost, start_node, end_node, profile, tolerance=None):
+    # The geometry is simplified to `tolerance` metres for the response;
+    # costs and lengths are those of the full route
+    coordinates = [list(point) for point in simplify(route, tolerance)]
+    return {
+        'type': 'Feature',
+        'geometry': {
+            'type': 'LineString',
+            'coordinates': coordinates
+        },
+        'properties': {
+            'start_node': list(start_node),
+            'end_node': list(end_node),
+            'profile': profile,
+            'cost': cost,
+            'node_count': len(route),
+            'point_count': len(coordinates),
+            'distance_km': engine.route_length(route),
+            'polyline': encode_polyline(coordinates)
+        }
+    }
+
+
+def compute_route(app, key):
+    engine = app['engine']
+    cache = app['cache']
+    generation = cache.generation
+    with app['profiler'].cycle():
+        route, cost, gids = engine.route(*key[:3], *key[4:])
+    if route:
+        cache.put(key, route, cost, gids, generation)
+    return route, cost
+
+
+async def coalesced_route(app, key):
+    cached = app['cache'].get(key)
+    if cached is not None:
+        return cached.route, cached.cost
+
+    # Identical origin/destination pairs share a single computation
+    inflight = app['inflight']
+    future = inflight.get(key)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(app['executor'], compute_route, app, key)
+        inflight[key] = future
+        future.add_done_callback(lambda _: inflight.pop(key, None))
+    else:
+        app['coalesced'] += 1
+
+    # Shield so that a disconnecting client does not cancel the others
+    return await asyncio.shield(future)
+
+
+def parse_profile(value):
+    profile = value or 'distance'
+    if profile not in COST_PROFILES:
+        raise web.HTTPBadRequest(text=f"Unknown profile '{profile}'")
+    return profile
+
+
+def parse_departure(request, profile):
+    # Seconds since midnight UTC of depart_at (ISO 8601, local time without
+    # an offset), rounded down to a slot; None for routes without one
+    value = request.query.get('depart_at')
+    if value is None or profile not in LEVEL_PROFILES or request.app['engine'].hourly is None:
+        return None
+    try:
+        departure = datetime.fromisoformat(value.replace('Z', '+00:00')).astimezone(timezone.utc)
+    except ValueError:
+        raise web.HTTPBadRequest(text="'depart_at' must be an ISO 8601 date and time")
+    seconds = departure.hour * 3600 + departure.minute * 60 + departure.second
+    return seconds - seconds % DEPARTURE_SLOT_SECONDS
+
+
+def parse_coordinate(request, name):
+    try:
+        return float(request.query[name])
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest(text=f"Missing or invalid parameter '{name}'")
+
+
+async def handle_route(request):
+    app = request.app
+    engine = app['engine']
+
+    profile = parse_profile(request.query.get('profile'))
+
+    start_node = engine.snap(
+        parse_coordinate(request, 'start_lon'),
+        parse_coordinate(request, 'start_lat'))
+    end_node = engine.snap(
+        parse_coordinate(request, 'end_lon'),
+        parse_coordinate(request, 'end_lat'))
+
+    key = (start_node, end_node, profile, engine.version)
+    departure = parse_departure(request, profile)
+    if departure is not None:
+        key += (departure,)
+    with ROUTE_SECONDS.labels('route', profile).time():
+        route, cost = await coalesced_route(app, key)
+    if not route:
+        return web.json_response({'error': 'No route found.'}, status=404)
+
+    tolerance = request.query.get('tolerance')
+    try:
+        tolerance = None if tolerance is None else float(tolerance)
+    except ValueError:
+        raise web.HTTPBadRequest(text="'tolerance' must be a number of metres")
+    feature = route_to_geojson(engine, route, cost, start_node, end_node, profile, tolerance)
+    response_format = request.query.get('format', 'geojson')
+    if response_format == 'json':
+        return web.json_response({
+            'route': feature['geometry']['coordinates'],
+            **feature['properties']
+        })
+    if response_format == 'polyline':
+        return web.json_response(feature['properties'])
+    return web.json_response(feature)
+
+
+def matrix_to_json(matrix):
+    # Unreachable pairs are reported as null
+    return [[cost if math.isfinite(cost) else None for cost in row]
+            for row in matrix.tolist()]
+
+
+async def handle_matrix(request):
+    app = request.app
+    try:
+        body = await request.json()
+        origins = np.array(body['origins'], dtype=float).reshape(-1, 2)
+        destinations = np.array(body['destinations'], dtype=float).reshape(-1, 2)
+        limit = body.get('limit')
+        limit = None if limit is None else float(limit)
+    except (KeyError, TypeError, ValueError):
+        raise web.HTTPBadRequest(
+            text="Expected JSON with 'origins' and 'destinations' as [lon, lat] lists")
+    profiles = body.get('profiles', ['distance'])
+    for profile in profiles:
+        parse_profile(profile)
+
+    loop = asyncio.get_running_loop()
+    result = {}
+    for profile in profiles:
+        with ROUTE_SECONDS.labels('matrix', profile).time():
+            matrix = await loop.run_in_executor(
+                app['executor'], route_matrix.route_matrix, app['engine'],
+                origins, destinations, profile, limit)
+        result[profile] = matrix_to_json(matrix)
+    return web.json_response(result)
+
+
+async def handle_isochrone(request):
+    app = request.app
+    profile = parse_profile(request.query.get('profile'))
+    longitude = parse_coordinate(request, 'lon')
+    latitude = parse_coordinate(request, 'lat')
+    limit = parse_coordinate(request, 'limit')
+
+    with ROUTE_SECONDS.labels('isochrone', profile).time():
+        coords, costs = await asyncio.get_running_loop().run_in_executor(
+            app['executor'], route_matrix.isochrone, app['engine'],
+            longitude, latitude, limit, profile)
+    return web.json_response({
+        'type': 'Feature',
+        'geometry': {'type': 'MultiPoint', 'coordinates': coords.tolist()},
+        'properties': {'profile': profile, 'limit': limit, 'costs': costs.tolist()}
+    })
+
+
+async def handle_metrics(request):
+    body, content_type = render_metrics()
+    return web.Response(body=body, headers={'Content-Type': content_type})
+
+
+async def handle_profile(request):
+    # Profiles the route computations of the next `seconds` (or `requests`)
+    if admin_token and request.headers.get('X-Admin-Token') != admin_token:
+        raise web.HTTPForbidden()
+    try:
+        seconds = float(request.query.get('seconds', profile_seconds))
+        requests = request.query.get('requests')
+        requests = None if requests is None else int(requests)
+    except ValueError:
+        raise web.HTTPBadRequest(text="'seconds' and 'requests' must be numbers")
+    request.app['profiler'].request(seconds=seconds, cycles=requests)
+    return web.json_response({'profiling': True, 'seconds': seconds, 'requests': requests,
+                              'directory': request.app['profiler'].directory})
+
+
+async def handle_health(request):
+    graph = request.app['engine'].graph
+    return web.json_response({
+        'nodes': graph.number_of_nodes(),
+        'edges': graph.number_of_edges(),
+        'version': request.app['engine'].version,
+        'inflight': len(request.app['inflight']),
+        'coalesced': request.app['coalesced'],
+        'cache': request.app['cache'].stats()
+    })
+
+
+def fetch_levels(gids=None):
+    conn = connect_to_database()
+    try:
+        with conn.cursor() as cur:
+            if gids is None:
+                cur.execute('SELECT gid, air_quality_level FROM "highway-bremen";')
+            else:
+                cur.execute(
+                    'SELECT gid, air_quality_level FROM "highway-bremen" '
+                    'WHERE gid = ANY(%s);', (list(gids),))
+            return dict(cur.fetchall())
+    finally:
+        conn.close()
+
+
+def refresh_levels(app, gids):
+    engine = app['engine']
+    cache = app['cache']
+    # A None gid set means a full refresh, e.g. after set_initial_levels
+    raised, lowered = engine.apply_levels(fetch_levels(gids))
+    if gids is None:
+        dropped = cache.invalidate_where(lambda key, entry: True, LEVEL_PROFILES)
+    else:
+        dropped = engine.invalidate(cache, raised, lowered)
+    logging.info(
+        f"Applied level changes: {len(raised)} raised, {len(lowered)} lowered, "
+        f"{dropped} cached routes invalidated")
+
+
+def fetch_hourly_levels():
+    conn = connect_to_database()
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT gid, hour, air_quality_level FROM highway_bremen_hourly_levels;')
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+
+def refresh_hourly_levels(app):
+    try:
+        rows = fetch_hourly_levels()
+    except Exception as e:
+        logging.error(f"Could not load hourly levels: {e}")
+        return
+    app['engine'].load_hourly_levels(rows)
+    # Routes with a departure time were computed from the old hourly levels
+    dropped = app['cache'].invalidate_where(lambda key, entry: len(key) > 4, LEVEL_PROFILES)
+    logging.info(
+        f"Loaded hourly levels of {app['engine'].hourly.segments} segments, "
+        f"{dropped} cached routes invalidated")
+
+
+def on_level_notify(app, conn):
+    conn.poll()
+    gids = set()
+    full_refresh = False
+    hourly_refresh = False
+    while conn.notifies:
+        notify = conn.notifies.pop(0)
+        payload = notify.payload
+        if notify.channel == hourly_levels_channel:
+            hourly_refresh = True
+        elif payload == '*':
+            full_refresh = True
+        else:
+            gids.update(json.loads(payload))
+    loop = asyncio.get_running_loop()
+    if full_refresh or gids:
+        loop.run_in_executor(
+            app['executor'], refresh_levels, app,
+            None if full_refresh else gids)
+    if hourly_refresh:
+        loop.run_in_executor(app['executor'], refresh_hourly_levels, app)
+
+
+async def start_level_listener(app):
+    # handler.py publishes the gids whose air_quality_level changed, and
+    # when it recomputed the hourly levels
+    try:
+        conn = connect_to_database()
+    except Exception as e:
+        logging.error(f"Level listener disabled: {e}")
+        return
+    conn.set_session(autocommit=True)
+    with conn.cursor() as cur:
+        cur.execute(f"LISTEN {levels_channel};")
+        cur.execute(f"LISTEN {hourly_levels_channel};")
+    asyncio.get_running_loop().add_reader(
+        conn.fileno(), on_level_notify, app, conn)
+    app['listen_conn'] = conn
+
+
+async def stop_level_listener(app):
+    conn = app.get('listen_conn')
+    if conn is not None:
+        asyncio.get_running_loop().remove_reader(conn.fileno())
+        conn.close()
+
+
+async def close_executor(app):
+    app['executor'].shutdown(wait=False)
+
+
+def create_app(engine, listen=True):
+    app = web.Application()
+    app['engine'] = engine
+    app['executor'] = ThreadPoolExecutor(max_workers=route_workers)
+    app['cache'] = RouteCache(route_cache_size, route_cache_max_nodes)
+    app['inflight'] = {}
+    app['coalesced'] = 0
+    app['profiler'] = LoopProfiler('route_service')
+    app.router.add_get('/route', handle_route)
+    app.router.add_post('/matrix', handle_matrix)
+    app.router.add_get('/isochrone', handle_isochrone)
+    app.router.add_get('/health', handle_health)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_post('/admin/profile', handle_profile)
+    if listen:
+        app.on_startup.append(start_level_listener)
+        app.on_cleanup.append(stop_level_listener)
+    app.on_cleanup.append(close_executor)
+    return app
+
+
+def main():
+    G = load_or_build_network(graph_file)
+    logging.info(f"Road graph loaded: {G}")
+    engine = RouteEngine(G, hierarchy=load_hierarchy(G))
+    app = create_app(engine)
+    refresh_hourly_levels(app)
+    app['profiler'].install_signal_handler()
+    web.run_app(app, host=service_host, port=service_port)
+
+
+if __name__ == "__main__":
+    main()
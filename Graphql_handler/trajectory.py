@@ -0,0 +1,175 @@
+import math
+import os
+import numpy as np
+from metrics import TRAJECTORY_FIXES
+
+# Cleans each device's GPS track before map matching.
+#
+# Every uplink carries one fix, which TTN.py stores with each of its six
+# readings, so the rows are grouped back into fixes by device and time.
+# Fixes that are not usable positions (missing, 0/0 or out of range) are
+# dropped. A fix is then dropped as an outlier when it is too far away to
+# reach at TRAJECTORY_MAX_SPEED_KMH from most of its OUTLIER_NEIGHBOURS
+# neighbours on either side. A jump of a few kilometres is removed this
+# way, while a device that really moved on keeps its fixes. The remaining
+# fixes are smoothed by a constant-velocity Kalman filter and a
+# Rauch-Tung-Striebel smoother. All devices are processed at once, as the
+# rows of padded arrays.
+#
+# TTN.py stores the longitude of a fix in the latitude column of raw_data_2
+# and the latitude in the longitude column, and graphql_helper.py reads
+# them that way. The filter reads and writes the columns in the same order.
+
+max_speed = float(os.getenv('TRAJECTORY_MAX_SPEED_KMH', '45')) / 3.6  # m/s
+gps_noise = float(os.getenv('TRAJECTORY_GPS_NOISE_METERS', '10'))
+acceleration_noise = float(os.getenv('TRAJECTORY_ACCELERATION', '1'))  # m/s², process noise of the smoother
+OUTLIER_NEIGHBOURS = 2  # on each side; up to this many consecutive bad fixes are caught
+SPEED_SLACK = 3  # times gps_noise, so jitter between close fixes is no jump
+METERS_PER_DEGREE = 111320.0
+
+
+def pad(tracks, fill=np.nan):
+    # (devices, longest track) array of the 1D tracks and the mask of real entries
+    length = max((len(track) for track in tracks), default=0)
+    padded = np.full((len(tracks), length), fill, dtype=float)
+    mask = np.zeros((len(tracks), length), dtype=bool)
+    for i, track in enumerate(tracks):
+        padded[i, :len(track)] = track
+        mask[i, :len(track)] = True
+    return padded, mask
+
+
+def speed_outliers(t, x, y, mask):
+    # Fixes that most neighbours could not reach without speeding, among
+    # at least two neighbours
+    too_fast = np.zeros(mask.shape, dtype=int)
+    neighbours = np.zeros(mask.shape, dtype=int)
+    for k in range(1, OUTLIER_NEIGHBOURS + 1):
+        if k >= mask.shape[1]:
+            break
+        both = mask[:, k:] & mask[:, :-k]
+        distance = np.hypot(x[:, k:] - x[:, :-k], y[:, k:] - y[:, :-k])
+        fast = both & (distance > max_speed * np.abs(t[:, k:] - t[:, :-k]) + SPEED_SLACK * gps_noise)
+        # The pair counts for both of its fixes
+        too_fast[:, k:] += fast
+        too_fast[:, :-k] += fast
+        neighbours[:, k:] += both
+        neighbours[:, :-k] += both
+    return mask & (too_fast >= 2) & (2 * too_fast > neighbours)
+
+
+def smooth(t, z, mask):
+    # Constant-velocity Kalman filter and RTS smoother. z is (devices, steps,
+    # 2) positions in metres; both axes share one covariance, so the state is
+    # a (devices, 2, 2) array of [position, velocity] x [x, y].
+    devices, steps = mask.shape
+    dt = np.zeros((devices, steps))
+    dt[:, 1:] = np.where(mask[:, 1:], np.nan_to_num(t[:, 1:] - t[:, :-1]), 0)
+    q = acceleration_noise ** 2
+    r = gps_noise ** 2
+
+    transition = np.zeros((devices, steps, 2, 2))
+    transition[:, :, 0, 0] = transition[:, :, 1, 1] = 1
+    transition[:, :, 0, 1] = dt
+    noise = np.empty((devices, steps, 2, 2))
+    noise[:, :, 0, 0] = q * dt ** 3 / 3
+    noise[:, :, 0, 1] = noise[:, :, 1, 0] = q * dt ** 2 / 2
+    noise[:, :, 1, 1] = q * dt
+
+    predicted = np.zeros((devices, steps, 2, 2))
+    predicted_cov = np.zeros((devices, steps, 2, 2))
+    filtered = np.zeros((devices, steps, 2, 2))
+    filtered_cov = np.zeros((devices, steps, 2, 2))
+    predicted[:, 0, 0] = np.nan_to_num(z[:, 0])
+    predicted_cov[:, 0] = np.diag([r, max_speed ** 2])
+    for i in range(steps):
+        if i:
+            F = transition[:, i]
+            predicted[:, i] = F @ filtered[:, i - 1]
+            predicted_cov[:, i] = F @ filtered_cov[:, i - 1] @ F.transpose(0, 2, 1) + noise[:, i]
+        # Padding steps are predictions without a measurement
+        gain = predicted_cov[:, i, :, 0] / (predicted_cov[:, i, 0, 0] + r)[:, None]
+        gain[~mask[:, i]] = 0
+        innovation = np.nan_to_num(z[:, i]) - predicted[:, i, 0]
+        filtered[:, i] = predicted[:, i] + gain[:, :, None] * innovation[:, None, :]
+        filtered_cov[:, i] = predicted_cov[:, i] - gain[:, :, None] * predicted_cov[:, i, None, 0]
+
+    smoothed = filtered.copy()
+    smoothed_cov = filtered_cov.copy()
+    for i in range(steps - 2, -1, -1):
+        F = transition[:, i + 1]
+        C = filtered_cov[:, i] @ F.transpose(0, 2, 1) @ np.linalg.inv(predicted_cov[:, i + 1])
+        smoothed[:, i] = filtered[:, i] + C @ (smoothed[:, i + 1] - predicted[:, i + 1])
+        smoothed_cov[:, i] = filtered_cov[:, i] + C @ (smoothed_cov[:, i + 1] - predicted_cov[:, i + 1]) \
+            @ C.transpose(0, 2, 1)
+    return smoothed[:, :, 0]
+
+
+def filter_trajectories(rows):
+    # The rows of the fixes that were kept, as dicts with smoothed latitude
+    # and longitude, ordered by device and time; rows of dropped fixes are
+    # left out
+    fixes = {}
+    for row in rows:
+        fixes.setdefault((row['device_id'], row['time_received']), []).append(row)
+    tracks = {}
+    for device, time_received in fixes:
+        tracks.setdefault(device, []).append(time_received)
+
+    devices = sorted(tracks, key=str)
+    times, lats, lons = [], [], []
+    invalid = 0
+    for device in devices:
+        track = []
+        for time_received in sorted(tracks[device], key=lambda value: (value is None, value)):
+            first = fixes[device, time_received][0]
+            lat, lon = first['longitude'], first['latitude']  # swapped, see above
+            if time_received is None or lat is None or lon is None or not (
+                    math.isfinite(lat) and math.isfinite(lon) and abs(lat) <= 90 and abs(lon) <= 180) \
+                    or (lat == 0 and lon == 0):
+                invalid += 1
+                continue
+            track.append((time_received.timestamp(), lat, lon, time_received))
+        tracks[device] = track
+        times.append([fix[0] for fix in track])
+        lats.append([fix[1] for fix in track])
+        lons.append([fix[2] for fix in track])
+
+    t, mask = pad(times)
+    lat, _ = pad(lats)
+    lon, _ = pad(lons)
+    if not mask.any():
+        TRAJECTORY_FIXES.labels('invalid').inc(invalid)
+        return []
+    # Local equirectangular metres, accurate enough across a city
+    reference_lat = np.nanmean(lat[mask])
+    scale = math.cos(math.radians(reference_lat)) * METERS_PER_DEGREE
+    x, y = lon * scale, lat * METERS_PER_DEGREE
+    outliers = speed_outliers(t, x, y, mask)
+
+    # Compact the kept fixes to the front of each row again
+    kept_tracks = [[fix for fix, outlier in zip(tracks[device], outliers[d]) if not outlier]
+                   for d, device in enumerate(devices)]
+    t, mask = pad([[fix[0] for fix in track] for track in kept_tracks])
+    if not mask.any():
+        # Every fix was an outlier
+        TRAJECTORY_FIXES.labels('invalid').inc(invalid)
+        TRAJECTORY_FIXES.labels('outlier').inc(int(outliers.sum()))
+        return []
+    x, _ = pad([[fix[2] * scale for fix in track] for track in kept_tracks])
+    y, _ = pad([[fix[1] * METERS_PER_DEGREE for fix in track] for track in kept_tracks])
+    positions = smooth(t, np.stack((x, y), axis=-1), mask)
+
+    filtered_rows = []
+    for d, device in enumerate(devices):
+        for i, fix in enumerate(kept_tracks[d]):
+            for row in fixes[device, fix[3]]:
+                row = dict(row)
+                row['latitude'] = float(positions[d, i, 0] / scale)
+                row['longitude'] = float(positions[d, i, 1] / METERS_PER_DEGREE)
+                filtered_rows.append(row)
+
+    TRAJECTORY_FIXES.labels('invalid').inc(invalid)
+    TRAJECTORY_FIXES.labels('outlier').inc(int(outliers.sum()))
+    TRAJECTORY_FIXES.labels('kept').inc(int(mask.sum()))
+    return filtered_rows
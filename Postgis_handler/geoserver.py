@@ -0,0 +1,44 @@
+import logging
+import os
+import requests
+
+# Calls to the GeoServer and GeoWebCache REST APIs for the layers handler.py
+# produces. Leave GEOSERVER_URL empty to run without GeoServer.
+
+geoserver_url = os.getenv('GEOSERVER_URL', 'http://localhost:8080/geoserver')
+geoserver_user = os.getenv('GEOSERVER_USER', 'admin')
+geoserver_password = os.getenv('GEOSERVER_PASSWORD', 'geoserver')
+geoserver_workspace = os.getenv('GEOSERVER_WORKSPACE', 'bremen')
+REQUEST_TIMEOUT = 30  # seconds
+
+
+def rest_request(method, path, **kwargs):
+    response = requests.request(
+        method, f"{geoserver_url}/rest/{path}", auth=(geoserver_user, geoserver_password),
+        timeout=REQUEST_TIMEOUT, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def gwc_request(method, path, **kwargs):
+    # GeoWebCache's own REST API, served next to GeoServer's
+    response = requests.request(
+        method, f"{geoserver_url}/gwc/rest/{path}", auth=(geoserver_user, geoserver_password),
+        timeout=REQUEST_TIMEOUT, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def publish_geotiff(store, path):
+    # Creates (or points) the coverage store at a GeoTIFF that GeoServer can
+    # read at `path`, and the layer of the same name on first use
+    rest_request(
+        'PUT', f"workspaces/{geoserver_workspace}/coveragestores/{store}/external.geotiff",
+        params={'configure': 'first', 'coverageName': store},
+        data=f"file:{path}", headers={'Content-Type': 'text/plain'})
+    logging.info(f"Published {path} as {geoserver_workspace}:{store}")
+
+
+def reload_coverages():
+    # GeoServer keeps GeoTIFF readers open; this makes it reopen the files
+    rest_request('POST', 'reset')
@@ -1,7 +1,18 @@
+import argparse
+import numpy as np
 import psycopg2
+import psycopg2.extras
+import requests
 import logging
 import time
+import json
 import os
+from cells import ensure_cells, update_cells
+from geoserver import geoserver_url, geoserver_workspace, publish_geotiff, reload_coverages
+from metrics import FRESHNESS_SECONDS, QUERY_SECONDS, RECOMPUTE_SECONDS, start_metrics_server
+from profiling import add_profile_arguments, loop_profiler
+from surface import TILE_SIZE, load_surface, surface_path
+from tile_cache import refresh_tiles, truncate_layers, warm_seed
 
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,6 +31,27 @@ PM25_THRESHOLDS = {'Good': 12, 'Moderate': 35.4, 'Unhealthy': 55.4, 'Very Unheal
 NO2_THRESHOLDS = {'Good': 53, 'Moderate': 100, 'Unhealthy': 360, 'Very Unhealthy': 649}  # ppb
 NH3_THRESHOLDS = {'Good': 100, 'Moderate': 200, 'Unhealthy': 400, 'Very Unhealthy': 700}  # hypothetical units
 
+# Channel on which changed segment gids are published (see route_service.py)
+levels_channel = os.getenv('LEVELS_CHANNEL', 'highway_bremen_levels')
+NOTIFY_CHUNK_SIZE = 500  # keeps each payload below the 8000 byte limit
+
+# Per-segment levels by UTC hour of day over the last hourly_levels_days,
+# for time-dependent routing (see Graphql_handler/hourly_levels.py). They
+# are recomputed at most every hourly_levels_interval seconds, and the
+# route service reloads them on a notification on hourly_levels_channel.
+hourly_levels_days = int(os.getenv('HOURLY_LEVELS_DAYS', '28'))
+hourly_levels_interval = float(os.getenv('HOURLY_LEVELS_INTERVAL_SECONDS', '3600'))
+hourly_levels_channel = os.getenv('HOURLY_LEVELS_CHANNEL', 'highway_bremen_hourly_levels')
+hourly_levels_updated = None  # time.monotonic() of the last recompute
+
+# Interpolated surface, published as a GeoServer coverage store of this name.
+# SURFACE_GEOSERVER_PATH is where GeoServer sees SURFACE_PATH.
+SURFACE_STORE = 'air_quality_surface'
+surface_geoserver_path = os.getenv('SURFACE_GEOSERVER_PATH', os.path.abspath(surface_path))
+surface = None  # loaded in main()
+surface_published = False
+segment_points = None  # (gids, lon, lat) of a point on each segment, read once
+
 
 def connect_to_database(attempts=5, delay=5):
     while attempts > 0:
@@ -40,6 +72,45 @@ def connect_to_database(attempts=5, delay=5):
     raise Exception("Unable to connect to the database ")
 
 
+def ensure_level_versions():
+    # Every air_quality_level change gets a new version from a sequence, so
+    # graph_sync.py can pick up exactly the rows changed since its last run
+    conn = connect_to_database()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE SEQUENCE IF NOT EXISTS highway_bremen_levels_version;")
+            cursor.execute("""
+            ALTER TABLE "highway-bremen"
+                ADD COLUMN IF NOT EXISTS levels_version BIGINT NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS levels_updated_at TIMESTAMPTZ;
+            """)
+            cursor.execute("""
+            CREATE INDEX IF NOT EXISTS highway_bremen_levels_version_idx
+                ON "highway-bremen" (levels_version);
+            """)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def ensure_hourly_levels():
+    conn = connect_to_database()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS highway_bremen_hourly_levels (
+                gid INTEGER NOT NULL,
+                hour SMALLINT NOT NULL,
+                air_quality_level SMALLINT NOT NULL,
+                readings INTEGER NOT NULL,
+                PRIMARY KEY (gid, hour)
+            );
+            """)
+        conn.commit()
+    finally:
+        conn.close()
+
+
 def set_initial_levels():
     try:
         conn = connect_to_database()
@@ -51,10 +122,14 @@ def set_initial_levels():
             pm25_level = 150,
             no2_level = 150,
             nh3_level = 150,
-            air_quality_level = 150;
+            air_quality_level = 150,
+            levels_version = nextval('highway_bremen_levels_version'),
+            levels_updated_at = now();
         """
 
         cursor.execute(query)
+        # Every segment changed, so listeners should reload all levels
+        cursor.execute("SELECT pg_notify(%s, '*');", (levels_channel,))
         conn.commit()
         logging.info("Initial levels set in highway-bremen table")
     except Exception as e:
@@ -64,6 +139,7 @@ def set_initial_levels():
         conn.close()
 
 
+@RECOMPUTE_SECONDS.labels('update_highway_bremen').time()
 def update_highway_bremen():
     try:
         conn = connect_to_database()
@@ -124,40 +200,323 @@ def determine_air_quality_level(co_level, pm25_level, no2_level, nh3_level):
     return max(numeric_levels) if numeric_levels else None
 
 
+def notify_level_changes(cursor, gids):
+    for i in range(0, len(gids), NOTIFY_CHUNK_SIZE):
+        cursor.execute(
+            "SELECT pg_notify(%s, %s);",
+            (levels_channel, json.dumps(gids[i:i + NOTIFY_CHUNK_SIZE])))
+
+
+@RECOMPUTE_SECONDS.labels('update_air_quality_levels').time()
 def update_air_quality_levels():
+    # Returns the gids whose level changed
+    changed_gids = []
     try:
         conn = connect_to_database()
         cursor = conn.cursor()
 
         # Select all rows from the table
-        cursor.execute("SELECT gid, co_level, pm25_level, no2_level, nh3_level FROM \"highway-bremen\";")
+        cursor.execute("SELECT gid, co_level, pm25_level, no2_level, nh3_level, air_quality_level FROM \"highway-bremen\";")
         rows = cursor.fetchall()
 
-        # Iterate over each row and update the air quality level
+        # Iterate over each row and update the air quality level if it changed
         for row in rows:
-            gid, co_level, pm25_level, no2_level, nh3_level = row
+            gid, co_level, pm25_level, no2_level, nh3_level, current_level = row
             air_quality_level = determine_air_quality_level(co_level, pm25_level, no2_level, nh3_level)
 
-            if air_quality_level is not None:
+            if air_quality_level is not None and air_quality_level != current_level:
                 # Update the air_quality_level for the current row
                 update_query = """
                     UPDATE "highway-bremen"
-                    SET air_quality_level = %s
+                    SET air_quality_level = %s,
+                        levels_version = nextval('highway_bremen_levels_version'),
+                        levels_updated_at = now()
                     WHERE gid = %s;
                 """
                 cursor.execute(update_query, (air_quality_level, gid))
+                changed_gids.append(gid)
 
+        # Notifications are delivered on commit, together with the new levels
+        notify_level_changes(cursor, changed_gids)
         conn.commit()
-        logging.info("Air quality levels updated successfully for all rows.")
+        logging.info(f"Air quality levels updated successfully: {len(changed_gids)} of {len(rows)} rows changed.")
     except Exception as e:
         logging.error(f"Error updating air quality levels: {e}")
+        changed_gids = []
     finally:
         cursor.close()
         conn.close()
+    return changed_gids
+
+
+@RECOMPUTE_SECONDS.labels('update_hourly_levels').time()
+def update_hourly_levels():
+    # Same 200 m rule as update_highway_bremen(), with the readings of each
+    # hour of the day averaged separately
+    global hourly_levels_updated
+    conn = connect_to_database()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT h.gid, extract(hour FROM a.time_received AT TIME ZONE 'UTC')::smallint,
+                       avg(a.co_level), avg(a.pm25_level), avg(a.no2_level), avg(a.nh3_level), count(*)
+                FROM air_quality AS a
+                JOIN "highway-bremen" AS h ON ST_DWithin(h.geom::geography, a.geom::geography, 200)
+                WHERE a.time_received > now() - %s * interval '1 day'
+                GROUP BY 1, 2;
+            """, (hourly_levels_days,))
+            rows = []
+            for gid, hour, co_level, pm25_level, no2_level, nh3_level, readings in cursor.fetchall():
+                if None in (co_level, pm25_level, no2_level, nh3_level):
+                    continue
+                level = determine_air_quality_level(co_level, pm25_level, no2_level, nh3_level)
+                if level is not None:
+                    rows.append((gid, hour, level, readings))
+            # Replaced in one transaction, so the route service never reads half of it
+            cursor.execute("DELETE FROM highway_bremen_hourly_levels;")
+            psycopg2.extras.execute_values(cursor, """
+                INSERT INTO highway_bremen_hourly_levels (gid, hour, air_quality_level, readings) VALUES %s;
+            """, rows, page_size=5000)
+            cursor.execute("SELECT pg_notify(%s, '');", (hourly_levels_channel,))
+        conn.commit()
+        hourly_levels_updated = time.monotonic()
+        logging.info(f"Hourly levels updated: {len(rows)} segment hours")
+    except Exception as e:
+        logging.error(f"Error updating hourly levels: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+def hourly_levels_due():
+    return hourly_levels_updated is None or time.monotonic() - hourly_levels_updated >= hourly_levels_interval
+
+
+def observe_freshness(cursor, since, until):
+    # Readings stored in (since, until] have now been applied to "highway-bremen"
+    with QUERY_SECONDS.labels('postgis', 'observe_freshness').time():
+        cursor.execute("""
+            SELECT extract(epoch FROM now() - time_received)
+            FROM air_quality
+            WHERE time_received IS NOT NULL AND updated_at <= %s
+              AND (%s::timestamptz IS NULL OR updated_at > %s);
+            """, (until, since, since))
+        ages = cursor.fetchall()
+    for (age,) in ages:
+        FRESHNESS_SECONDS.observe(float(age))
+
+
+@RECOMPUTE_SECONDS.labels('update_heatmap_cells').time()
+def update_heatmap_cells():
+    conn = connect_to_database()
+    try:
+        aggregated = update_cells(conn)
+        logging.info(f"Heatmap cells updated with {aggregated} readings")
+    except Exception as e:
+        logging.error(f"Error updating heatmap cells: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+def load_segment_points(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT gid, ST_X(p), ST_Y(p)
+            FROM (SELECT gid, ST_PointOnSurface(geom) AS p FROM "highway-bremen" WHERE geom IS NOT NULL) AS s;
+        """)
+        rows = cursor.fetchall()
+    conn.commit()
+    points = np.array(rows, dtype=float).reshape(len(rows), 3)
+    return points[:, 0].astype(np.int64), points[:, 1], points[:, 2]
+
+
+CLEAR_SEGMENTS_QUERY = """
+    WITH cleared AS (
+        SELECT gid, air_quality_level IS DISTINCT FROM 150 AS level_changed
+        FROM "highway-bremen" AS h
+        WHERE gid = ANY(%s)
+          AND (co_level, pm25_level, no2_level, nh3_level, air_quality_level)
+              IS DISTINCT FROM (150, 150, 150, 150, 150)
+          AND NOT EXISTS (SELECT 1 FROM air_quality AS a
+                          WHERE ST_DWithin(h.geom::geography, a.geom::geography, 200))
+    )
+    UPDATE "highway-bremen" AS h
+    SET co_level = 150, pm25_level = 150, no2_level = 150, nh3_level = 150, air_quality_level = 150,
+        levels_version = CASE WHEN c.level_changed
+                              THEN nextval('highway_bremen_levels_version') ELSE h.levels_version END,
+        levels_updated_at = CASE WHEN c.level_changed THEN now() ELSE h.levels_updated_at END
+    FROM cleared AS c
+    WHERE h.gid = c.gid
+    RETURNING h.gid, c.level_changed;
+"""
+
+
+def apply_surface_to_segments(conn, tiles):
+    # Samples the surface at one point of every segment in the recomputed
+    # tiles. update_highway_bremen() runs afterwards, so segments within
+    # 200 m of a reading still take the reading itself. Segments where the
+    # surface is empty, with no reading near enough, go back to the initial
+    # levels of set_initial_levels() instead of keeping an old estimate;
+    # returns the number sampled and the gids whose level was reset.
+    global segment_points
+    if segment_points is None:
+        segment_points = load_segment_points(conn)
+    gids, lon, lat = segment_points
+    rows, cols, inside = surface.cells(lon, lat)
+    tile_columns = -(-surface.width // TILE_SIZE)
+    keys = np.array([row * tile_columns + col for row, col in tiles])
+    selected = inside & np.isin(rows // TILE_SIZE * tile_columns + cols // TILE_SIZE, keys)
+    values = surface.sample(lon[selected], lat[selected])
+    valid = ~np.isnan(values).any(axis=0)
+    updates = list(zip(gids[selected][valid].tolist(), *values[:, valid].astype(float).tolist()))
+    with conn.cursor() as cursor:
+        psycopg2.extras.execute_values(cursor, """
+            UPDATE "highway-bremen" AS h
+            SET co_level = v.co, pm25_level = v.pm25, no2_level = v.no2, nh3_level = v.nh3
+            FROM (VALUES %s) AS v(gid, co, pm25, no2, nh3)
+            WHERE h.gid = v.gid;
+        """, updates, page_size=5000)
+        cursor.execute(CLEAR_SEGMENTS_QUERY, (gids[selected][~valid].tolist(),))
+        reset_gids = [gid for gid, level_changed in cursor.fetchall() if level_changed]
+        notify_level_changes(cursor, reset_gids)
+    conn.commit()
+    return len(updates), reset_gids
+
+
+def publish_surface():
+    global surface_published
+    if not geoserver_url:
+        return
+    try:
+        if not surface_published:
+            publish_geotiff(SURFACE_STORE, surface_geoserver_path)
+            surface_published = True
+        reload_coverages()
+    except requests.RequestException as e:
+        logging.error(f"Could not publish the surface to GeoServer: {e}")
+
+
+def segment_boxes(gids):
+    # (west, south, east, north) of each segment
+    conn = connect_to_database()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)
+                FROM "highway-bremen"
+                WHERE gid = ANY(%s) AND geom IS NOT NULL;
+            """, (gids,))
+            return cursor.fetchall()
+    finally:
+        conn.close()
+
+
+@RECOMPUTE_SECONDS.labels('refresh_tile_cache').time()
+def refresh_tile_cache(gids, surface_tiles):
+    # Reseeds or truncates the cached tiles over segments whose level
+    # changed and over recomputed surface tiles; the rest stay cached
+    if not geoserver_url:
+        return
+    try:
+        if gids:
+            rectangles = refresh_tiles(segment_boxes(gids))
+            logging.info(f"Tile cache refreshed in {len(rectangles)} areas for {len(gids)} changed segments")
+        if surface_tiles and surface_published:
+            refresh_tiles([surface.tile_bounds(tile) for tile in surface_tiles],
+                          [f"{geoserver_workspace}:{SURFACE_STORE}"])
+    except (requests.RequestException, psycopg2.Error) as e:
+        logging.error(f"Could not refresh the tile cache: {e}")
+
+
+def reset_tile_cache():
+    # Every level may have changed while the handler was down
+    if not geoserver_url:
+        return
+    try:
+        truncate_layers()
+        if surface_published:
+            truncate_layers([f"{geoserver_workspace}:{SURFACE_STORE}"])
+        warm_seed()
+    except requests.RequestException as e:
+        logging.error(f"Could not reset the tile cache: {e}")
+
+
+@RECOMPUTE_SECONDS.labels('update_surface').time()
+def update_surface(resample_all=False):
+    # Returns the recomputed surface tiles and the gids whose level was
+    # reset. resample_all also samples the segments of unchanged tiles,
+    # after set_initial_levels() reset them.
+    conn = connect_to_database()
+    try:
+        tiles = surface.update(conn)
+        if tiles:
+            surface.write(tiles=tiles)
+            publish_surface()
+        elif not resample_all:
+            return tiles, []
+        segments, reset_gids = apply_surface_to_segments(conn, surface.all_tiles() if resample_all else tiles)
+        logging.info(f"Surface updated: {len(tiles)} tiles recomputed, {segments} segments sampled, "
+                     f"{len(reset_gids)} segments without a reading near enough reset")
+        return tiles, reset_gids
+    except Exception as e:
+        logging.error(f"Error updating the surface: {e}")
+        conn.rollback()
+        return set(), []
+    finally:
+        conn.close()
+
+
+def check_for_updates(last_checked):
+    # One iteration of the main loop; returns the new last_checked
+    conn = connect_to_database()
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(updated_at) FROM air_quality;")
+    last_updated = cursor.fetchone()[0]
+
+    if last_updated != last_checked:
+        logging.info(f"Detected update in air_quality table. Last updated at: {last_updated}")
+        surface_tiles, reset_gids = update_surface()
+        update_highway_bremen()
+        changed_gids = update_air_quality_levels()
+        refresh_tile_cache(sorted(set(changed_gids) | set(reset_gids)), surface_tiles)
+        update_heatmap_cells()
+        if hourly_levels_due():
+            update_hourly_levels()
+        try:
+            observe_freshness(cursor, last_checked, last_updated)
+        except psycopg2.Error as e:
+            logging.error(f"Could not measure freshness: {e}")
+            conn.rollback()
+
+    cursor.close()
+    conn.close()
+    return last_updated
 
 
 def main():
+    global surface
+    parser = argparse.ArgumentParser(description="Recompute segment air quality levels")
+    add_profile_arguments(parser)
+    profiler = loop_profiler('handler', parser.parse_args())
+
+    start_metrics_server(9103)
+    ensure_level_versions()
+    ensure_hourly_levels()
+    conn = connect_to_database()
+    try:
+        ensure_cells(conn)
+    finally:
+        conn.close()
+    update_heatmap_cells()  # Backfill readings stored before the cells existed
+    surface = load_surface()
     set_initial_levels()  # Set initial levels when the script runs first time
+    # Estimates from the surface for segments without a reading nearby
+    update_surface(resample_all=True)
+    update_highway_bremen()
+    update_air_quality_levels()
+    reset_tile_cache()
+    update_hourly_levels()
     logging.info("Starting main process")
 
     # Initialize last_checked with the current max timestamp from air_quality
@@ -169,22 +528,12 @@ def main():
     cursor.close()
     conn.close()
 
-    while True:
+    while not profiler.done:
         # Check if the air_quality table has been updated
-        conn = connect_to_database()
-        cursor = conn.cursor()
-        cursor.execute("SELECT MAX(updated_at) FROM air_quality;")
-        last_updated = cursor.fetchone()[0]
-
-        if last_updated != last_checked:
-            logging.info(f"Detected update in air_quality table. Last updated at: {last_updated}")
-            last_checked = last_updated
-            update_highway_bremen()
-            update_air_quality_levels()
-
-        cursor.close()
-        conn.close()
-        time.sleep(5)
+        with profiler.cycle():
+            last_checked = check_for_updates(last_checked)
+        if not profiler.done:
+            time.sleep(5)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,243 @@
+import logging
+import math
+import os
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import RasterioIOError
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from scipy.spatial import cKDTree
+
+# Interpolated pollution surface over Bremen.
+#
+# The surface is a regular lon/lat grid of SURFACE_RESOLUTION_METERS cells
+# with one band per pollutant. A cell gets the inverse-distance-weighted
+# mean of its SURFACE_NEIGHBOURS nearest air_quality readings from the last
+# SURFACE_WINDOW_HOURS. Only readings within SURFACE_MAX_DISTANCE_METERS
+# count, and cells with none stay empty. The grid is split into 256 x 256
+# tiles. A tile is recomputed only when a reading within the maximum
+# distance was added or has left the window since the last update. The
+# surface is kept in memory and written as a tiled GeoTIFF with overviews;
+# after an update only the recomputed tiles are written into the file,
+# which is rewritten in full once that has grown it MAX_FILE_GROWTH times.
+# Its last aggregated id and window start are stored in the file's tags, so
+# a restart resumes instead of recomputing. sample() looks up a cell by
+# array index, so a value costs O(1) per point.
+
+surface_bbox = tuple(float(v) for v in os.getenv('SURFACE_BBOX', '8.48,53.01,8.99,53.23').split(','))
+surface_resolution = float(os.getenv('SURFACE_RESOLUTION_METERS', '50'))
+surface_window_hours = float(os.getenv('SURFACE_WINDOW_HOURS', '24'))
+surface_neighbours = int(os.getenv('SURFACE_NEIGHBOURS', '12'))
+surface_max_distance = float(os.getenv('SURFACE_MAX_DISTANCE_METERS', '1500'))
+surface_path = os.getenv('SURFACE_PATH', 'surface/air_quality_surface.tif')
+BANDS = ('co', 'pm25', 'no2', 'nh3')
+IDW_POWER = 2
+MIN_DISTANCE = 1.0  # metres; a reading on a cell centre does not divide by zero
+TILE_SIZE = 256
+OVERVIEW_FACTORS = (2, 4, 8, 16)
+NODATA = -1.0
+MAX_FILE_GROWTH = 2  # rewritten compressed blocks that do not fit are appended
+METERS_PER_DEGREE = 111320.0
+
+READINGS_QUERY = """
+    SELECT id, ST_X(geom), ST_Y(geom), co_level, pm25_level, no2_level, nh3_level
+    FROM air_quality
+    WHERE geom IS NOT NULL AND coalesce(time_received, updated_at) > %s;
+"""
+
+EXPIRED_QUERY = """
+    SELECT ST_X(geom), ST_Y(geom)
+    FROM air_quality
+    WHERE geom IS NOT NULL AND coalesce(time_received, updated_at) > %s
+      AND coalesce(time_received, updated_at) <= %s;
+"""
+
+
+class Surface:
+    def __init__(self, bbox=None, resolution=None):
+        west, south, east, north = bbox or surface_bbox
+        resolution = resolution or surface_resolution
+        # Cells are square in metres at the centre latitude
+        self.scale = math.cos(math.radians((south + north) / 2))
+        self.dy = resolution / METERS_PER_DEGREE
+        self.dx = self.dy / self.scale
+        self.west, self.north = west, north
+        self.width = math.ceil((east - west) / self.dx)
+        self.height = math.ceil((north - south) / self.dy)
+        self.transform = from_origin(west, north, self.dx, self.dy)
+        self.values = np.full((len(BANDS), self.height, self.width), np.nan, dtype=np.float32)
+        self.last_id = None  # None until the first full computation
+        self.window_start = None
+        self.written_size = None  # bytes of the file when last written in full
+
+    def to_meters(self, lon, lat):
+        # Local equirectangular coordinates, accurate enough across a city
+        return np.column_stack(((np.asarray(lon) - self.west) * self.scale * METERS_PER_DEGREE,
+                                (self.north - np.asarray(lat)) * METERS_PER_DEGREE))
+
+    def cells(self, lon, lat):
+        # Row and column of each point, and whether it lies on the grid
+        rows = np.floor((self.north - np.asarray(lat, dtype=float)) / self.dy).astype(np.int64)
+        cols = np.floor((np.asarray(lon, dtype=float) - self.west) / self.dx).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        return rows, cols, inside
+
+    def sample(self, lon, lat):
+        # (bands, points) values at the given points, NaN off the grid or
+        # where no reading is close enough
+        rows, cols, inside = self.cells(lon, lat)
+        samples = np.full((len(BANDS), len(rows)), np.nan, dtype=np.float32)
+        samples[:, inside] = self.values[:, rows[inside], cols[inside]]
+        return samples
+
+    def tiles_near(self, lon, lat):
+        # Tiles with a cell within the maximum distance of any point
+        reach_rows = math.ceil(surface_max_distance / METERS_PER_DEGREE / self.dy)
+        reach_cols = math.ceil(surface_max_distance / METERS_PER_DEGREE / self.scale / self.dx)
+        rows, cols, _ = self.cells(lon, lat)
+        tiles = set()
+        for row, col in zip(rows.tolist(), cols.tolist()):
+            first_row = max(row - reach_rows, 0) // TILE_SIZE
+            last_row = min(row + reach_rows, self.height - 1) // TILE_SIZE
+            first_col = max(col - reach_cols, 0) // TILE_SIZE
+            last_col = min(col + reach_cols, self.width - 1) // TILE_SIZE
+            for tile_row in range(first_row, last_row + 1):
+                for tile_col in range(first_col, last_col + 1):
+                    tiles.add((tile_row, tile_col))
+        return tiles
+
+    def all_tiles(self):
+        return {(tile_row, tile_col)
+                for tile_row in range(math.ceil(self.height / TILE_SIZE))
+                for tile_col in range(math.ceil(self.width / TILE_SIZE))}
+
+    def tile_window(self, tile):
+        tile_row, tile_col = tile
+        row, col = tile_row * TILE_SIZE, tile_col * TILE_SIZE
+        return row, min(row + TILE_SIZE, self.height), col, min(col + TILE_SIZE, self.width)
+
+    def tile_bounds(self, tile):
+        # (west, south, east, north) of a tile in degrees
+        row0, row1, col0, col1 = self.tile_window(tile)
+        return (self.west + col0 * self.dx, self.north - row1 * self.dy,
+                self.west + col1 * self.dx, self.north - row0 * self.dy)
+
+    def interpolate(self, tile, tree, readings):
+        row0, row1, col0, col1 = self.tile_window(tile)
+        rows, cols = np.mgrid[row0:row1, col0:col1]
+        centres = np.column_stack((((cols.ravel() + 0.5) * self.dx) * self.scale * METERS_PER_DEGREE,
+                                   ((rows.ravel() + 0.5) * self.dy) * METERS_PER_DEGREE))
+        k = min(surface_neighbours, len(readings))
+        distances, neighbours = tree.query(centres, k=k, distance_upper_bound=surface_max_distance)
+        distances = distances.reshape(len(centres), k)
+        neighbours = neighbours.reshape(len(centres), k)
+        found = np.isfinite(distances)
+        weights = np.where(found, 1 / np.maximum(distances, MIN_DISTANCE) ** IDW_POWER, 0)
+        total = weights.sum(axis=1)
+        # Missing neighbours are reported as index len(readings)
+        values = readings[np.minimum(neighbours, len(readings) - 1)]  # (cells, k, bands)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tile_values = np.einsum('ck,ckb->bc', weights, values) / total
+        self.values[:, row0:row1, col0:col1] = tile_values.reshape(len(BANDS), row1 - row0, col1 - col0)
+
+    def update(self, conn):
+        # Recomputes the tiles affected by readings added to or expired from
+        # the window; returns them (empty if nothing changed)
+        window_start = datetime.now(timezone.utc) - timedelta(hours=surface_window_hours)
+        with conn.cursor() as cur:
+            cur.execute(READINGS_QUERY, (window_start,))
+            rows = cur.fetchall()
+            expired = []
+            if self.window_start is not None:
+                cur.execute(EXPIRED_QUERY, (self.window_start, window_start))
+                expired = cur.fetchall()
+        conn.commit()
+
+        data = np.array([row[1:] for row in rows], dtype=float).reshape(len(rows), 2 + len(BANDS))
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        if self.last_id is None:
+            tiles = self.all_tiles()
+        else:
+            added = data[ids > self.last_id]
+            tiles = self.tiles_near(added[:, 0], added[:, 1])
+            if expired:
+                expired = np.array(expired, dtype=float)
+                tiles |= self.tiles_near(expired[:, 0], expired[:, 1])
+
+        if tiles:
+            if len(data):
+                # Readings with a missing pollutant count as that pollutant's mean
+                readings = data[:, 2:]
+                readings = np.where(np.isnan(readings), np.nanmean(readings, axis=0), readings)
+                tree = cKDTree(self.to_meters(data[:, 0], data[:, 1]))
+                for tile in tiles:
+                    self.interpolate(tile, tree, readings)
+            else:
+                self.values[:] = np.nan
+        self.last_id = int(ids.max()) if len(ids) else (self.last_id or 0)
+        self.window_start = window_start
+        return tiles
+
+    def write(self, path=None, tiles=None):
+        # The windows of tiles into the file written before; the whole file,
+        # replaced atomically, without tiles or when it has grown too much
+        path = path or surface_path
+        if (tiles is not None and self.written_size is not None and os.path.exists(path)
+                and os.path.getsize(path) <= MAX_FILE_GROWTH * self.written_size):
+            self.write_tiles(path, tiles)
+            return
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        profile = {
+            'driver': 'GTiff', 'width': self.width, 'height': self.height, 'count': len(BANDS),
+            'dtype': 'float32', 'crs': 'EPSG:4326', 'transform': self.transform, 'nodata': NODATA,
+            'tiled': True, 'blockxsize': TILE_SIZE, 'blockysize': TILE_SIZE,
+            'compress': 'deflate', 'predictor': 3
+        }
+        with rasterio.open(path + '.tmp', 'w', **profile) as dst:
+            dst.write(np.where(np.isnan(self.values), NODATA, self.values).astype(np.float32))
+            dst.build_overviews(OVERVIEW_FACTORS, Resampling.average)
+            dst.update_tags(ns='rio_overview', resampling='average')
+            dst.update_tags(last_id=self.last_id, window_start=self.window_start.isoformat())
+            for band, name in enumerate(BANDS, start=1):
+                dst.set_band_description(band, f"{name}_level")
+        os.replace(path + '.tmp', path)
+        self.written_size = os.path.getsize(path)
+
+    def write_tiles(self, path, tiles):
+        with rasterio.open(path, 'r+') as dst:
+            for tile in tiles:
+                row0, row1, col0, col1 = self.tile_window(tile)
+                values = self.values[:, row0:row1, col0:col1]
+                dst.write(np.where(np.isnan(values), NODATA, values).astype(np.float32),
+                          window=Window(col0, row0, col1 - col0, row1 - row0))
+            # GDAL regenerates the overviews from the base, which it reads
+            # uncompressed; the compressed tiles left alone are not rewritten
+            dst.build_overviews(OVERVIEW_FACTORS, Resampling.average)
+            dst.update_tags(last_id=self.last_id, window_start=self.window_start.isoformat())
+
+
+def load_surface(path=None):
+    # The surface in the GeoTIFF if it matches the configured grid, an
+    # empty one (computed in full by the first update) otherwise
+    path = path or surface_path
+    surface = Surface()
+    if not os.path.exists(path):
+        return surface
+    try:
+        with rasterio.open(path) as src:
+            tags = src.tags()
+            if (src.width, src.height) != (surface.width, surface.height) \
+                    or not src.transform.almost_equals(surface.transform) or 'last_id' not in tags:
+                logging.info(f"Surface {path} does not match the configured grid, recomputing")
+                return surface
+            values = src.read().astype(np.float32)
+        surface.values = np.where(values == NODATA, np.nan, values)
+        surface.last_id = int(tags['last_id'])
+        surface.written_size = os.path.getsize(path)
+        surface.window_start = datetime.fromisoformat(tags['window_start'])
+        logging.info(f"Loaded surface {path} up to air_quality id {surface.last_id}")
+    except RasterioIOError as e:
+        logging.error(f"Could not read surface {path}, recomputing: {e}")
+    return surface
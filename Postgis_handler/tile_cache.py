@@ -0,0 +1,149 @@
+import logging
+import math
+import os
+from geoserver import gwc_request
+
+# Keeps GeoWebCache in step with the segment levels.
+#
+# After a recompute, the bounding boxes of the changed segments are snapped
+# to a grid of MERGE_CELL_DEGREES cells and merged into at most
+# MAX_RECTANGLES rectangles. Each rectangle is sent to GWC as a reseed of
+# the low zoom levels (up to GWC_RESEED_MAX_ZOOM), where few tiles cover
+# it, and a truncate of the zooms above, which are rendered again on the
+# next request. At startup
+# the whole layer is seeded up to GWC_WARM_ZOOM, which leaves tiles that
+# are already cached alone.
+
+gwc_layers = [layer for layer in os.getenv('GWC_LAYERS', 'bremen:highway-bremen').split(',') if layer]
+gwc_gridsets = [gridset for gridset in os.getenv('GWC_GRIDSETS', 'EPSG:4326,EPSG:900913').split(',') if gridset]
+gwc_format = os.getenv('GWC_FORMAT', 'image/png')
+gwc_max_zoom = int(os.getenv('GWC_MAX_ZOOM', '20'))
+gwc_reseed_max_zoom = int(os.getenv('GWC_RESEED_MAX_ZOOM', '14'))
+gwc_warm_zoom = int(os.getenv('GWC_WARM_ZOOM', '12'))  # -1 disables the startup seed
+gwc_threads = int(os.getenv('GWC_THREADS', '2'))
+MERGE_CELL_DEGREES = 0.01  # about 1 km
+MAX_RECTANGLES = 20  # GWC seed tasks per layer, gridset and kind
+MERGE_CANDIDATES = 100  # rectangles compared pairwise when merging down to MAX_RECTANGLES
+
+# EPSG:4326 level 0 is two tiles wide, so its levels are one below the
+# Web Mercator levels at the same scale
+GRIDSET_ZOOM_OFFSET = {'EPSG:4326': -1}
+MERCATOR_GRIDSETS = ('EPSG:900913', 'EPSG:3857')
+MERCATOR_RADIUS = 6378137.0
+
+
+def cell_rectangles(cells):
+    # Grid cells as (first row, last row, first column, last column)
+    # rectangles: runs of adjacent cells in a row, then runs of rows with
+    # the same columns
+    runs = []
+    for j, i in sorted(cells):
+        if runs and runs[-1][0] == j and runs[-1][2] == i - 1:
+            runs[-1][2] = i
+        else:
+            runs.append([j, i, i])
+    rectangles = []
+    open_rectangles = {}  # (first column, last column) -> rectangle ending in the previous row
+    for j, i0, i1 in runs:
+        rectangle = open_rectangles.get((i0, i1))
+        if rectangle is not None and rectangle[1] == j - 1:
+            rectangle[1] = j
+        else:
+            rectangle = [j, j, i0, i1]
+            open_rectangles[(i0, i1)] = rectangle
+            rectangles.append(rectangle)
+    return [tuple(rectangle) for rectangle in rectangles]
+
+
+def merge_closest(rectangles, count):
+    # Merges the pair of rectangles whose bbox adds the least area, until
+    # count are left
+    def area(r):
+        return (r[1] - r[0] + 1) * (r[3] - r[2] + 1)
+
+    def union(a, b):
+        return (min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3]))
+
+    rectangles = list(rectangles)
+    while len(rectangles) > count:
+        _, a, b = min((area(union(a, b)) - area(a) - area(b), x, y)
+                      for x, a in enumerate(rectangles) for y, b in enumerate(rectangles[:x]))
+        merged = union(rectangles[a], rectangles[b])
+        rectangles = [r for x, r in enumerate(rectangles) if x not in (a, b)] + [merged]
+    return rectangles
+
+
+def merge_boxes(boxes):
+    # (west, south, east, north) boxes as a few grid-aligned rectangles.
+    # Beyond MAX_RECTANGLES the cells are doubled in size until at most
+    # MERGE_CANDIDATES rectangles are left, and the closest of those are
+    # merged, so a scattered update becomes a few rectangles around groups
+    # of changes rather than one around all of them.
+    cells = set()
+    for west, south, east, north in boxes:
+        for i in range(math.floor(west / MERGE_CELL_DEGREES), math.floor(east / MERGE_CELL_DEGREES) + 1):
+            for j in range(math.floor(south / MERGE_CELL_DEGREES), math.floor(north / MERGE_CELL_DEGREES) + 1):
+                cells.add((j, i))
+    scale = 1
+    rectangles = cell_rectangles(cells)
+    while len(rectangles) > MERGE_CANDIDATES:
+        scale *= 2
+        rectangles = cell_rectangles({(j // scale, i // scale) for j, i in cells})
+    rectangles = merge_closest(rectangles, MAX_RECTANGLES)
+    size = scale * MERGE_CELL_DEGREES
+    return [(i0 * size, j0 * size, (i1 + 1) * size, (j1 + 1) * size)
+            for j0, j1, i0, i1 in rectangles]
+
+
+def gridset_bounds(bbox, gridset):
+    # Seed request bounds are in the gridset's CRS
+    if gridset not in MERCATOR_GRIDSETS:
+        return list(bbox)
+    west, south, east, north = bbox
+
+    def y(lat):
+        return MERCATOR_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+    return [MERCATOR_RADIUS * math.radians(west), y(south), MERCATOR_RADIUS * math.radians(east), y(north)]
+
+
+def seed_request(layer, gridset, kind, zoom_start, zoom_stop, bbox=None):
+    # kind is 'seed' (missing tiles), 'reseed' (all tiles) or 'truncate'
+    offset = GRIDSET_ZOOM_OFFSET.get(gridset, 0)
+    zoom_start, zoom_stop = max(zoom_start + offset, 0), zoom_stop + offset
+    if zoom_stop < zoom_start:
+        return
+    request = {
+        'name': layer, 'gridSetId': gridset, 'format': gwc_format, 'type': kind,
+        'zoomStart': zoom_start, 'zoomStop': zoom_stop, 'threadCount': gwc_threads
+    }
+    if bbox is not None:
+        request['bounds'] = {'coords': {'double': gridset_bounds(bbox, gridset)}}
+    gwc_request('POST', f"seed/{layer}.json", json={'seedRequest': request})
+
+
+def refresh_tiles(boxes, layers=None):
+    # Reseeds and truncates the cached tiles of layers over the boxes;
+    # returns the rectangles sent
+    rectangles = merge_boxes(boxes)
+    for layer in layers or gwc_layers:
+        for gridset in gwc_gridsets:
+            for bbox in rectangles:
+                seed_request(layer, gridset, 'reseed', 0, gwc_reseed_max_zoom, bbox)
+                seed_request(layer, gridset, 'truncate', gwc_reseed_max_zoom + 1, gwc_max_zoom, bbox)
+    return rectangles
+
+
+def truncate_layers(layers=None):
+    # Every cached tile, after all levels were reset
+    for layer in layers or gwc_layers:
+        for gridset in gwc_gridsets:
+            seed_request(layer, gridset, 'truncate', 0, gwc_max_zoom)
+
+
+def warm_seed(layers=None):
+    if gwc_warm_zoom < 0:
+        return
+    for layer in layers or gwc_layers:
+        for gridset in gwc_gridsets:
+            seed_request(layer, gridset, 'seed', 0, gwc_warm_zoom)
+    logging.info(f"Requested a warm seed of {', '.join(layers or gwc_layers)} up to zoom {gwc_warm_zoom}")
@@ -1,14 +1,26 @@
+import argparse
 import paho.mqtt.client as mqtt
 import json
 import base64
+import multiprocessing
 import psycopg2
+import psycopg2.extras
+import signal
 import struct
+import threading
 import time
 import logging
 import os
+import zlib
+from collections import namedtuple
+from metrics import (MQTT_DECODE_SECONDS, MQTT_INSERT_SECONDS, MQTT_MESSAGES, SPOOL_REPLAYED,
+                     log_sampled, start_metrics_server)
+from profiling import LoopProfiler, add_profile_arguments, loop_profiler
+from dedup import RecentKeys, uplink_key
+from spool import Spool, read_segment, spool_dir
 
 logging.basicConfig(
-    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s - %(levelname)s - %(message)s')
 
 # PostgreSQL database credentials
 db_name = os.getenv('DB_NAME', 'default_db_name')
@@ -16,6 +28,32 @@ db_user = os.getenv('DB_USER', 'default_user')
 db_password = os.getenv('DB_PASSWORD', 'default_password')
 db_host = os.getenv('DB_HOST', 'localhost')
 db_port = os.getenv('DB_PORT', '5432')
+db_connect_timeout = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))  # seconds
+
+# How often the spool drainer retries while the database is down
+spool_retry_seconds = float(os.getenv('SPOOL_RETRY_SECONDS', '5'))
+
+# Keys of the stored uplinks outlive their readings, which graphql_helper.py
+# deletes once they are matched; a redelivery is dropped while its key is
+# kept, UPLINK_KEY_RETENTION_HOURS after it was first stored
+uplink_key_retention_hours = float(os.getenv('UPLINK_KEY_RETENTION_HOURS', '168'))
+UPLINK_KEY_PRUNE_SECONDS = 3600
+uplink_keys_pruned_at = None
+
+NEW_UPLINK_KEYS_QUERY = """
+    INSERT INTO uplink_keys (uplink_key)
+    SELECT unnest(%s::text[])
+    ON CONFLICT DO NOTHING
+    RETURNING uplink_key;
+"""
+
+# uplink_key and reading_index identify a reading across TTN redeliveries
+INSERT_QUERY = """
+    INSERT INTO raw_data_2 (device_id, time_received, co_level, pm25_level, no2_level, nh3_level, latitude, longitude,
+                            uplink_key, reading_index)
+    VALUES %s
+    ON CONFLICT DO NOTHING;
+"""
 
 
 def connect_to_database(attempts=5, delay=5):
@@ -26,7 +64,8 @@ def connect_to_database(attempts=5, delay=5):
                 user=db_user,
                 password=db_password,
                 host=db_host,
-                port=db_port
+                port=db_port,
+                connect_timeout=db_connect_timeout
             )
             print("Database connection established")
             logging.info("Database connection established")
@@ -38,9 +77,12 @@ def connect_to_database(attempts=5, delay=5):
     raise Exception("Unable to connect to the database after multiple attempts")
 
 
-# Use the function to connect
-conn = connect_to_database()
-cursor = conn.cursor()
+# Connected in main(); while the database is unavailable readings go to the
+# spool and the drainer thread writes them once it is back
+conn = None
+db_available = False
+spool = None
+recent_uplinks = RecentKeys()
 
 # MQTT setup
 application_id = os.getenv('APPLICATION_ID', 'default_application_id')
@@ -50,23 +92,186 @@ mqtt_server = os.getenv('MQTT_SERVER', 'default_mqtt_server')
 
 mqtt_username = f"{application_id}@{tenant_id}"
 mqtt_topic = f"v3/{application_id}@{tenant_id}/devices/+/up"
+# With a broker that supports MQTT 5 shared subscriptions, consumers started
+# with the same group split the uplinks between them
+mqtt_share_group = os.getenv('MQTT_SHARE_GROUP')
+
+# --workers: uplinks queued per worker before the MQTT reader blocks
+worker_queue_size = int(os.getenv('WORKER_QUEUE_SIZE', '10000'))
+
+# Worker i serves metrics on the reader's port + 10 + i, clear of the
+# other services' ports
+WORKER_METRICS_OFFSET = 10
+
+# Message handed from the MQTT reader to a worker process
+Uplink = namedtuple('Uplink', ['topic', 'payload'])
+
+# Replaced in main() once the command line is parsed
+profiler = LoopProfiler('ttn')
 
 
 def on_connect(client, userdata, flags, rc):
     logging.info("Connected with result code " + str(rc))
-    client.subscribe(mqtt_topic)
+    if mqtt_share_group:
+        client.subscribe(f"$share/{mqtt_share_group}/{mqtt_topic}")
+    else:
+        client.subscribe(mqtt_topic)
 
 
-def on_message(client, userdata, msg):
-    print(f"Message received on topic {msg.topic}")
+def ensure_uplink_keys(connection):
+    with connection.cursor() as cur:
+        cur.execute("""
+            ALTER TABLE raw_data_2
+                ADD COLUMN IF NOT EXISTS uplink_key TEXT,
+                ADD COLUMN IF NOT EXISTS reading_index SMALLINT;
+            CREATE UNIQUE INDEX IF NOT EXISTS raw_data_2_uplink_key
+                ON raw_data_2 (uplink_key, reading_index);
+            CREATE TABLE IF NOT EXISTS uplink_keys (
+                uplink_key TEXT PRIMARY KEY,
+                stored_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            CREATE INDEX IF NOT EXISTS uplink_keys_stored_at ON uplink_keys (stored_at);
+        """)
+    connection.commit()
+
+
+def reconnect():
+    # Single attempt, for use while the service keeps running on the spool
+    connection = connect_to_database(attempts=1, delay=0)
+    ensure_uplink_keys(connection)
+    return connection
+
+
+def open_storage(spool_directory=None):
+    # Spool and, if the database is reachable, the direct connection
+    global conn, db_available, spool
+    spool = Spool(spool_directory)
+    try:
+        conn = connect_to_database()
+        ensure_uplink_keys(conn)
+        db_available = True
+    except Exception as e:
+        logging.error(f"Starting without a database, readings are spooled: {e}")
+
+
+def start_drainer():
+    stop = threading.Event()
+    drainer = threading.Thread(target=drain_spool, args=(stop,), daemon=True)
+    drainer.start()
+    return stop, drainer
+
+
+def close_storage(stop_draining, drainer):
+    # Lets the drainer finish its current segment; whatever is still spooled
+    # is replayed at the next start
+    stop_draining.set()
+    drainer.join()
+    spool.close()
+    if conn is not None:
+        close_quietly(conn)
+
+
+def insert_readings(connection, rows):
+    # Only the readings of uplinks whose key is new are inserted, in the
+    # same transaction as their keys; returns how many
+    global uplink_keys_pruned_at
+    with connection.cursor() as cur:
+        cur.execute(NEW_UPLINK_KEYS_QUERY, (list({row[8] for row in rows}),))
+        new_keys = {key for key, in cur.fetchall()}
+        rows = [row for row in rows if row[8] in new_keys]
+        if rows:
+            psycopg2.extras.execute_values(cur, INSERT_QUERY, rows, page_size=1000)
+        if uplink_keys_pruned_at is None or time.monotonic() - uplink_keys_pruned_at > UPLINK_KEY_PRUNE_SECONDS:
+            cur.execute("DELETE FROM uplink_keys WHERE stored_at < now() - %s * interval '1 hour';",
+                        (uplink_key_retention_hours,))
+            uplink_keys_pruned_at = time.monotonic()
+    connection.commit()
+    return len(rows)
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except psycopg2.Error:
+        pass
+
+
+def store_readings(rows):
+    # Writes straight to the database while it is up and nothing is spooled,
+    # so replayed readings are never overtaken; spools otherwise
+    global conn, db_available
+    if not db_available and not spool.pending():
+        # The drainer emptied the spool, so the database is reachable again
+        try:
+            conn = reconnect()
+            db_available = True
+        except Exception:
+            pass
+    if db_available and not spool.pending():
+        try:
+            if not insert_readings(conn, rows):
+                return 'duplicate'  # stored before the dedup window
+            return 'stored'
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            logging.error(f"Database unavailable, spooling readings: {e}")
+            db_available = False
+            close_quietly(conn)
+        except psycopg2.Error as e:
+            logging.error(f"Error inserting data: {e}")
+            conn.rollback()
+            return 'failed'
+    spool.append(rows)
+    return 'spooled'
+
+
+def drain_spool(stop):
+    # Replays spooled segments in bulk, oldest first, on its own connection
+    drain_conn = None
+    while not stop.is_set():
+        if not spool.ready.wait(timeout=1):
+            continue
+        path = spool.oldest()
+        if path is None:
+            continue
+        try:
+            rows = read_segment(path)
+        except FileNotFoundError:
+            continue  # dropped by the size limit meanwhile
+        try:
+            if drain_conn is None or drain_conn.closed:
+                drain_conn = reconnect()
+            insert_readings(drain_conn, [tuple(row) for row in rows])
+        except Exception as e:
+            logging.warning(f"Spool replay failed, retrying in {spool_retry_seconds:.0f}s: {e}")
+            if drain_conn is not None:
+                close_quietly(drain_conn)
+                drain_conn = None
+            stop.wait(spool_retry_seconds)
+            continue
+        spool.remove(path)
+        SPOOL_REPLAYED.inc(len(rows))
+        logging.info(f"Replayed {len(rows)} spooled readings from {path}")
+    if drain_conn is not None:
+        drain_conn.close()
+
+
+def handle_message(msg):
+    decode_started = time.perf_counter()
     payload = json.loads(msg.payload)
 
+    # Redelivered copies are dropped before any decoding or database work
+    key = uplink_key(payload)
+    if not recent_uplinks.add(key):
+        MQTT_MESSAGES.labels('duplicate').inc()
+        return
+
     device_id = payload['end_device_ids']['device_id']
     time_received = payload['received_at']
     frm_payload = payload['uplink_message']['frm_payload']
     decoded_payload = base64.b64decode(frm_payload)
 
-    print("Length of decoded payload: ", len(decoded_payload))
+    if log_sampled():
+        logging.debug(f"Message received on topic {msg.topic}, payload length {len(decoded_payload)}")
 
     if len(decoded_payload) == 56:  # Expected length
         try:
@@ -78,39 +283,134 @@ def on_message(client, userdata, msg):
             # Extract air quality data and GPS coordinates
             air_quality_data = unpacked_data[:24]  # First 24 values (6 sets of 4 values each)
             gps_coords = unpacked_data[24:]  # Last 2 values (latitude, longitude)
+            MQTT_DECODE_SECONDS.observe(time.perf_counter() - decode_started)
 
-            # Process and insert each set of air quality data into the database
+            # Insert the six sets of air quality data in one statement
+            latitude, longitude = gps_coords
+            rows = []
             for i in range(0, len(air_quality_data), 4):
                 co_level, pm25_level, no2_level, nh3_level = air_quality_data[i:i+4]
-                latitude, longitude = gps_coords
-                print(f"Device ID: {device_id}, Time: {time_received}, CO: {co_level}, PM2.5: {pm25_level}, NO2: {no2_level}, NH3: {nh3_level}, Lat: {latitude}, Long: {longitude}")
-                logging.info(f"Device ID: {device_id}, Time: {time_received}, CO: {co_level}, PM2.5: {pm25_level}, NO2: {no2_level}, NH3: {nh3_level}, Lat: {longitude}, Long: {latitude}")
-                # Insert data into the PostgreSQL database
-                try:
-                    insert_query = "INSERT INTO raw_data_2 (device_id, time_received, co_level, pm25_level, no2_level, nh3_level, latitude, longitude) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
-                    cursor.execute(insert_query, (device_id, time_received, co_level, pm25_level, no2_level, nh3_level, longitude, latitude))
-                    conn.commit()
-                except Exception as e:
-                    print("Error inserting data:", e)
-                    conn.rollback()
+                if log_sampled():
+                    logging.debug(f"Device ID: {device_id}, Time: {time_received}, CO: {co_level}, PM2.5: {pm25_level}, NO2: {no2_level}, NH3: {nh3_level}, Lat: {longitude}, Long: {latitude}")
+                rows.append((device_id, time_received, co_level, pm25_level, no2_level, nh3_level, longitude, latitude,
+                             key, i // 4))
+            with MQTT_INSERT_SECONDS.time():
+                outcome = store_readings(rows)
+            if outcome == 'failed':
+                recent_uplinks.forget(key)
+            MQTT_MESSAGES.labels(outcome).inc()
 
         except struct.error as e:
-            print("Unpacking error:", e)
+            logging.error(f"Unpacking error: {e}")
+            MQTT_MESSAGES.labels('malformed').inc()
     else:
-        print("Unexpected payload length")
+        logging.warning(f"Unexpected payload length {len(decoded_payload)} on topic {msg.topic}")
+        MQTT_MESSAGES.labels('malformed').inc()
+
+
+def on_message(client, userdata, msg):
+    with profiler.cycle():
+        handle_message(msg)
+    if profiler.done:
+        client.disconnect()  # --profile-cycles reached, leave loop_forever
+
 
+def device_partition(topic, workers):
+    # v3/{application}@{tenant}/devices/{device_id}/up; every uplink of a
+    # device goes to the same worker, so it is stored in order and its
+    # redeliveries meet the same dedup window
+    return zlib.crc32(topic.split('/')[3].encode()) % workers
 
-client = mqtt.Client()
-client.username_pw_set(mqtt_username, access_key)
 
-client.on_connect = on_connect
-client.on_message = on_message
+def fan_out(client, queues, msg):
+    queues[device_partition(msg.topic, len(queues))].put(Uplink(msg.topic, msg.payload))
 
-client.connect(mqtt_server, 1883, 60)
 
-try:
-    client.loop_forever()
-except KeyboardInterrupt:
+def wait_for_profiles(client, profiled):
+    # --profile-cycles with workers: stop reading once every worker has
+    # written its profile; the workers then exit like on Ctrl-C
+    for event in profiled:
+        event.wait()
     client.disconnect()
-    cursor.close()
-    conn.close()
+
+
+def run_worker(index, queue, args, profiled=None):
+    global profiler
+    # The reader owns shutdown and sends None once it has stopped reading.
+    # A worker that has profiled its --profile-cycles uplinks sets profiled
+    # and keeps storing, so that the reader never blocks on its queue.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    profiler = loop_profiler(f'ttn-{index}', args)
+    start_metrics_server(9101, offset=WORKER_METRICS_OFFSET + index)
+
+    open_storage(os.path.join(spool_dir, f'worker-{index}'))
+    stop_draining, drainer = start_drainer()
+    try:
+        while True:
+            uplink = queue.get()
+            if uplink is None:
+                break
+            with profiler.cycle():
+                handle_message(uplink)
+            if profiler.done and profiled is not None and not profiled.is_set():
+                profiled.set()
+    finally:
+        close_storage(stop_draining, drainer)
+        logging.info(f"Worker {index} stopped")
+
+
+def main():
+    global profiler
+    parser = argparse.ArgumentParser(description="Store TTN uplinks in raw_data_2")
+    add_profile_arguments(parser)
+    parser.add_argument('--workers', type=int, default=int(os.getenv('TTN_WORKERS', '1')),
+                        help="decode and store in N processes, partitioned by device")
+    args = parser.parse_args()
+
+    client = mqtt.Client()
+    client.username_pw_set(mqtt_username, access_key)
+    client.on_connect = on_connect
+
+    workers = []
+    if args.workers > 1:
+        # This process only reads from MQTT and hands each uplink to the
+        # worker that owns its device
+        queues = [multiprocessing.Queue(worker_queue_size) for _ in range(args.workers)]
+        profiled = [multiprocessing.Event() for _ in queues]
+        workers = [multiprocessing.Process(target=run_worker, args=(i, queue, args, event),
+                                           name=f'ttn-worker-{i}')
+                   for i, (queue, event) in enumerate(zip(queues, profiled))]
+        for worker in workers:
+            worker.start()
+        client.user_data_set(queues)
+        client.on_message = fan_out
+        if args.profile_cycles:
+            threading.Thread(target=wait_for_profiles, args=(client, profiled), daemon=True).start()
+    else:
+        profiler = loop_profiler('ttn', args)
+        open_storage()
+        stop_draining, drainer = start_drainer()
+        client.on_message = on_message
+    start_metrics_server(9101)
+
+    # docker stop sends SIGTERM; leave loop_forever and flush like on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: client.disconnect())
+    client.connect(mqtt_server, 1883, 60)
+
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        client.disconnect()
+    finally:
+        if workers:
+            for queue in queues:
+                queue.put(None)
+            for worker in workers:
+                worker.join()
+        else:
+            close_storage(stop_draining, drainer)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import hashlib
+import os
+import threading
+import time
+
+# Drops TTN uplinks that were already seen.
+#
+# TTN redelivers an uplink after MQTT reconnects, and the same frame can
+# arrive through more than one gateway. A copy has the same device, frame
+# counter (received_at when there is none) and payload, so those are hashed
+# into a 32-character hex key. Keys are remembered for DEDUP_WINDOW_SECONDS,
+# capped at DEDUP_MAX_KEYS so memory stays bounded (about 150 bytes per
+# key). TTN.py also stores the key in the uplink_keys table for
+# UPLINK_KEY_RETENTION_HOURS, which catches the copies that outlive the
+# window or arrive after a restart, including those of uplinks whose
+# readings graphql_helper.py has already processed and deleted.
+
+dedup_window_seconds = float(os.getenv('DEDUP_WINDOW_SECONDS', '3600'))
+dedup_max_keys = int(os.getenv('DEDUP_MAX_KEYS', '200000'))
+
+
+def uplink_key(payload):
+    uplink = payload['uplink_message']
+    counter = uplink.get('f_cnt', payload['received_at'])
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{payload['end_device_ids']['device_id']}\0{counter}\0".encode())
+    digest.update(uplink['frm_payload'].encode())
+    return digest.hexdigest()
+
+
+class RecentKeys:
+    def __init__(self, window=None, max_keys=None):
+        self.window = dedup_window_seconds if window is None else window
+        self.max_keys = max_keys or dedup_max_keys
+        self.seen = {}  # key -> time first seen, oldest first
+        self.lock = threading.Lock()
+
+    def expire(self, now):
+        # Dicts keep insertion order, so expired keys are at the front
+        while self.seen:
+            key, seen_at = next(iter(self.seen.items()))
+            if now - seen_at < self.window and len(self.seen) <= self.max_keys:
+                break
+            del self.seen[key]
+
+    def add(self, key):
+        # True if the key is new, False for a duplicate
+        now = time.monotonic()
+        with self.lock:
+            if key in self.seen:
+                return False
+            self.seen[key] = now
+            self.expire(now)
+            return True
+
+    def forget(self, key):
+        # For uplinks that could not be stored, so a redelivery is let through
+        with self.lock:
+            self.seen.pop(key, None)
@@ -0,0 +1,135 @@
+import glob
+import json
+import logging
+import os
+import threading
+from metrics import SPOOL_BYTES, SPOOL_DROPPED, SPOOL_READINGS
+
+# Append-only spool for readings that could not be written to PostgreSQL.
+#
+# Records are JSON lines (one uplink's rows per line) appended to numbered
+# segment files in SPOOL_DIR. The segment being written is rotated once it
+# reaches SPOOL_SEGMENT_BYTES, and the drainer replays and deletes whole
+# segments, oldest first, so a segment is the unit of both replay and
+# cleanup. When the spool would grow past SPOOL_MAX_BYTES the oldest
+# segment is dropped. Segments left over from a previous run are picked up
+# at startup.
+
+spool_dir = os.getenv('SPOOL_DIR', 'spool')
+spool_max_bytes = int(os.getenv('SPOOL_MAX_BYTES', str(512 * 1024 * 1024)))
+spool_segment_bytes = int(os.getenv('SPOOL_SEGMENT_BYTES', str(4 * 1024 * 1024)))
+spool_fsync = os.getenv('SPOOL_FSYNC', 'false').lower() == 'true'  # survive power loss, not just a crash
+SEGMENT_PREFIX = 'spool-'
+SEGMENT_SUFFIX = '.jsonl'
+
+
+def segment_number(path):
+    return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def read_segment(path):
+    # Rows of every complete record; a record torn by a crash mid-write is skipped
+    rows = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                logging.warning(f"Skipping incomplete record at the end of {path}")
+                break
+            try:
+                rows.extend(json.loads(line))
+            except ValueError:
+                logging.warning(f"Skipping unreadable record in {path}")
+    return rows
+
+
+class Spool:
+    def __init__(self, directory=None, max_bytes=None, segment_bytes=None):
+        self.directory = directory or spool_dir
+        self.max_bytes = max_bytes or spool_max_bytes
+        self.segment_bytes = segment_bytes or spool_segment_bytes
+        self.lock = threading.Lock()
+        self.ready = threading.Event()  # set while there is something to drain
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Closed segments, oldest first, with their size and row count
+        self.segments = []
+        for path in sorted(glob.glob(os.path.join(self.directory, f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}")),
+                           key=segment_number):
+            self.segments.append([path, os.path.getsize(path), len(read_segment(path))])
+        self.next_number = segment_number(self.segments[-1][0]) + 1 if self.segments else 1
+        self.active = None  # [path, size, rows] of the segment being written
+        self.file = None
+        if self.segments:
+            logging.info(f"Found {self.pending_rows()} spooled readings from a previous run")
+            self.ready.set()
+        self.update_gauges()
+
+    def pending_rows(self):
+        return sum(rows for _, _, rows in self.segments) + (self.active[2] if self.active else 0)
+
+    def pending(self):
+        return self.active is not None or bool(self.segments)
+
+    def total_bytes(self):
+        return sum(size for _, size, _ in self.segments) + (self.active[1] if self.active else 0)
+
+    def update_gauges(self):
+        SPOOL_READINGS.set(self.pending_rows())
+        SPOOL_BYTES.set(self.total_bytes())
+
+    def append(self, rows):
+        record = (json.dumps(rows, separators=(',', ':')) + '\n').encode()
+        with self.lock:
+            if self.active is None:
+                path = os.path.join(self.directory, f"{SEGMENT_PREFIX}{self.next_number:012d}{SEGMENT_SUFFIX}")
+                self.next_number += 1
+                self.file = open(path, 'ab')
+                self.active = [path, 0, 0]
+            self.file.write(record)
+            self.file.flush()
+            if spool_fsync:
+                os.fsync(self.file.fileno())
+            self.active[1] += len(record)
+            self.active[2] += len(rows)
+            if self.active[1] >= self.segment_bytes:
+                self.rotate()
+            self.enforce_limit()
+            self.update_gauges()
+        self.ready.set()
+
+    def rotate(self):
+        # Closes the active segment so the drainer can take it
+        if self.active is not None:
+            self.file.close()
+            self.segments.append(self.active)
+            self.active = None
+            self.file = None
+
+    def enforce_limit(self):
+        while self.total_bytes() > self.max_bytes and self.segments:
+            path, _, rows = self.segments.pop(0)
+            os.remove(path)
+            SPOOL_DROPPED.inc(rows)
+            logging.error(f"Spool is over {self.max_bytes} bytes, dropped {rows} readings in {path}")
+
+    def oldest(self):
+        # Oldest segment to replay, or None once the spool is empty
+        with self.lock:
+            if not self.segments:
+                self.rotate()
+            if not self.segments:
+                self.ready.clear()
+                return None
+            return self.segments[0][0]
+
+    def remove(self, path):
+        with self.lock:
+            # The segment may already have been dropped by enforce_limit
+            if self.segments and self.segments[0][0] == path:
+                self.segments.pop(0)
+                os.remove(path)
+            self.update_gauges()
+
+    def close(self):
+        with self.lock:
+            self.rotate()
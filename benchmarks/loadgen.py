@@ -0,0 +1,361 @@
+import argparse
+import bisect
+import contextlib
+import csv
+import json
+import math
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+import synthetic
+
+# Load generator and soak test for the ingestion pipeline.
+#
+# Simulated bikes ride back and forth along the route in Sampled_Location.csv
+# (with a random start, speed and a few metres of GPS noise) and publish TTN
+# v3 uplink JSON with the same 56-byte <24H2f> payload as the real sensors.
+# Uplinks go to an MQTT broker, or with --in-process straight into
+# TTN.on_message through the broker-less client from standins.py.
+#
+#   python benchmarks/loadgen.py --broker localhost --devices 50 --rate 100 --duration 60
+#   python benchmarks/loadgen.py --in-process --rate 0 --duration 30
+#
+# --soak starts TTN.py, graphql_helper.py and handler.py against the
+# database in DB_* and the broker (which must listen on 1883, like TTN.py
+# expects, and accept any credentials, e.g. mosquitto with allow_anonymous),
+# publishes for --duration seconds and reports the sustained throughput, the
+# growth of the raw_data_2 backlog and the p50/p99 time from uplink to
+# road-segment update. The latency is read from the handler's
+# atmos_freshness_seconds histogram, so it has the resolution of its buckets.
+# Neo4j must already hold the road graph.
+#
+#   python benchmarks/loadgen.py --broker localhost --soak --duration 900 --output soak.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRACK_PATH = os.path.join(ROOT, 'Sampled_Location.csv')
+METERS_PER_DEGREE = 111320.0
+GPS_NOISE_METERS = 4.0
+SPEED_RANGE = (3.0, 7.0)  # cycling speeds in m/s
+
+application_id = os.getenv('APPLICATION_ID', 'loadgen')
+tenant_id = os.getenv('TENANT_ID', 'ttn')
+
+# Services started by --soak: script, working directory, metrics port
+SOAK_SERVICES = [
+    ('TTN.py', 'Things_network_handler', 9101),
+    ('graphql_helper.py', 'Graphql_handler', 9102),
+    ('handler.py', 'Postgis_handler', 9103),
+]
+TTN_WORKER_METRICS_PORT = 9111  # TTN.py --workers: worker i serves on 9111 + i
+
+
+def load_track(path=TRACK_PATH):
+    # (lon, lat) points of the sampled route
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader)  # Latitude (°),Longitude (°)
+        return [(float(lon), float(lat)) for lat, lon in reader]
+
+
+class Trajectory:
+    # Rides along the track at a constant speed, turning round at both ends
+    def __init__(self, track, rng):
+        self.track = track
+        scale = math.cos(math.radians(track[0][1]))
+        self.distances = [0.0]
+        for (x0, y0), (x1, y1) in zip(track, track[1:]):
+            self.distances.append(self.distances[-1] + math.hypot(
+                (x1 - x0) * scale, y1 - y0) * METERS_PER_DEGREE)
+        self.length = self.distances[-1]
+        self.offset = rng.uniform(0, 2 * self.length)
+        self.speed = rng.uniform(*SPEED_RANGE)
+        self.rng = rng
+
+    def position(self, elapsed):
+        travelled = (self.offset + elapsed * self.speed) % (2 * self.length)
+        if travelled > self.length:
+            travelled = 2 * self.length - travelled
+        i = min(bisect.bisect_right(self.distances, travelled), len(self.track) - 1)
+        span = self.distances[i] - self.distances[i - 1]
+        t = (travelled - self.distances[i - 1]) / span if span else 0.0
+        (x0, y0), (x1, y1) = self.track[i - 1], self.track[i]
+        noise = GPS_NOISE_METERS / METERS_PER_DEGREE
+        return (x0 + (x1 - x0) * t + self.rng.gauss(0, noise),
+                y0 + (y1 - y0) * t + self.rng.gauss(0, noise))
+
+
+class Device:
+    def __init__(self, index, track, rng):
+        self.device_id = f"loadgen-bike-{index:04d}"
+        self.topic = f"v3/{application_id}@{tenant_id}/devices/{self.device_id}/up"
+        self.trajectory = Trajectory(track, rng)
+        self.levels = [rng.uniform(0, 20), rng.uniform(0, 60), rng.uniform(0, 120), rng.uniform(0, 300)]
+        self.f_cnt = 0
+        self.rng = rng
+
+    def uplink(self, elapsed):
+        # Six readings that drift a little from the previous uplink
+        levels = []
+        for _ in range(6):
+            self.levels = [max(0.0, level + self.rng.gauss(0, 1 + level * 0.05)) for level in self.levels]
+            levels.extend(min(int(level), 0xFFFF) for level in self.levels)
+        longitude, latitude = self.trajectory.position(elapsed)
+        payload = synthetic.uplink_message(
+            self.device_id, self.f_cnt, datetime.now(timezone.utc),
+            synthetic.encode_payload(levels, latitude, longitude))
+        self.f_cnt += 1
+        return self.topic, payload
+
+
+def broker_client(broker):
+    import paho.mqtt.client as mqtt
+    host, _, port = broker.partition(':')
+    client = mqtt.Client()
+    client.connect(host, int(port or 1883), 60)
+    client.loop_start()
+    return client
+
+
+def in_process_client():
+    # TTN.py's message handler behind the broker-less client; stores into
+    # the database in DB_*
+    sys.path[:0] = [os.path.join(ROOT, 'Things_network_handler'), os.path.join(ROOT, 'common')]
+    import standins
+    standins.install()
+    import TTN
+    TTN.open_storage()
+    client = standins.MQTTClient()
+    client.on_message = TTN.on_message
+    return client
+
+
+def publish(client, devices, rate, duration):
+    # Round-robins over the devices at `rate` uplinks/s (0: as fast as
+    # possible) for `duration` seconds; returns (published, elapsed, max lag)
+    started = time.perf_counter()
+    published = 0
+    max_lag = 0.0
+    while True:
+        elapsed = time.perf_counter() - started
+        if elapsed >= duration:
+            break
+        if rate:
+            due = published / rate
+            if due > elapsed:
+                time.sleep(due - elapsed)
+            else:
+                max_lag = max(max_lag, elapsed - due)
+        topic, payload = devices[published % len(devices)].uplink(elapsed)
+        client.publish(topic, payload)
+        published += 1
+    return published, time.perf_counter() - started, max_lag
+
+
+def scrape(port):
+    # Prometheus text format as {(name, labels): value}; {} if unreachable
+    try:
+        with urllib.request.urlopen(f"http://localhost:{port}/metrics", timeout=5) as response:
+            text = response.read().decode()
+    except OSError:
+        return {}
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name_labels, _, value = line.rpartition(' ')
+        name, _, labels = name_labels.partition('{')
+        samples[(name, labels.rstrip('}'))] = float(value)
+    return samples
+
+
+def counter_delta(before, after, name, labels=''):
+    return after.get((name, labels), 0.0) - before.get((name, labels), 0.0)
+
+
+def histogram_quantile(q, before, after, name):
+    # Linear interpolation inside the bucket, as PromQL's histogram_quantile
+    buckets = []
+    for (sample, labels), count in after.items():
+        if sample == f"{name}_bucket":
+            le = float(labels.split('"')[1])
+            buckets.append((le, count - before.get((sample, labels), 0.0)))
+    buckets.sort()
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    rank = q * buckets[-1][1]
+    lower, below = 0.0, 0.0
+    for le, count in buckets:
+        if count >= rank:
+            if math.isinf(le):
+                return lower
+            return lower + (le - lower) * (rank - below) / max(count - below, 1e-12)
+        lower, below = le, count
+    return lower
+
+
+def backlog(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM raw_data_2;")
+        count = cur.fetchone()[0]
+    conn.commit()
+    return count
+
+
+def growth_per_minute(samples):
+    # Least-squares slope of (seconds, rows) samples
+    if len(samples) < 2:
+        return 0.0
+    mean_t = statistics.fmean(t for t, _ in samples)
+    mean_n = statistics.fmean(n for _, n in samples)
+    variance = sum((t - mean_t) ** 2 for t, _ in samples)
+    if not variance:
+        return 0.0
+    return sum((t - mean_t) * (n - mean_n) for t, n in samples) / variance * 60
+
+
+def ttn_ports(args):
+    # The workers store the uplinks when there are any
+    if args.ttn_workers > 1:
+        return [TTN_WORKER_METRICS_PORT + i for i in range(args.ttn_workers)]
+    return [SOAK_SERVICES[0][2]]
+
+
+def metrics_ports(args):
+    return ttn_ports(args) + [port for _, _, port in SOAK_SERVICES[1:]]
+
+
+def start_services(args):
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, 'common'),
+               APPLICATION_ID=application_id, TENANT_ID=tenant_id,
+               MQTT_SERVER=args.broker.partition(':')[0])
+    processes = []
+    for script, directory, _ in SOAK_SERVICES:
+        command = [sys.executable, script]
+        if script == 'TTN.py':
+            command += ['--workers', str(args.ttn_workers)]
+        processes.append(subprocess.Popen(command, cwd=os.path.join(ROOT, directory), env=env))
+    return processes
+
+
+def stop_services(processes):
+    for process in processes:
+        process.send_signal(signal.SIGTERM)
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def soak(args, client, devices):
+    import psycopg2
+    conn = psycopg2.connect(
+        dbname=os.getenv('DB_NAME', 'default_db_name'), user=os.getenv('DB_USER', 'default_user'),
+        password=os.getenv('DB_PASSWORD', 'default_password'),
+        host=os.getenv('DB_HOST', 'localhost'), port=os.getenv('DB_PORT', '5432'))
+    processes = start_services(args)
+    try:
+        time.sleep(args.warmup)
+        ports = metrics_ports(args)
+        before = {port: scrape(port) for port in ports}
+        samples = [(0.0, backlog(conn))]
+        started = time.monotonic()
+        published = 0
+        max_lag = 0.0
+        # Publish in slices so the backlog can be sampled in between
+        while time.monotonic() - started < args.duration:
+            slice_seconds = min(args.sample_interval, args.duration - (time.monotonic() - started))
+            count, _, lag = publish(client, devices, args.rate, slice_seconds)
+            published += count
+            max_lag = max(max_lag, lag)
+            samples.append((time.monotonic() - started, backlog(conn)))
+        elapsed = time.monotonic() - started
+        after = {port: scrape(port) for port in ports}
+    finally:
+        stop_services(processes)
+        conn.close()
+
+    _, helper, handler = (port for _, _, port in SOAK_SERVICES)
+    stored = sum(counter_delta(before[port], after[port], 'atmos_mqtt_messages_total', 'outcome="stored"')
+                 for port in ttn_ports(args))
+    return {
+        'published': published,
+        'published_per_s': published / elapsed,
+        'max_publish_lag_s': max_lag,
+        'stored_uplinks_per_s': stored / elapsed,
+        'segments_processed_per_s': counter_delta(
+            before[helper], after[helper], 'atmos_segments_processed_total') / elapsed,
+        'backlog_rows': {'start': samples[0][1], 'end': samples[-1][1],
+                         'max': max(n for _, n in samples),
+                         'growth_per_minute': growth_per_minute(samples)},
+        'uplink_to_segment_seconds': {
+            'p50': histogram_quantile(0.5, before[handler], after[handler], 'atmos_freshness_seconds'),
+            'p99': histogram_quantile(0.99, before[handler], after[handler], 'atmos_freshness_seconds')
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish synthetic TTN uplinks along Sampled_Location.csv")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--broker', help="MQTT broker as host[:port]")
+    target.add_argument('--in-process', action='store_true',
+                        help="deliver to TTN.on_message in this process instead of a broker")
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=20, help="uplinks per second in total, 0 for unthrottled")
+    parser.add_argument('--duration', type=float, default=60, help="seconds to publish for")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--soak', action='store_true', help="also run the pipeline services and report on them")
+    parser.add_argument('--ttn-workers', type=int, default=1, help="--workers for TTN.py in --soak")
+    parser.add_argument('--warmup', type=float, default=10, help="seconds for the services to start in --soak")
+    parser.add_argument('--sample-interval', type=float, default=15, help="seconds between backlog samples")
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+    if args.soak and not args.broker:
+        parser.error("--soak needs --broker")
+
+    rng = random.Random(args.seed)
+    track = load_track()
+    devices = [Device(i, track, rng) for i in range(args.devices)]
+
+    # The services print per message; keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        client = broker_client(args.broker) if args.broker else in_process_client()
+        if args.soak:
+            results = soak(args, client, devices)
+        else:
+            published, elapsed, max_lag = publish(client, devices, args.rate, args.duration)
+            results = {'published': published, 'published_per_s': published / elapsed,
+                       'max_publish_lag_s': max_lag}
+        if args.broker:
+            client.loop_stop()
+            client.disconnect()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'target': args.broker or 'in-process',
+            'devices': args.devices,
+            'rate': args.rate,
+            'duration': args.duration,
+            'ttn_workers': args.ttn_workers if args.soak else None,
+            'seed': args.seed
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+import psycopg2.extras
+
+import standins
+import synthetic
+
+# Benchmarks for the ingestion, processing and routing hot paths.
+#
+# A disposable database is created on the PostgreSQL server given by the
+# BENCH_DB_* variables (it needs PostGIS), filled with a synthetic road
+# network and dropped again at the end. Neo4j and MQTT are replaced by the
+# in-memory stand-ins from standins.py.
+#
+#   python benchmarks/run.py --grid 80 --devices 20 --uplinks 50 --output bench.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICE_DIRS = ['Things_network_handler', 'Graphql_handler', 'Postgis_handler', 'common']
+
+bench_db_host = os.getenv('BENCH_DB_HOST', 'localhost')
+bench_db_port = os.getenv('BENCH_DB_PORT', '5432')
+bench_db_user = os.getenv('BENCH_DB_USER', 'postgres')
+bench_db_password = os.getenv('BENCH_DB_PASSWORD', 'postgres')
+bench_db_admin = os.getenv('BENCH_DB_ADMIN_DB', 'postgres')
+
+
+def admin_connection():
+    conn = psycopg2.connect(
+        dbname=bench_db_admin, user=bench_db_user, password=bench_db_password,
+        host=bench_db_host, port=bench_db_port)
+    conn.autocommit = True
+    return conn
+
+
+def create_database(name):
+    conn = admin_connection()
+    with conn.cursor() as cur:
+        cur.execute(f'CREATE DATABASE "{name}";')
+    conn.close()
+
+    conn = psycopg2.connect(
+        dbname=name, user=bench_db_user, password=bench_db_password,
+        host=bench_db_host, port=bench_db_port)
+    with conn.cursor() as cur, open(os.path.join(ROOT, 'benchmarks', 'schema.sql')) as f:
+        cur.execute(f.read())
+    conn.commit()
+    return conn
+
+
+def drop_database(name):
+    conn = admin_connection()
+    with conn.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE);')
+    conn.close()
+
+
+def load_roads(conn, grid):
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur,
+            'INSERT INTO "highway-bremen" (geom, co_level, pm25_level, no2_level, nh3_level, air_quality_level) VALUES %s',
+            [(wkt,) for wkt in synthetic.road_network(grid)],
+            template="(ST_GeomFromText(%s, 4326), 150, 150, 150, 150, 150)",
+            page_size=1000)
+        cur.execute('SELECT count(*) FROM "highway-bremen";')
+        count = cur.fetchone()[0]
+    conn.commit()
+    return count
+
+
+class Recorder:
+    def __init__(self):
+        self.results = []
+
+    def measure(self, name, fn, items=None, repeat=1, **extra):
+        # Times fn() `repeat` times, or fn(item) once per item
+        samples = []
+        calls = items if items is not None else [None] * repeat
+        for item in calls:
+            started = time.perf_counter()
+            value = fn(item) if items is not None else fn()
+            samples.append(time.perf_counter() - started)
+        samples.sort()
+        result = {
+            'name': name,
+            'n': len(samples),
+            'total_s': sum(samples),
+            'mean_ms': statistics.fmean(samples) * 1000,
+            'p50_ms': samples[len(samples) // 2] * 1000,
+            'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+            'max_ms': samples[-1] * 1000,
+            **extra
+        }
+        self.results.append(result)
+        print(f"{name:40s} n={result['n']:6d} mean={result['mean_ms']:10.3f}ms "
+              f"p95={result['p95_ms']:10.3f}ms", file=sys.stderr)
+        return value
+
+
+def run(args):
+    db_name = f"atmos_bench_{os.getpid()}"
+    geoserver = standins.GeoServerStub()
+    os.environ.update({
+        'DB_NAME': db_name, 'DB_USER': bench_db_user,
+        'DB_PASSWORD': bench_db_password, 'DB_HOST': bench_db_host,
+        'DB_PORT': bench_db_port, 'METRICS_PORT': '0', 'GEOSERVER_URL': geoserver.url,
+        'HOURLY_LEVELS_DAYS': '36500'  # the synthetic readings are from 2024
+    })
+    standins.install()
+    for service in SERVICE_DIRS:
+        sys.path.insert(0, os.path.join(ROOT, service))
+
+    recorder = Recorder()
+    conn = create_database(db_name)
+    try:
+        segments = recorder.measure('load_synthetic_roads', lambda: load_roads(conn, args.grid))
+
+        # Ingestion: TTN.on_message decode + insert into raw_data_2, then the
+        # same uplinks again as TTN redeliveries
+        import TTN
+        messages = list(synthetic.uplinks(args.devices, args.uplinks, args.grid, seed=args.seed))
+        with tempfile.TemporaryDirectory() as spool_dir:
+            TTN.open_storage(spool_dir)
+            recorder.measure(
+                'ttn.on_message', lambda message: TTN.on_message(
+                    None, None, standins.MQTTMessage(*message)),
+                items=messages)
+            recorder.measure(
+                'ttn.on_message[duplicate]', lambda message: TTN.on_message(
+                    None, None, standins.MQTTMessage(*message)),
+                items=messages)
+
+        # Graph build and export to the (in-memory) graph store
+        import algorithm
+        G = recorder.measure('algorithm.build_network', lambda: algorithm.build_network(conn))
+        recorder.results[-1]['components'] = len(G.graph['component_sizes'])
+
+        # Cold start from a GeoParquet snapshot of the road layer
+        import road_layer
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            recorder.measure(
+                'road_layer.write_snapshot', lambda: road_layer.write_snapshot(conn, snapshot_dir))
+            recorder.measure(
+                'algorithm.build_network_tiled[snapshot]',
+                lambda: algorithm.build_network_tiled(*road_layer.road_source(conn, directory=snapshot_dir)))
+
+        import graphql_helper
+        recorder.measure(
+            'algorithm.transfer_graph_to_neo4j',
+            lambda: algorithm.transfer_graph_to_neo4j(G, graphql_helper.get_neo4j_driver()),
+            nodes=G.number_of_nodes(), edges=G.number_of_edges())
+
+        # Path matching of the raw readings
+        raw_data = graphql_helper.get_data_from_postgres()
+        rows = (len(raw_data) - 1) // 6 * 6
+        import trajectory
+        filtered = recorder.measure(
+            'trajectory.filter_trajectories',
+            lambda: trajectory.filter_trajectories(raw_data[:rows]), rows=rows)
+        recorder.measure(
+            'graphql_helper.process_data[filtered]',
+            lambda: graphql_helper.process_data(filtered),
+            rows=len(filtered), segments=len(filtered) // 6)
+        processed = recorder.measure(
+            'graphql_helper.process_data',
+            lambda: graphql_helper.process_data(raw_data[:rows]),
+            rows=rows, segments=rows // 6)
+        recorder.measure(
+            'graphql_helper.process_data[distance]',
+            lambda: graphql_helper.process_data(raw_data[:rows], 'distance'),
+            rows=rows, segments=rows // 6)
+        recorder.measure(
+            'graphql_helper.update_air_quality_table',
+            lambda: graphql_helper.update_air_quality_table(processed))
+
+        # Segment level recompute
+        import handler
+        recorder.measure('handler.update_highway_bremen', handler.update_highway_bremen)
+        changed_gids = recorder.measure('handler.update_air_quality_levels', handler.update_air_quality_levels)
+
+        # Tile cache requests for the changed segments, sent to the stub
+        recorder.measure(
+            'handler.refresh_tile_cache', lambda: handler.refresh_tile_cache(changed_gids, set()),
+            segments=len(changed_gids))
+        recorder.results[-1]['seed_requests'] = len(geoserver.seed_requests())
+
+        # Per-hour levels for time-dependent routing
+        handler.ensure_hourly_levels()
+        recorder.measure('handler.update_hourly_levels', handler.update_hourly_levels)
+
+        # Heatmap cell aggregation and a city-wide and a street-level query
+        import cells
+        cells.ensure_cells(conn)
+        recorder.measure('cells.update_cells', lambda: cells.update_cells(conn))
+        west, south = synthetic.grid_point(0, 0, args.grid)
+        east, north = synthetic.grid_point(args.grid - 1, args.grid - 1, args.grid)
+        for zoom in (12, 16):
+            recorder.measure(
+                f'cells.heatmap_cells[z{zoom}]',
+                lambda: cells.heatmap_cells(conn, (west, south, east, north), zoom))
+
+        # Incremental push of the changed levels to the graph store
+        import graph_sync
+        version, synced = recorder.measure(
+            'graph_sync.sync_changes',
+            lambda: graph_sync.sync_changes(conn, graphql_helper.get_neo4j_driver(), 0))
+        recorder.results[-1]['segments'] = synced
+
+        # Routing
+        import route_service
+        engine = route_service.RouteEngine(algorithm.build_network(conn))
+        rng = random.Random(args.seed)
+        nodes = engine.nodes
+        pairs = [(rng.choice(nodes), rng.choice(nodes)) for _ in range(args.route_queries)]
+        for profile in route_service.COST_PROFILES:
+            recorder.measure(
+                f'route_service.route[{profile}]',
+                lambda pair: engine.route(pair[0], pair[1], profile), items=pairs)
+        engine.load_hourly_levels(route_service.fetch_hourly_levels())
+        departures = [rng.randrange(24 * 3600) for _ in pairs]
+        recorder.measure(
+            'route_service.route[clean, departure]',
+            lambda item: engine.route(item[0][0], item[0][1], 'clean', item[1]),
+            items=list(zip(pairs, departures)), segments=engine.hourly.segments)
+    finally:
+        conn.close()
+        geoserver.close()
+        if not args.keep_db:
+            drop_database(db_name)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'grid': args.grid,
+            'segments': segments,
+            'devices': args.devices,
+            'uplinks_per_device': args.uplinks,
+            'route_queries': args.route_queries,
+            'seed': args.seed
+        },
+        'results': recorder.results
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AtmosGPT pipeline benchmarks")
+    parser.add_argument('--grid', type=int, default=40,
+                        help="street grid size; the network has 2 * grid * (grid - 1) segments")
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--uplinks', type=int, default=50, help="uplinks per device")
+    parser.add_argument('--route-queries', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write JSON results to this file instead of stdout")
+    parser.add_argument('--keep-db', action='store_true', help="do not drop the benchmark database")
+    args = parser.parse_args()
+
+    # The services print per message; keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
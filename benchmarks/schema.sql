@@ -0,0 +1,50 @@
+-- Minimal schema for the benchmark database, matching the columns the
+-- services read and write in the production bremengeo database.
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+CREATE TABLE raw_data_2 (
+    id SERIAL PRIMARY KEY,
+    device_id TEXT,
+    time_received TIMESTAMPTZ,
+    co_level DOUBLE PRECISION,
+    pm25_level DOUBLE PRECISION,
+    no2_level DOUBLE PRECISION,
+    nh3_level DOUBLE PRECISION,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    uplink_key TEXT,
+    reading_index SMALLINT
+);
+
+CREATE UNIQUE INDEX raw_data_2_uplink_key ON raw_data_2 (uplink_key, reading_index);
+
+CREATE TABLE air_quality (
+    id SERIAL PRIMARY KEY,
+    co_level DOUBLE PRECISION,
+    pm25_level DOUBLE PRECISION,
+    no2_level DOUBLE PRECISION,
+    nh3_level DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    latitude DOUBLE PRECISION,
+    geom GEOMETRY(Point, 4326),
+    time_received TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ DEFAULT now()
+);
+
+CREATE TABLE "highway-bremen" (
+    gid SERIAL PRIMARY KEY,
+    geom GEOMETRY(MultiLineString, 4326),
+    co_level DOUBLE PRECISION,
+    pm25_level DOUBLE PRECISION,
+    no2_level DOUBLE PRECISION,
+    nh3_level DOUBLE PRECISION,
+    air_quality_level INTEGER,
+    levels_version BIGINT NOT NULL DEFAULT 0,
+    levels_updated_at TIMESTAMPTZ
+);
+
+CREATE SEQUENCE highway_bremen_levels_version;
+CREATE INDEX ON "highway-bremen" (levels_version);
+
+CREATE INDEX ON "highway-bremen" USING GIST (geom);
+CREATE INDEX ON air_quality USING GIST (geom);
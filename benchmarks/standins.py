@@ -0,0 +1,268 @@
+import json
+import math
+import sys
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import networkx as nx
+import numpy as np
+
+# In-memory stand-ins for Neo4j and MQTT. install() registers them as the
+# `neo4j` and `paho.mqtt.client` modules so that the service modules can be
+# imported and exercised without a graph database or a broker. GeoServerStub
+# is a local HTTP server that answers GeoServer and GeoWebCache REST calls.
+
+
+class Record(tuple):
+    # Supports both record[0] and record['key'] like neo4j.Record
+    def __new__(cls, values, keys=()):
+        record = super().__new__(cls, values)
+        record.keys = list(keys)
+        return record
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self.keys.index(key)
+        return super().__getitem__(key)
+
+
+class Result:
+    def __init__(self, records, keys=()):
+        self.records = [Record(record, keys) for record in records]
+
+    def single(self):
+        return self.records[0] if self.records else None
+
+    def __iter__(self):
+        return iter(self.records)
+
+
+class InMemoryGraph:
+    # Answers the handful of Cypher statements the services issue
+    def __init__(self):
+        self.graph = nx.Graph()
+        self.node_ids = []
+        self.node_points = None
+        self.node_components = None
+        self.sync_version = None
+
+    def run(self, query, **params):
+        if query.startswith('CREATE') or 'n.location IS NULL' in query:
+            return Result([])  # constraints, indexes and backfills
+        if 'DETACH DELETE' in query:
+            self.graph.clear()
+            self.node_points = None
+            return Result([])
+        if 'SyncState' in query:
+            if query.startswith('MATCH (s:SyncState {'):
+                return Result([] if self.sync_version is None else [(self.sync_version,)],
+                              keys=('version',))
+            self.sync_version = params.get('version')  # MERGE ... SET or DELETE
+            return Result([])
+        if 'gds.graph.exists' in query:
+            return Result([(True,)], keys=('exists',))  # projections are implicit
+        if 'gds.graph.drop' in query:
+            return Result([(params['name'],)], keys=('graphName',))
+        if query.startswith('UNWIND $pairs'):
+            weight = params.get('weight')
+            records = []
+            for pair in params['pairs']:
+                start = self.nearest(pair['start_lat'], pair['start_lon'])[0]
+                end = self.nearest(pair['end_lat'], pair['end_lon'],
+                                   self.graph.nodes[start].get('component', 0))[0]
+                records.append((pair['i'], self.path(start, end, weight)[0]))
+            return Result(records, keys=('i', 'path'))
+        if query.startswith('UNWIND $nodes'):
+            for node in params['nodes']:
+                self.graph.add_node(
+                    node['id'], latitude=node['latitude'], longitude=node['longitude'],
+                    component=node.get('component', 0))
+            self.node_points = None
+            return Result([])
+        if query.startswith('UNWIND $relationships'):
+            for rel in params['relationships']:
+                self.graph.add_edge(
+                    rel['source'], rel['target'], distance=rel['distance'],
+                    exposure=rel['exposure'], gid=rel['gid'])
+            return Result([])
+        if query.startswith('UNWIND $rows'):
+            rows = {row['gid']: row for row in params['rows']}
+            for _, _, data in self.graph.edges(data=True):
+                row = rows.get(data.get('gid'))
+                if row is not None:
+                    data['exposure'] = data['distance'] * row['factor']
+                    data['levels_version'] = row['version']
+            return Result([])
+        if 'ORDER BY dist' in query:
+            return Result([self.nearest(params['latitude'], params['longitude'], params.get('component'))],
+                          keys=('nodeId', 'dist'))
+        if 'gds.shortestPath' in query or 'shortestPath' in query:
+            path, cost = self.path(params['start_id'], params['end_id'], params.get('weight'))
+            return Result([(path, cost)] if path else [], keys=('path', 'totalCost'))
+        raise NotImplementedError(f"Unsupported query: {query}")
+
+    def path(self, start_id, end_id, weight=None):
+        # Coordinate path and its cost; fewest hops without a weight
+        try:
+            ids = nx.shortest_path(self.graph, start_id, end_id, weight=weight)
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            return None, None
+        nodes = self.graph.nodes
+        cost = (nx.path_weight(self.graph, ids, weight) if weight
+                else float(len(ids) - 1))
+        return [[nodes[n]['latitude'], nodes[n]['longitude']] for n in ids], cost
+
+    def nearest(self, latitude, longitude, component=None):
+        # Full scan; Neo4j narrows this down with the node_location point index
+        if self.node_points is None:
+            self.node_ids = list(self.graph.nodes)
+            self.node_points = np.radians([
+                (self.graph.nodes[n]['latitude'], self.graph.nodes[n]['longitude'])
+                for n in self.node_ids])
+            self.node_components = np.array(
+                [self.graph.nodes[n].get('component', 0) for n in self.node_ids])
+        lat, lon = math.radians(latitude), math.radians(longitude)
+        h = (np.sin((self.node_points[:, 0] - lat) / 2) ** 2
+             + np.cos(lat) * np.cos(self.node_points[:, 0])
+             * np.sin((self.node_points[:, 1] - lon) / 2) ** 2)
+        if component is not None:
+            h = np.where(self.node_components == component, h, np.inf)
+        index = int(np.argmin(h))
+        dist = 2 * 6371000 * math.asin(math.sqrt(min(h[index], 1.0)))
+        return self.node_ids[index], dist
+
+
+class ClientError(Exception):
+    pass
+
+
+class Session:
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, query, **params):
+        return self.store.run(query, **params)
+
+    def write_transaction(self, work, *args, **kwargs):
+        return work(self, *args, **kwargs)
+
+    read_transaction = execute_write = execute_read = write_transaction
+
+    def close(self):
+        pass
+
+
+class InMemoryDriver:
+    def __init__(self, *args, **kwargs):
+        self.store = InMemoryGraph()
+
+    def session(self, **kwargs):
+        return Session(self.store)
+
+    def close(self):
+        pass
+
+
+class MQTTMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class MQTTClient:
+    # Broker-less client: publish() delivers straight to on_message
+    def __init__(self, *args, **kwargs):
+        self.on_connect = None
+        self.on_message = None
+        self.subscriptions = []
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60):
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+        return 0
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+        return 0, len(self.subscriptions)
+
+    def publish(self, topic, payload, qos=0):
+        if self.on_message is not None:
+            self.on_message(self, None, MQTTMessage(topic, payload))
+
+    def loop_forever(self):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class GeoServerStub:
+    # Accepts every request and records (method, path, JSON body); point
+    # GEOSERVER_URL at .url
+    def __init__(self):
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_request(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                try:
+                    body = json.loads(body) if body else None
+                except ValueError:
+                    body = body.decode()
+                stub.requests.append((self.command, self.path, body))
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/geoserver"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def seed_requests(self):
+        return [body['seedRequest'] for method, path, body in self.requests
+                if path.startswith('/geoserver/gwc/rest/seed/') and body]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def install():
+    exceptions = types.ModuleType('neo4j.exceptions')
+    exceptions.ClientError = ClientError
+    neo4j = types.ModuleType('neo4j')
+    neo4j.GraphDatabase = types.SimpleNamespace(driver=InMemoryDriver)
+    neo4j.exceptions = exceptions
+    sys.modules.update({'neo4j': neo4j, 'neo4j.exceptions': exceptions})
+
+    client = types.ModuleType('paho.mqtt.client')
+    client.Client = MQTTClient
+    client.MQTTMessage = MQTTMessage
+    mqtt = types.ModuleType('paho.mqtt')
+    mqtt.client = client
+    paho = types.ModuleType('paho')
+    paho.mqtt = mqtt
+    sys.modules.update({'paho': paho, 'paho.mqtt': mqtt, 'paho.mqtt.client': client})
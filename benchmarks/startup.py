@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+# Startup time of the services.
+#
+# Every service module is imported --repeat times, each time in a fresh
+# interpreter like on a container restart, and the time of the import is
+# reported together with the heavy modules it loaded. Importing must not
+# connect anywhere: DB_HOST and NEO4J_URI point at a closed port, so an
+# import-time connection shows up as an error or a timeout. With --check the
+# run fails (exit status 1) when an import loads one of LAZY_MODULES that
+# the service does not need before it starts serving, takes longer than
+# --budget-ms, or is more than --tolerance times slower than in a
+# --baseline report.
+#
+#   python benchmarks/startup.py --output startup.json
+#   python benchmarks/startup.py --check --baseline startup.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported only by the functions that use them
+LAZY_MODULES = ('folium', 'geopandas', 'geopy', 'networkx', 'pandas', 'plotly.express',
+                'pyarrow', 'rasterio', 'scipy', 'shapely')
+
+# Directory, module and the LAZY_MODULES it may load at import
+SERVICES = [
+    ('Things_network_handler', 'TTN', ()),
+    ('Graphql_handler', 'graphql_helper', ()),
+    ('Graphql_handler', 'graph_sync', ()),
+    ('Graphql_handler', 'algorithm', ()),
+    ('Graphql_handler', 'contraction', ()),
+    # pyarrow loads pandas when it is installed
+    ('Graphql_handler', 'road_layer', ('pandas', 'pyarrow', 'shapely')),
+    # The graph and its KD-tree are built before the first request
+    ('Graphql_handler', 'route_service', ('networkx', 'scipy')),
+    ('Graphql_handler', 'google_nav', ()),
+    # The surface is loaded before the first recompute
+    ('Postgis_handler', 'handler', ('rasterio', 'scipy')),
+    # The sample data of the dashboard is a DataFrame
+    ('Frontend', 'main', ('pandas',)),
+    ('Frontend', 'main2', ()),
+    ('Frontend', 'routemap', ()),
+]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - started, 'modules': sorted(sys.modules)}}))
+"""
+
+CLOSED_PORT_ENV = {
+    'DB_HOST': '127.0.0.1', 'DB_PORT': '9', 'NEO4J_URI': 'neo4j://127.0.0.1:9',
+    'MQTT_SERVER': '127.0.0.1', 'GEOSERVER_URL': 'http://127.0.0.1:9/geoserver', 'METRICS_PORT': '0'
+}
+BASELINE_SLACK_MS = 20  # fast imports vary by more than the tolerance
+
+
+def import_once(directory, module, timeout):
+    # (import seconds, process seconds, loaded modules) in a new interpreter
+    env = dict(os.environ, **CLOSED_PORT_ENV)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.join(ROOT, directory), os.path.join(ROOT, 'common')]
+        + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', IMPORT_SCRIPT.format(module=module)],
+        cwd=os.path.join(ROOT, directory), env=env, capture_output=True, text=True, timeout=timeout)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip()
+                           else f"exit status {result.returncode}")
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    return report['seconds'], elapsed, report['modules']
+
+
+def lazy_loaded(modules):
+    loaded = set()
+    for name in modules:
+        for lazy in LAZY_MODULES:
+            if name == lazy or name.startswith(lazy + '.'):
+                loaded.add(lazy)
+    return sorted(loaded)
+
+
+def measure(directory, module, allowed, repeat, timeout):
+    name = f"import[{directory}/{module}]"
+    samples, process_samples = [], []
+    try:
+        for _ in range(repeat):
+            seconds, process_seconds, modules = import_once(directory, module, timeout)
+            samples.append(seconds)
+            process_samples.append(process_seconds)
+    except (RuntimeError, subprocess.TimeoutExpired) as e:
+        print(f"{name:48s} failed: {e}", file=sys.stderr)
+        return {'name': name, 'error': str(e)}
+    samples.sort()
+    loaded = lazy_loaded(modules)
+    result = {
+        'name': name,
+        'n': len(samples),
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'max_ms': samples[-1] * 1000,
+        'process_p50_ms': statistics.median(process_samples) * 1000,
+        'modules': len(modules),
+        'lazy_loaded': loaded,
+        'unexpected': [lazy for lazy in loaded if lazy not in allowed]
+    }
+    print(f"{name:48s} n={result['n']:3d} p50={result['p50_ms']:8.1f}ms "
+          f"process={result['process_p50_ms']:8.1f}ms {' '.join(loaded)}", file=sys.stderr)
+    return result
+
+
+def check(results, budget_ms, baseline, tolerance):
+    # Reasons to fail the run, one line each
+    previous = {result['name']: result for result in baseline['results']} if baseline else {}
+    failures = []
+    for result in results:
+        name = result['name']
+        if 'error' in result:
+            failures.append(f"{name}: {result['error']}")
+            continue
+        if result['unexpected']:
+            failures.append(f"{name} loads {', '.join(result['unexpected'])} at import")
+        if budget_ms is not None and result['p50_ms'] > budget_ms:
+            failures.append(f"{name} takes {result['p50_ms']:.0f} ms, the budget is {budget_ms:.0f} ms")
+        before = previous.get(name, {}).get('p50_ms')
+        if before is not None and result['p50_ms'] > before * tolerance + BASELINE_SLACK_MS:
+            failures.append(f"{name} takes {result['p50_ms']:.0f} ms, {before:.0f} ms in the baseline")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AtmosGPT service startup benchmark")
+    parser.add_argument('--repeat', type=int, default=5, help="imports per module, each in a new interpreter")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds before an import counts as hung")
+    parser.add_argument('--only', action='append', help="benchmark only this module (repeatable)")
+    parser.add_argument('--check', action='store_true', help="exit with status 1 on a regression")
+    parser.add_argument('--budget-ms', type=float, help="largest p50 import time allowed with --check")
+    parser.add_argument('--baseline', help="earlier JSON report to compare against with --check")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="allowed slowdown against the baseline with --check")
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = [measure(directory, module, allowed, args.repeat, args.timeout)
+               for directory, module, allowed in SERVICES
+               if not args.only or module in args.only]
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    if args.check:
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        failures = check(results, args.budget_ms, baseline, args.tolerance)
+        for failure in failures:
+            print(f"FAIL {failure}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import base64
+import json
+import random
+import struct
+from datetime import datetime, timedelta, timezone
+
+# Synthetic data around Bremen for the benchmarks
+BREMEN_CENTER = (8.8017, 53.0793)  # lon, lat
+GRID_SPACING = 0.002  # degrees between parallel streets (~130-220 m)
+PAYLOAD_FORMAT = '<24H2f'  # 6 x (CO, PM2.5, NO2, NH3) + latitude, longitude
+
+
+def grid_point(i, j, grid, spacing=GRID_SPACING):
+    offset = (grid - 1) * spacing / 2
+    return (BREMEN_CENTER[0] - offset + i * spacing,
+            BREMEN_CENTER[1] - offset + j * spacing)
+
+
+def road_network(grid=40, vertices_per_segment=4, spacing=GRID_SPACING, seed=0):
+    # Street grid of grid x grid intersections; every block edge becomes one
+    # MultiLineString segment with jittered intermediate vertices
+    rng = random.Random(seed)
+    for i in range(grid):
+        for j in range(grid):
+            start = grid_point(i, j, grid, spacing)
+            for di, dj in ((1, 0), (0, 1)):
+                if i + di >= grid or j + dj >= grid:
+                    continue
+                end = grid_point(i + di, j + dj, grid, spacing)
+                coords = [start]
+                for k in range(1, vertices_per_segment - 1):
+                    t = k / (vertices_per_segment - 1)
+                    coords.append((
+                        start[0] + (end[0] - start[0]) * t + rng.uniform(-1, 1) * spacing * 0.05,
+                        start[1] + (end[1] - start[1]) * t + rng.uniform(-1, 1) * spacing * 0.05))
+                coords.append(end)
+                yield 'MULTILINESTRING((' + ', '.join(f"{x} {y}" for x, y in coords) + '))'
+
+
+def encode_payload(levels, latitude, longitude):
+    return struct.pack(PAYLOAD_FORMAT, *levels, latitude, longitude)
+
+
+def uplink_message(device_id, f_cnt, received_at, payload):
+    return json.dumps({
+        'end_device_ids': {'device_id': device_id},
+        'received_at': received_at.isoformat().replace('+00:00', 'Z'),
+        'uplink_message': {
+            'f_cnt': f_cnt,
+            'frm_payload': base64.b64encode(payload).decode()
+        }
+    }).encode()
+
+
+def uplinks(devices=10, uplinks_per_device=50, grid=40, interval=timedelta(seconds=30), seed=0):
+    # Each device random-walks along the street grid; yields (topic, payload)
+    rng = random.Random(seed)
+    started = datetime(2024, 5, 1, 8, 0, tzinfo=timezone.utc)
+    walkers = [(rng.randrange(grid), rng.randrange(grid)) for _ in range(devices)]
+    for f_cnt in range(uplinks_per_device):
+        for d, (i, j) in enumerate(walkers):
+            di, dj = rng.choice(((1, 0), (-1, 0), (0, 1), (0, -1)))
+            i = min(max(i + di, 0), grid - 1)
+            j = min(max(j + dj, 0), grid - 1)
+            walkers[d] = (i, j)
+
+            longitude, latitude = grid_point(i, j, grid)
+            levels = [rng.randrange(0, 20), rng.randrange(0, 60),
+                      rng.randrange(0, 120), rng.randrange(0, 300)] * 6
+            device_id = f"bench-bike-{d:04d}"
+            yield (f"v3/bench@ttn/devices/{device_id}/up",
+                   uplink_message(device_id, f_cnt, started + f_cnt * interval,
+                                  encode_payload(levels, latitude, longitude)))
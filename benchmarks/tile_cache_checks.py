@@ -0,0 +1,94 @@
+import os
+import random
+import sys
+
+# Checks of the rectangle merging in Postgis_handler/tile_cache.py. Needs
+# no GeoServer; exits with status 1 when a check fails.
+#
+#   python benchmarks/tile_cache_checks.py
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'Postgis_handler'), os.path.join(ROOT, 'common')]
+
+import tile_cache  # noqa: E402
+
+CELL = tile_cache.MERGE_CELL_DEGREES
+BREMEN = (8.70, 53.00, 8.99, 53.15)  # west, south, east, north
+
+
+def area(rectangles):
+    return sum((east - west) * (north - south) for west, south, east, north in rectangles)
+
+
+def covers(rectangles, box):
+    # Every corner of box lies in one of the rectangles
+    eps = 1e-9
+    west, south, east, north = box
+    return all(any(w - eps <= x <= e + eps and s - eps <= y <= n + eps for w, s, e, n in rectangles)
+               for x in (west, east) for y in (south, north))
+
+
+def segment_box(x, y, length=0.002):
+    return (x, y, x + length, y + length / 2)
+
+
+def check_block_is_one_rectangle():
+    # A 3 x 3 km block of changed segments, not one rectangle per row
+    boxes = [segment_box(8.80 + i * 0.003, 53.05 + j * 0.003) for i in range(10) for j in range(10)]
+    rectangles = tile_cache.merge_boxes(boxes)
+    assert len(rectangles) == 1, f"{len(rectangles)} rectangles"
+
+
+def check_scattered_update():
+    # A few changed segments in each of 40 city blocks spread over Bremen:
+    # several rectangles that together cover far less than the bbox around
+    # all of them
+    random.seed(1)
+    west, south, east, north = BREMEN
+    boxes = []
+    for _ in range(40):
+        x, y = random.uniform(west, east), random.uniform(south, north)
+        boxes += [segment_box(x + random.uniform(0, 0.004), y + random.uniform(0, 0.004)) for _ in range(5)]
+    rectangles = tile_cache.merge_boxes(boxes)
+    assert 1 < len(rectangles) <= tile_cache.MAX_RECTANGLES, f"{len(rectangles)} rectangles"
+    assert all(covers(rectangles, box) for box in boxes), "a changed segment is not covered"
+    everything = (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                  max(b[2] for b in boxes), max(b[3] for b in boxes))
+    assert area(rectangles) < 0.5 * area([everything]), \
+        f"rectangles cover {area(rectangles) / area([everything]):.0%} of the bbox around all changes"
+
+
+def check_large_update():
+    # Changes in every cell of the city still end up as at most MAX_RECTANGLES
+    west, south, east, north = BREMEN
+    boxes = [segment_box(west + i * CELL, south + j * CELL)
+             for i in range(int((east - west) / CELL)) for j in range(int((north - south) / CELL)) if (i + j) % 2]
+    rectangles = tile_cache.merge_boxes(boxes)
+    assert len(rectangles) <= tile_cache.MAX_RECTANGLES, f"{len(rectangles)} rectangles"
+    assert all(covers(rectangles, box) for box in boxes), "a changed segment is not covered"
+
+
+def check_few_boxes_stay_fine():
+    boxes = [segment_box(8.80, 53.05), segment_box(8.90, 53.10)]
+    rectangles = tile_cache.merge_boxes(boxes)
+    assert len(rectangles) == 2 and abs(area(rectangles) - 2 * CELL * CELL) < 1e-12, rectangles
+
+
+CHECKS = [check_block_is_one_rectangle, check_scattered_update, check_large_update, check_few_boxes_stay_fine]
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+            print(f"ok   {check.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL {check.__name__}: {e}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
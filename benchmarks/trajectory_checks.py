@@ -0,0 +1,86 @@
+import math
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+# Regression checks for Graphql_handler/trajectory.py on synthetic tracks.
+# Needs no database; exits with status 1 when a check fails.
+#
+#   PYTHONPATH=Graphql_handler:common python benchmarks/trajectory_checks.py
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'Graphql_handler'), os.path.join(ROOT, 'common')]
+
+import trajectory  # noqa: E402
+
+START = datetime(2024, 5, 1, 8, tzinfo=timezone.utc)
+BREMEN = (8.8017, 53.0793)  # lon, lat
+METERS_PER_DEGREE = 111320.0
+
+
+def rows_for(fixes, device='bike-1'):
+    # raw_data_2 rows as TTN.py writes them: six readings per fix, with the
+    # longitude in the latitude column and the latitude in the longitude column
+    rows = []
+    for seconds, lon, lat in fixes:
+        for reading in range(6):
+            rows.append({
+                'id': len(rows), 'device_id': device, 'time_received': START + timedelta(seconds=seconds),
+                'co_level': 1, 'pm25_level': 1, 'no2_level': 1, 'nh3_level': 1,
+                'latitude': lon, 'longitude': lat
+            })
+    return rows
+
+
+def east_west_track(speed_kmh=30, fixes=72, interval=30):
+    lon, lat = BREMEN
+    step = speed_kmh / 3.6 * interval / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+    return [(i * interval, lon + i * step, lat) for i in range(fixes)]
+
+
+def check_all_outliers():
+    # Three fixes about 10 km and 30 s apart in a line: every one is rejected
+    lon, lat = BREMEN
+    fixes = [(0, lon, lat), (30, lon + 0.15, lat), (60, lon + 0.3, lat)]
+    kept = trajectory.filter_trajectories(rows_for(fixes))
+    assert kept == [], f"expected no rows, got {len(kept)}"
+
+
+def check_east_west_track():
+    # A cyclist riding east at 30 km/h keeps every fix, close to its position
+    fixes = east_west_track()
+    kept = trajectory.filter_trajectories(rows_for(fixes))
+    assert len(kept) == 6 * len(fixes), f"kept {len(kept) // 6} of {len(fixes)} fixes"
+    for row, (_, lon, lat) in zip(kept[::6], fixes):
+        error = math.hypot((row['latitude'] - lon) * math.cos(math.radians(lat)), row['longitude'] - lat)
+        assert error * METERS_PER_DEGREE < 5, f"smoothed fix {error * METERS_PER_DEGREE:.1f} m off the track"
+
+
+def check_outlier_device_beside_track():
+    # A device whose fixes are all outliers does not disturb another one
+    lon, lat = BREMEN
+    rows = rows_for(east_west_track()) + rows_for(
+        [(0, lon, lat), (30, lon + 0.15, lat), (60, lon + 0.3, lat)], device='bike-2')
+    kept = trajectory.filter_trajectories(rows)
+    assert {row['device_id'] for row in kept} == {'bike-1'}
+    assert len(kept) == 6 * len(east_west_track())
+
+
+CHECKS = [check_all_outliers, check_east_west_track, check_outlier_device_beside_track]
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+            print(f"ok   {check.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL {check.__name__}: {e}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import math
+import os
+
+# Pre-aggregated air quality per grid cell, for heatmaps.
+#
+# Cells are Web Mercator tiles (the z/x/y scheme of the map tiles) at the
+# levels in CELL_LEVELS, so they nest: the parent of (level, x, y) is
+# (level - 1, x // 2, y // 2). handler.py folds new air_quality rows into
+# air_quality_cells after each recompute. It works through them by id in
+# batches, and each batch is a single INSERT ... SELECT that bins the batch
+# at every level at once and adds its count, sums and maxima to the stored
+# cells. The last aggregated id is saved in the same transaction. Heatmap
+# queries read only the cell table: the level is picked from the map zoom
+# and capped so that a view never needs more than CELL_QUERY_MAX cells.
+
+CELL_LEVELS = tuple(range(
+    int(os.getenv('CELL_MIN_LEVEL', '10')), int(os.getenv('CELL_MAX_LEVEL', '19')) + 1))
+cell_batch_rows = int(os.getenv('CELL_BATCH_ROWS', '50000'))  # air_quality ids per transaction
+CELL_ZOOM_OFFSET = 3  # 8 x 8 cells per map tile
+CELL_QUERY_MAX = 4096
+POLLUTANTS = ('co', 'pm25', 'no2', 'nh3')
+MERCATOR_HALF_WORLD = 20037508.342789244  # metres, EPSG:3857
+
+SCHEMA_QUERIES = ("""
+    CREATE TABLE IF NOT EXISTS air_quality_cells (
+        level SMALLINT NOT NULL,
+        x INTEGER NOT NULL,
+        y INTEGER NOT NULL,
+        readings BIGINT NOT NULL,
+        co_sum DOUBLE PRECISION NOT NULL,
+        pm25_sum DOUBLE PRECISION NOT NULL,
+        no2_sum DOUBLE PRECISION NOT NULL,
+        nh3_sum DOUBLE PRECISION NOT NULL,
+        co_max REAL,
+        pm25_max REAL,
+        no2_max REAL,
+        nh3_max REAL,
+        last_received TIMESTAMPTZ,
+        PRIMARY KEY (level, x, y)
+    );
+""", """
+    CREATE TABLE IF NOT EXISTS air_quality_cells_state (
+        name TEXT PRIMARY KEY,
+        last_id BIGINT NOT NULL
+    );
+""", """
+    INSERT INTO air_quality_cells_state (name, last_id) VALUES ('air_quality', 0)
+    ON CONFLICT (name) DO NOTHING;
+""")
+
+AGGREGATE_QUERY = """
+    WITH batch AS (
+        SELECT co_level, pm25_level, no2_level, nh3_level, time_received,
+               ST_X(p) AS mx, ST_Y(p) AS my
+        FROM (SELECT *, ST_Transform(geom, 3857) AS p FROM air_quality
+              WHERE id > %(since)s AND id <= %(until)s AND geom IS NOT NULL) AS a
+    )
+    INSERT INTO air_quality_cells AS c
+    SELECT l.level,
+           floor((mx + %(half)s) / (2 * %(half)s / 2 ^ l.level))::integer,
+           floor((%(half)s - my) / (2 * %(half)s / 2 ^ l.level))::integer,
+           count(*),
+           coalesce(sum(co_level), 0), coalesce(sum(pm25_level), 0),
+           coalesce(sum(no2_level), 0), coalesce(sum(nh3_level), 0),
+           max(co_level), max(pm25_level), max(no2_level), max(nh3_level),
+           max(time_received)
+    FROM batch CROSS JOIN unnest(%(levels)s::smallint[]) AS l(level)
+    GROUP BY 1, 2, 3
+    ON CONFLICT (level, x, y) DO UPDATE SET
+        readings = c.readings + EXCLUDED.readings,
+        co_sum = c.co_sum + EXCLUDED.co_sum,
+        pm25_sum = c.pm25_sum + EXCLUDED.pm25_sum,
+        no2_sum = c.no2_sum + EXCLUDED.no2_sum,
+        nh3_sum = c.nh3_sum + EXCLUDED.nh3_sum,
+        co_max = greatest(c.co_max, EXCLUDED.co_max),
+        pm25_max = greatest(c.pm25_max, EXCLUDED.pm25_max),
+        no2_max = greatest(c.no2_max, EXCLUDED.no2_max),
+        nh3_max = greatest(c.nh3_max, EXCLUDED.nh3_max),
+        last_received = greatest(c.last_received, EXCLUDED.last_received);
+"""
+
+CELLS_QUERY = """
+    SELECT x, y, readings,
+           co_sum / readings, pm25_sum / readings, no2_sum / readings, nh3_sum / readings,
+           co_max, pm25_max, no2_max, nh3_max, last_received
+    FROM air_quality_cells
+    WHERE level = %s AND x BETWEEN %s AND %s AND y BETWEEN %s AND %s;
+"""
+
+
+def ensure_cells(conn):
+    with conn.cursor() as cur:
+        for query in SCHEMA_QUERIES:
+            cur.execute(query)
+    conn.commit()
+
+
+def update_cells(conn, batch_rows=None):
+    # Aggregates the air_quality rows added since the last call; returns
+    # how many were aggregated
+    batch_rows = batch_rows or cell_batch_rows
+    with conn.cursor() as cur:
+        cur.execute("SELECT last_id FROM air_quality_cells_state WHERE name = 'air_quality';")
+        since = cur.fetchone()[0]
+        cur.execute("SELECT coalesce(max(id), 0) FROM air_quality;")
+        newest = cur.fetchone()[0]
+    conn.commit()
+
+    aggregated = 0
+    while since < newest:
+        until = min(since + batch_rows, newest)
+        with conn.cursor() as cur:
+            # Locks the checkpoint, so two handlers never add a batch twice
+            cur.execute("SELECT last_id FROM air_quality_cells_state WHERE name = 'air_quality' FOR UPDATE;")
+            if cur.fetchone()[0] != since:
+                conn.rollback()
+                break
+            cur.execute(AGGREGATE_QUERY, {
+                'since': since, 'until': until, 'half': MERCATOR_HALF_WORLD, 'levels': list(CELL_LEVELS)})
+            cur.execute("SELECT count(*) FROM air_quality WHERE id > %s AND id <= %s;", (since, until))
+            aggregated += cur.fetchone()[0]
+            cur.execute("UPDATE air_quality_cells_state SET last_id = %s WHERE name = 'air_quality';", (until,))
+        conn.commit()
+        since = until
+    return aggregated
+
+
+def tile(lon, lat, level):
+    n = 2 ** level
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(x, y, level):
+    # (west, south, east, north) in degrees
+    n = 2 ** level
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+
+def cell_level(bbox, zoom):
+    # Finest level at most CELL_ZOOM_OFFSET below the map zoom at which the
+    # bbox spans no more than CELL_QUERY_MAX cells
+    level = min(max(int(zoom) + CELL_ZOOM_OFFSET, CELL_LEVELS[0]), CELL_LEVELS[-1])
+    west, south, east, north = bbox
+    while level > CELL_LEVELS[0]:
+        x0, y0 = tile(west, north, level)
+        x1, y1 = tile(east, south, level)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= CELL_QUERY_MAX:
+            break
+        level -= 1
+    return level
+
+
+def heatmap_cells(conn, bbox, zoom):
+    # Cells of the bbox (west, south, east, north) at the level for zoom,
+    # with their bounds and per-pollutant mean and maximum
+    level = cell_level(bbox, zoom)
+    west, south, east, north = bbox
+    x0, y0 = tile(west, north, level)
+    x1, y1 = tile(east, south, level)
+    with conn.cursor() as cur:
+        cur.execute(CELLS_QUERY, (level, x0, x1, y0, y1))
+        rows = cur.fetchall()
+    conn.commit()
+    cells = []
+    for x, y, readings, *stats, last_received in rows:
+        cell = {'level': level, 'x': x, 'y': y, 'bounds': tile_bounds(x, y, level),
+                'readings': readings, 'last_received': last_received}
+        for i, pollutant in enumerate(POLLUTANTS):
+            cell[f'{pollutant}_mean'] = stats[i]
+            cell[f'{pollutant}_max'] = stats[len(POLLUTANTS) + i]
+        cells.append(cell)
+    return cells
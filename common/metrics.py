@@ -0,0 +1,96 @@
+import logging
+import os
+import random
+from prometheus_client import (CONTENT_TYPE_LATEST, Counter, Gauge, Histogram,
+                               generate_latest, start_http_server)
+
+# Metrics shared by the ingestion, processing and routing services.
+#
+# Every service calls start_metrics_server() (the route service serves
+# /metrics from its own aiohttp app instead) and records into the metrics
+# below, so the same names show up in every Prometheus target. The Docker
+# images copy this file next to the service scripts; for local runs add
+# the common directory to PYTHONPATH.
+
+metrics_port = os.getenv('METRICS_PORT')
+log_sample_rate = float(os.getenv('LOG_SAMPLE_RATE', '0.01'))  # share of per-message debug logs
+
+# Bucket edges in seconds
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+SLOW_BUCKETS = (.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+FRESHNESS_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 21600, 86400)
+
+# Ingestion (TTN.py)
+MQTT_DECODE_SECONDS = Histogram(
+    'atmos_mqtt_decode_seconds', 'Time to parse and unpack one uplink',
+    buckets=FAST_BUCKETS)
+MQTT_INSERT_SECONDS = Histogram(
+    'atmos_mqtt_insert_seconds', 'Time to insert the readings of one uplink',
+    buckets=FAST_BUCKETS)
+MQTT_MESSAGES = Counter(
+    'atmos_mqtt_messages', 'Uplinks received, by outcome', ['outcome'])
+SPOOL_READINGS = Gauge(
+    'atmos_spool_readings', 'Readings waiting in the TTN spool for the database')
+SPOOL_BYTES = Gauge(
+    'atmos_spool_bytes', 'Disk used by the TTN spool')
+SPOOL_DROPPED = Counter(
+    'atmos_spool_dropped_readings', 'Spooled readings dropped to stay within SPOOL_MAX_BYTES')
+SPOOL_REPLAYED = Counter(
+    'atmos_spool_replayed_readings', 'Spooled readings written to the database by the drainer')
+
+# Processing (graphql_helper.py, handler.py, graph_sync.py)
+PROCESS_SEGMENT_SECONDS = Histogram(
+    'atmos_process_data_segment_seconds',
+    'process_data time per six-reading segment, averaged over one call',
+    buckets=FAST_BUCKETS)
+SEGMENTS_PROCESSED = Counter(
+    'atmos_segments_processed', 'Segments matched onto the road graph')
+TRAJECTORY_FIXES = Counter(
+    'atmos_trajectory_fixes', 'GPS fixes seen by the trajectory filter, by outcome (kept, outlier, invalid)',
+    ['outcome'])
+QUERY_SECONDS = Histogram(
+    'atmos_query_seconds', 'Database query latency', ['backend', 'query'],
+    buckets=FAST_BUCKETS + SLOW_BUCKETS[-6:])
+RECOMPUTE_SECONDS = Histogram(
+    'atmos_handler_recompute_seconds', 'handler.py recompute step duration', ['step'],
+    buckets=SLOW_BUCKETS)
+FRESHNESS_SECONDS = Histogram(
+    'atmos_freshness_seconds',
+    'Time from a reading being received until its level is in "highway-bremen"',
+    buckets=FRESHNESS_BUCKETS)
+GRAPH_SYNC_LAG_SECONDS = Gauge(
+    'atmos_graph_sync_lag_seconds', 'Age of the oldest level change not yet in Neo4j')
+
+# Routing (route_service.py)
+ROUTE_SECONDS = Histogram(
+    'atmos_route_seconds', 'Route service request latency', ['endpoint', 'profile'],
+    buckets=FAST_BUCKETS)
+ROUTE_CACHE_LOOKUPS = Counter(
+    'atmos_route_cache_lookups', 'Route cache lookups, by result (hit, miss)', ['result'])
+ROUTE_CACHE_EVICTIONS = Counter(
+    'atmos_route_cache_evictions', 'Cached routes evicted to stay within the size limits')
+ROUTE_CACHE_INVALIDATIONS = Counter(
+    'atmos_route_cache_invalidations', 'Cached routes dropped after level changes')
+ROUTE_CACHE_ENTRIES = Gauge(
+    'atmos_route_cache_entries', 'Routes in the route cache')
+
+
+def start_metrics_server(default_port, offset=0):
+    # METRICS_PORT overrides the per-service default; 0 disables the endpoint.
+    # Worker processes of one service serve on the following ports (offset).
+    port = int(metrics_port or default_port)
+    if port:
+        start_http_server(port + offset)
+        logging.info(f"Serving metrics on port {port + offset}")
+
+
+def render_metrics():
+    # For services that serve /metrics from their own web server
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def log_sampled():
+    # Per-message logging only for a sample of messages, and only at DEBUG
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return False
+    return random.random() < log_sample_rate
@@ -0,0 +1,172 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import signal
+import statistics
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# On-demand profiling of a service's main loop.
+#
+# Each iteration of the loop (or each message/request) runs inside
+# profiler.cycle(). Nothing is measured until a profiling window is opened,
+# either by SIGUSR1 (for PROFILE_SECONDS), by --profile-cycles N at startup
+# or by the route service's /admin/profile endpoint. While the window is
+# open every cycle is run under cProfile and tracemalloc records
+# allocations. A timed window is closed by a timer, so it ends on time even
+# when the loop is idle. When it closes the merged cProfile stats are
+# written to <PROFILE_DIR>/<service>-<time>.prof and the per-cycle timings
+# plus the top allocation sites to a .json file next to it.
+
+profile_dir = os.getenv('PROFILE_DIR', 'profiles')
+profile_seconds = float(os.getenv('PROFILE_SECONDS', '60'))  # window opened by SIGUSR1
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATIONS = 30
+
+
+class LoopProfiler:
+    def __init__(self, service, directory=None):
+        self.service = service
+        self.directory = directory or profile_dir
+        self.lock = threading.Lock()
+        self.requested = None  # (seconds, cycles) to start at the next cycle
+        self.active = False
+        self.timer = None
+        self.exit_after = False
+        self.done = False
+
+    def request(self, seconds=None, cycles=None, exit_after=False):
+        # Safe to call from a signal handler: the window opens at the next cycle
+        self.requested = (seconds, cycles)
+        self.exit_after = exit_after
+
+    def on_signal(self, signum, frame):
+        logging.info(f"Profiling requested for {profile_seconds:.0f}s")
+        self.request(seconds=profile_seconds)
+
+    def install_signal_handler(self, signum=signal.SIGUSR1):
+        signal.signal(signum, self.on_signal)
+
+    def start(self, seconds, cycles):
+        self.active = True
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+        self.cycles_left = cycles
+        self.started_at = datetime.now(timezone.utc)
+        self.durations = []
+        self.stats = None
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.first_snapshot = tracemalloc.take_snapshot()
+        if seconds is not None:
+            self.timer = threading.Timer(seconds, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self):
+        with self.lock:
+            if self.active and self.deadline is not None and time.monotonic() >= self.deadline:
+                self.finish()
+
+    @contextmanager
+    def cycle(self):
+        with self.lock:
+            if self.requested is not None and not self.active:
+                self.start(*self.requested)
+                self.requested = None
+            active = self.active
+        if not active:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active cProfile at a time; concurrent
+            # cycles (route service worker threads) run unprofiled
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.disable()
+            duration = time.perf_counter() - started
+            with self.lock:
+                if self.active:
+                    self.record(profile, duration)
+
+    def record(self, profile, duration):
+        self.durations.append(duration)
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+        if self.cycles_left is not None:
+            self.cycles_left -= 1
+        if self.cycles_left == 0 or (self.deadline is not None and time.monotonic() >= self.deadline):
+            self.finish()
+
+    def finish(self):
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        self.active = False
+        self.done = self.exit_after
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.durations:
+            logging.info("Profiling window closed without any cycles, nothing written")
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{self.service}-{self.started_at.strftime('%Y%m%dT%H%M%S')}"
+        path = os.path.join(self.directory, name)
+        self.stats.dump_stats(path + '.prof')
+
+        durations = sorted(self.durations)
+        report = {
+            'service': self.service,
+            'started_at': self.started_at.isoformat(),
+            'cycles': len(durations),
+            'cycle_seconds': {
+                'total': sum(durations),
+                'mean': statistics.fmean(durations),
+                'p50': durations[len(durations) // 2],
+                'p95': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+                'max': durations[-1],
+                'each': self.durations
+            },
+            'traced_memory_bytes': sum(stat.size for stat in snapshot.statistics('filename')),
+            'top_allocations': [{
+                'location': str(stat.traceback[0]),
+                'size_bytes': stat.size,
+                'count': stat.count
+            } for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]],
+            'allocation_growth': [{
+                'location': str(stat.traceback[0]),
+                'size_diff_bytes': stat.size_diff,
+                'count_diff': stat.count_diff
+            } for stat in snapshot.compare_to(self.first_snapshot, 'lineno')[:TOP_ALLOCATIONS]]
+        }
+        with open(path + '.json', 'w') as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Profile of {len(durations)} cycles written to {path}.prof/.json")
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile-cycles', type=int, metavar='N',
+                        help="profile the first N iterations of the main loop, then exit")
+
+
+def loop_profiler(service, args):
+    # Profiler with the SIGUSR1 handler installed and --profile-cycles applied
+    profiler = LoopProfiler(service)
+    profiler.install_signal_handler()
+    if args.profile_cycles:
+        profiler.request(cycles=args.profile_cycles, exit_after=True)
+    return profiler
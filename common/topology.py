@@ -0,0 +1,108 @@
+import os
+import numpy as np
+import shapely
+
+# Noding of the road lines before they become graph edges.
+#
+# The graph joins two lines only where they share a node, but roads in
+# "highway-bremen" often cross, or end on another road, without a vertex in
+# common. Every point where two lines meet is therefore inserted into both
+# of them as a vertex. A line end that stops within GRAPH_SNAP_METERS of
+# another line gets a vertex at the closest point of that line, plus a
+# short connector to it. Coordinates are then rounded to
+# GRAPH_COORD_DECIMALS, so vertices that differ only by floating point
+# noise become one node. Set GRAPH_NODE_CROSSINGS=false where crossings are
+# mostly bridges and tunnels; line ends are still snapped.
+#
+# split_points() can be limited to a window, so a large layer can be noded
+# one tile at a time: each tile is read with a margin of snap_degrees, and
+# only the points inside the tile are kept. A point then comes from exactly
+# one tile, which holds every line that meets there.
+
+coord_decimals = int(os.getenv('GRAPH_COORD_DECIMALS', '6'))  # about 0.1 m
+snap_meters = float(os.getenv('GRAPH_SNAP_METERS', '1'))
+node_crossings = os.getenv('GRAPH_NODE_CROSSINGS', 'true').lower() == 'true'
+METERS_PER_DEGREE = 111320.0
+snap_degrees = snap_meters / METERS_PER_DEGREE
+
+
+def end_snaps(lines, tree):
+    # (line, point) of the closest point on a line near the end of another,
+    # and the connectors from those ends as (owner line, end, point)
+    ends = np.concatenate((shapely.get_point(lines, 0), shapely.get_point(lines, -1)))
+    owners = np.tile(np.arange(len(lines)), 2)
+    end_index, line_index = tree.query(
+        ends, predicate='dwithin', distance=snap_degrees)
+    other = owners[end_index] != line_index
+    end_index, line_index = end_index[other], line_index[other]
+    targets = lines[line_index]
+    points = shapely.line_interpolate_point(
+        targets, shapely.line_locate_point(targets, ends[end_index]))
+    gaps = shapely.distance(ends[end_index], points) > 0
+    connectors = (owners[end_index][gaps], shapely.get_coordinates(ends[end_index][gaps]),
+                  shapely.get_coordinates(points[gaps]))
+    return line_index, shapely.get_coordinates(points), connectors
+
+
+def crossings(lines, tree):
+    # (line, point) for every point where two lines meet, once for each line
+    first, second = tree.query(lines, predicate='intersects')
+    pairs = first < second
+    first, second = first[pairs], second[pairs]
+    points, pair_index = shapely.get_coordinates(
+        shapely.intersection(lines[first], lines[second]), return_index=True)
+    return (np.concatenate((first[pair_index], second[pair_index])),
+            np.concatenate((points, points)))
+
+
+def in_window(points, window):
+    # Half-open, so that a point on a tile edge belongs to one tile only
+    west, south, east, north = window
+    return ((points[:, 0] >= west) & (points[:, 0] < east)
+            & (points[:, 1] >= south) & (points[:, 1] < north))
+
+
+def split_points(lines, window=None):
+    # (line index, point) of every point where a line has to be split, plus
+    # connectors as (line index, starts, ends) arrays; with a (west, south,
+    # east, north) window, only the points and connector ends inside it
+    tree = shapely.STRtree(lines)
+    split_lines, points, connectors = end_snaps(lines, tree)
+    if node_crossings:
+        crossing_lines, crossing_points = crossings(lines, tree)
+        split_lines = np.concatenate((split_lines, crossing_lines))
+        points = np.concatenate((points, crossing_points))
+    if window is not None:
+        inside = in_window(points, window)
+        split_lines, points = split_lines[inside], points[inside]
+        inside = in_window(connectors[1], window)
+        connectors = tuple(part[inside] for part in connectors)
+    return split_lines, points, connectors
+
+
+def insert_splits(lines, split_lines, split_points):
+    # Vertices of the lines with the split points inserted, as (rounded
+    # coordinates, line index) arrays in line order
+    coords, vertex_lines = shapely.get_coordinates(lines, return_index=True)
+    # Position of every vertex along its line, in degrees
+    steps = np.hypot(*np.diff(coords, axis=0).T)
+    steps[vertex_lines[1:] != vertex_lines[:-1]] = 0
+    along = np.concatenate(([0.0], np.cumsum(steps)))[:len(coords)]
+    along -= along[np.searchsorted(vertex_lines, vertex_lines)]
+    split_along = shapely.line_locate_point(lines[split_lines], shapely.points(split_points))
+
+    # Vertices first where a split point falls on one
+    coords = np.concatenate((coords, split_points))
+    vertex_lines = np.concatenate((vertex_lines, split_lines))
+    order = np.lexsort((np.arange(len(coords)), np.concatenate((along, split_along)), vertex_lines))
+    return np.round(coords[order], coord_decimals), vertex_lines[order]
+
+
+def node_lines(lines):
+    # Vertices of the noded lines as (coordinates, line index) arrays in
+    # line order, plus connectors as (line index, starts, ends) arrays
+    lines = np.asarray(lines, dtype=object)
+    split_lines, points, connectors = split_points(lines)
+    coords, vertex_lines = insert_splits(lines, split_lines, points)
+    return (coords, vertex_lines,
+            (connectors[0], np.round(connectors[1], coord_decimals), np.round(connectors[2], coord_decimals)))